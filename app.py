@@ -1,105 +1,3800 @@
 # app.py
 import os
-from flask import Flask, render_template, redirect, url_for, flash
+from flask import Flask, render_template, redirect, url_for, flash, request, session, g, abort, send_file, Response, stream_with_context
+from flask import has_request_context, before_render_template, template_rendered
+from markupsafe import Markup
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import make_transient_to_detached, validates
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from datetime import timedelta
+from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, login_url, current_user
+from werkzeug.exceptions import HTTPException
+from datetime import timedelta, timezone
+from zoneinfo import ZoneInfo, available_timezones
 import secrets
+import hashlib
+import sqlite3
+import threading
+import socket
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import re
+import json
+import base64
+import binascii
+import io
+import gzip
+import zlib
+import difflib
+import zipfile
+import time
+import calendar
+import functools
+import contextlib
+import math
+from collections import OrderedDict
+import click
+from flask.cli import AppGroup
 from dotenv import load_dotenv
 
+try:
+    import brotli  # необязательная зависимость: сжатие ответов brotli
+except ImportError:
+    brotli = None
+
+try:
+    import argon2  # необязательная зависимость: PASSWORD_HASH_METHOD=argon2
+except ImportError:
+    argon2 = None
+
+try:
+    from compression import zstd  # стандартная библиотека с Python 3.14
+except ImportError:
+    zstd = None
+
 load_dotenv()  # Загружаем переменные окружения из .env
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///notes.db')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app = Flask(__name__)
+app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///notes.db')
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['NOTES_PAGE_SIZE'] = int(os.getenv('NOTES_PAGE_SIZE', 30))
+# Применять миграции схемы при запуске (иначе - командой flask db-upgrade)
+app.config['AUTO_MIGRATE'] = os.getenv('AUTO_MIGRATE', 'true').lower() == 'true'
+# Кеш пользователей для load_user(): memory (в процессе), sqlite (общий файл,
+# по умолчанию instance/user-cache.db) или none
+app.config['USER_CACHE_BACKEND'] = os.getenv('USER_CACHE_BACKEND', 'memory')
+app.config['USER_CACHE_SIZE'] = int(os.getenv('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_TTL'] = int(os.getenv('USER_CACHE_TTL', 300))
+app.config['USER_CACHE_PATH'] = os.getenv('USER_CACHE_PATH')
+# Размер LRU-кеша отрисованных карточек заметок
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.getenv('FRAGMENT_CACHE_SIZE', 2048))
+# Сжатие ответов: минимальный размер в байтах и уровень (для gzip и brotli)
+app.config['COMPRESS_MIN_SIZE'] = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+app.config['COMPRESS_LEVEL'] = int(os.getenv('COMPRESS_LEVEL', 6))
+# Канал уведомлений /api/events: период проверки версий, пинг и время жизни соединения (с)
+app.config['SSE_POLL_INTERVAL'] = float(os.getenv('SSE_POLL_INTERVAL', 1.0))
+app.config['SSE_HEARTBEAT'] = float(os.getenv('SSE_HEARTBEAT', 15))
+app.config['SSE_MAX_SECONDS'] = float(os.getenv('SSE_MAX_SECONDS', 300))
+# Фоновые задачи: выполнять в веб-процессе (иначе - отдельным flask jobs worker),
+# число потоков, период опроса очереди (с), базовая задержка повтора (с),
+# предельное время выполнения (с), каталог файлов результатов и их срок хранения (ч)
+app.config['JOBS_ENABLED'] = os.getenv('JOBS_ENABLED', 'true').lower() == 'true'
+app.config['JOB_WORKERS'] = int(os.getenv('JOB_WORKERS', 2))
+app.config['JOB_POLL_INTERVAL'] = float(os.getenv('JOB_POLL_INTERVAL', 2.0))
+app.config['JOB_RETRY_DELAY'] = float(os.getenv('JOB_RETRY_DELAY', 30))
+app.config['JOB_TIMEOUT'] = int(os.getenv('JOB_TIMEOUT', 3600))
+app.config['JOB_RESULTS_DIR'] = os.getenv('JOB_RESULTS_DIR') or os.path.join(app.instance_path, 'jobs')
+app.config['JOB_RESULT_TTL'] = int(os.getenv('JOB_RESULT_TTL', 24))
+# Хеширование паролей: метод Werkzeug (scrypt:N:r:p, pbkdf2:sha256:итерации) или argon2
+app.config['PASSWORD_HASH_METHOD'] = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+app.config['ARGON2_TIME_COST'] = int(os.getenv('ARGON2_TIME_COST', 3))
+app.config['ARGON2_MEMORY_COST'] = int(os.getenv('ARGON2_MEMORY_COST', 65536))  # КиБ
+app.config['ARGON2_PARALLELISM'] = int(os.getenv('ARGON2_PARALLELISM', 4))
+# Пул хеширования: потоков, ожидающих в очереди и предельное ожидание (с)
+app.config['PASSWORD_HASH_WORKERS'] = int(os.getenv('PASSWORD_HASH_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+app.config['PASSWORD_HASH_QUEUE'] = int(os.getenv('PASSWORD_HASH_QUEUE', 16))
+app.config['PASSWORD_HASH_TIMEOUT'] = float(os.getenv('PASSWORD_HASH_TIMEOUT', 10))
+# Ограничение частоты: "попыток/секунд" на IP и на имя пользователя; пусто - без ограничения
+app.config['LOGIN_RATE_LIMIT_IP'] = os.getenv('LOGIN_RATE_LIMIT_IP', '20/60')
+app.config['LOGIN_RATE_LIMIT_USER'] = os.getenv('LOGIN_RATE_LIMIT_USER', '5/60')
+app.config['REGISTER_RATE_LIMIT_IP'] = os.getenv('REGISTER_RATE_LIMIT_IP', '5/600')
+# Токены сброса пароля: срок действия (ч), действующих токенов на пользователя и
+# период фоновой очистки просроченных и использованных (с; 0 - только flask sweep-reset-tokens)
+app.config['RESET_TOKEN_TTL'] = int(os.getenv('RESET_TOKEN_TTL', 24))
+app.config['RESET_TOKENS_PER_USER'] = int(os.getenv('RESET_TOKENS_PER_USER', 3))
+app.config['RESET_TOKEN_SWEEP_INTERVAL'] = int(os.getenv('RESET_TOKEN_SWEEP_INTERVAL', 3600))
+# Инструментирование запросов: /metrics и Server-Timing, порог медленного SQL (мс),
+# сколько повторов одного SQL за запрос считать N+1, токен для доступа к /metrics
+app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED', 'false').lower() == 'true'
+app.config['SLOW_QUERY_MS'] = float(os.getenv('SLOW_QUERY_MS', 100))
+app.config['N_PLUS_ONE_THRESHOLD'] = int(os.getenv('N_PLUS_ONE_THRESHOLD', 5))
+app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+# История версий заметок: сколько последних версий хранить на заметку (0 - все)
+# и не реже чем через сколько версий сохранять полный снимок вместо разницы
+app.config['NOTE_REVISIONS_KEEP'] = int(os.getenv('NOTE_REVISIONS_KEEP', 100))
+app.config['NOTE_REVISION_SNAPSHOT_EVERY'] = int(os.getenv('NOTE_REVISION_SNAPSHOT_EVERY', 20))
+# Сжатие содержания заметок в SQLite: zstd (Python 3.14+), zlib или none,
+# уровень сжатия и размер текста в символах, начиная с которого он сжимается
+app.config['CONTENT_COMPRESSION'] = os.getenv('CONTENT_COMPRESSION') or ('zstd' if zstd else 'zlib')
+app.config['CONTENT_COMPRESSION_LEVEL'] = int(os.getenv('CONTENT_COMPRESSION_LEVEL', 6))
+app.config['CONTENT_COMPRESSION_MIN'] = int(os.getenv('CONTENT_COMPRESSION_MIN', 4096))
+
+# --- НАСТРОЙКИ ДВИЖКА БАЗЫ ДАННЫХ ---
+
+# Профили PRAGMA для SQLite: tuned - для работы под gunicorn с несколькими
+# воркерами (WAL не блокирует читателей писателем), plain - настройки SQLite по умолчанию
+SQLITE_PROFILES = {
+    'tuned': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,  # в КиБ
+        'temp_store': 'MEMORY',
+    },
+    'plain': {},
+}
+
+
+def sqlite_pragmas(profile, overrides=''):
+    """PRAGMA профиля с переопределениями вида "cache_size=-20000,mmap_size=0" """
+    pragmas = dict(SQLITE_PROFILES[profile])
+    for item in filter(None, (part.strip() for part in overrides.split(','))):
+        name, _, value = item.partition('=')
+        pragmas[name.strip()] = value.strip()
+    return pragmas
+
+
+def engine_options(database_uri, pragmas):
+    """SQLALCHEMY_ENGINE_OPTIONS для SQLite и PostgreSQL"""
+    pool = {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 30)),
+    }
+    
+    if database_uri.startswith('sqlite'):
+        # Для базы в памяти используется собственный пул SQLAlchemy
+        if database_uri in ('sqlite://', 'sqlite:///:memory:'):
+            return {}
+        busy_timeout = int(pragmas.get('busy_timeout', 5000))
+        return dict(pool, connect_args={
+            'timeout': busy_timeout / 1000,
+            'check_same_thread': False,
+        })
+    
+    # PostgreSQL и прочие серверные СУБД: проверка и пересоздание соединений
+    return dict(pool, pool_pre_ping=True, pool_recycle=1800)
+
+
+app.config['DB_PROFILE'] = os.getenv('DB_PROFILE', 'tuned')
+app.config['SQLITE_PRAGMAS'] = sqlite_pragmas(app.config['DB_PROFILE'], os.getenv('SQLITE_PRAGMAS', ''))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+    app.config['SQLALCHEMY_DATABASE_URI'],
+    app.config['SQLITE_PRAGMAS']
+)
+
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas):
+    """Установка PRAGMA на новом соединении SQLite"""
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+
+def register_sqlite_functions(dbapi_connection):
+    """SQL-функции приложения. Без noteflow_plaintext (текст сжатой заметки)
+    не выполняются триггеры полнотекстового индекса, то есть любая запись в note"""
+    dbapi_connection.create_function('noteflow_plaintext', 1, decompress_content, deterministic=True)
+
+
+@event.listens_for(Engine, 'connect')
+def on_connect(dbapi_connection, connection_record):
+    """Настройка каждого нового соединения из пула"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        apply_sqlite_pragmas(dbapi_connection, app.config['SQLITE_PRAGMAS'])
+        register_sqlite_functions(dbapi_connection)
+
+# Инициализация базы данных
+db = SQLAlchemy(app)
+
+# --- ИНИЦИАЛИЗАЦИЯ FLASK-LOGIN ---
+login_manager = LoginManager()
+login_manager.init_app(app)
+login_manager.login_view = 'login'
+login_manager.login_message = 'Пожалуйста, войдите в систему'
+login_manager.login_message_category = 'warning'
+
+# --- ЗАГРУЗЧИК ПОЛЬЗОВАТЕЛЯ ---
+@login_manager.user_loader
+def load_user(user_id):
+    user = user_cache.get(int(user_id))
+    if user is None:
+        user = db.session.get(User, int(user_id))
+        if user is not None:
+            user_cache.set(user)
+    return user
+
+
+# --- СЖАТИЕ СОДЕРЖАНИЯ ЗАМЕТОК ---
+# В SQLite длинный Note.content хранится сжатым: маркер, код алгоритма и base85.
+# Текст, который сам начинается с маркера, сжимается при любой длине - так
+# чтение однозначно. Превью, счетчики и полнотекстовый индекс остаются текстом:
+# триггеры индекса читают содержание через SQL-функцию noteflow_plaintext.
+# PostgreSQL значения не трогаем: длинные строки он сжимает сам (TOAST),
+# а GIN-индекс поиска строится по выражению над текстом колонки
+
+CONTENT_MARKER = '\x1bnf:'
+# Код алгоритма в маркере -> (сжатие с уровнем, распаковка)
+CONTENT_CODECS = {
+    'z': (lambda data, level: zlib.compress(data, level), zlib.decompress),
+}
+if zstd is not None:
+    CONTENT_CODECS['s'] = (lambda data, level: zstd.compress(data, level), zstd.decompress)
+CONTENT_CODEC_NAMES = {'zlib': 'z', 'zstd': 's'}
+
+
+def content_codec():
+    """Код алгоритма по CONTENT_COMPRESSION (zstd без Python 3.14 - zlib); None - без сжатия"""
+    name = app.config['CONTENT_COMPRESSION']
+    if name == 'none':
+        return None
+    code = CONTENT_CODEC_NAMES.get(name, 'z')
+    return code if code in CONTENT_CODECS else 'z'
+
+
+def compress_content(text):
+    """Значение для колонки: сжатый текст, если он длиннее порога и сжатие выгодно"""
+    forced = text.startswith(CONTENT_MARKER)
+    code = content_codec() or ('z' if forced else None)
+    if code is None or (len(text) < app.config['CONTENT_COMPRESSION_MIN'] and not forced):
+        return text
+    
+    started = time.thread_time()
+    raw = text.encode()
+    packed = CONTENT_CODECS[code][0](raw, app.config['CONTENT_COMPRESSION_LEVEL'])
+    stored = f'{CONTENT_MARKER}{code}:{base64.b85encode(packed).decode()}'
+    content_codec_seconds.inc(time.thread_time() - started, operation='compress')
+    
+    # Несжимаемый текст (например, уже сжатые данные в base64) храним как есть
+    if len(stored) >= len(raw) and not forced:
+        return text
+    content_bytes.inc(len(raw), stage='plain')
+    content_bytes.inc(len(stored), stage='stored')
+    return stored
+
+
+def decompress_content(value):
+    """Текст заметки из значения колонки (несжатое возвращается как есть)"""
+    if not value or not value.startswith(CONTENT_MARKER):
+        return value
+    
+    started = time.thread_time()
+    code, _, payload = value[len(CONTENT_MARKER):].partition(':')
+    if code not in CONTENT_CODECS:
+        raise RuntimeError(f'Заметка сжата алгоритмом "{code}", недоступным в этой версии Python')
+    text = CONTENT_CODECS[code][1](base64.b85decode(payload)).decode()
+    content_codec_seconds.inc(time.thread_time() - started, operation='decompress')
+    return text
+
+
+class CompressedText(db.TypeDecorator):
+    """Text, длинные значения которого в SQLite хранятся сжатыми"""
+    impl = db.Text
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name != 'sqlite':
+            return value
+        return compress_content(value)
+    
+    def process_result_value(self, value, dialect):
+        return decompress_content(value)
+
+# --- ПАРОЛИ И ОГРАНИЧЕНИЕ ЧАСТОТЫ ВХОДА ---
+
+class PasswordHashBusy(Exception):
+    """Пул хеширования переполнен: запрос отклоняется, а не ждет"""
+
+
+def argon2_hasher():
+    return argon2.PasswordHasher(
+        time_cost=app.config['ARGON2_TIME_COST'],
+        memory_cost=app.config['ARGON2_MEMORY_COST'],
+        parallelism=app.config['ARGON2_PARALLELISM']
+    )
+
+
+if app.config['PASSWORD_HASH_METHOD'] == 'argon2' and argon2 is None:
+    raise RuntimeError('PASSWORD_HASH_METHOD=argon2 требует пакет argon2-cffi')
+
+
+@functools.lru_cache(maxsize=None)
+def password_hash_prefix(method):
+    """Префикс хеша Werkzeug с подставленными параметрами по умолчанию ("scrypt" -> "scrypt:32768:8:1")"""
+    return generate_password_hash('', method=method).split('$', 1)[0]
+
+
+def hash_password(password):
+    if app.config['PASSWORD_HASH_METHOD'] == 'argon2':
+        return argon2_hasher().hash(password)
+    return generate_password_hash(password, method=app.config['PASSWORD_HASH_METHOD'])
+
+
+def verify_password(password_hash, password):
+    if password_hash.startswith('$argon2'):
+        if argon2 is None:
+            app.logger.error('Хеш argon2 нельзя проверить: не установлен argon2-cffi')
+            return False
+        try:
+            return argon2_hasher().verify(password_hash, password)
+        except (argon2.exceptions.VerificationError, argon2.exceptions.InvalidHashError):
+            return False
+    return check_password_hash(password_hash, password)
+
+
+def password_needs_rehash(password_hash):
+    """Хеш получен другим методом или с другими параметрами, чем настроены сейчас"""
+    method = app.config['PASSWORD_HASH_METHOD']
+    if method == 'argon2':
+        return not password_hash.startswith('$argon2') or argon2_hasher().check_needs_rehash(password_hash)
+    return password_hash.split('$', 1)[0] != password_hash_prefix(method)
+
+
+class PasswordHashPool:
+    """Пул потоков для хеширования паролей.
+    
+    Одновременно считается не больше workers хешей (scrypt и argon2 отпускают
+    GIL и занимают ядро целиком), еще queue_size ждут; остальные запросы сразу
+    получают PasswordHashBusy, поэтому волна попыток входа не отнимает
+    процессор у обычных запросов.
+    """
+    
+    def __init__(self, workers, queue_size, timeout):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='password')
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.timeout = timeout
+    
+    def run(self, func, *args):
+        if not self.slots.acquire(blocking=False):
+            raise PasswordHashBusy()
+        try:
+            future = self.executor.submit(func, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise PasswordHashBusy()
+
+
+password_pool = PasswordHashPool(
+    app.config['PASSWORD_HASH_WORKERS'],
+    app.config['PASSWORD_HASH_QUEUE'],
+    app.config['PASSWORD_HASH_TIMEOUT']
+)
+
+
+class TokenBucket:
+    """Ограничение частоты по ключу: capacity попыток, восполняемых за period секунд.
+    
+    Корзины хранятся в памяти процесса (LRU на maxsize ключей), так что при
+    нескольких воркерах лимит действует в каждом из них отдельно.
+    """
+    
+    def __init__(self, capacity, period, maxsize=10000):
+        self.capacity = capacity
+        self.rate = capacity / period  # попыток в секунду
+        self.maxsize = maxsize
+        self.buckets = OrderedDict()  # ключ -> (остаток, время обновления)
+        self.lock = threading.Lock()
+    
+    def consume(self, key):
+        """Списание попытки: 0, если разрешена, иначе через сколько секунд повторить"""
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = math.ceil((1 - tokens) / self.rate)
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.maxsize:
+                self.buckets.popitem(last=False)
+        return wait
+    
+    def reset(self, key):
+        with self.lock:
+            self.buckets.pop(key, None)
+
+
+def create_token_bucket(limit):
+    """TokenBucket из строки "попыток/секунд"; пустая строка - без ограничения"""
+    if not limit:
+        return None
+    capacity, _, period = limit.partition('/')
+    return TokenBucket(int(capacity), float(period or 60))
+
+
+login_ip_limit = create_token_bucket(app.config['LOGIN_RATE_LIMIT_IP'])
+login_user_limit = create_token_bucket(app.config['LOGIN_RATE_LIMIT_USER'])
+register_ip_limit = create_token_bucket(app.config['REGISTER_RATE_LIMIT_IP'])
+
+
+def rate_limited(*checks):
+    """Проверки (корзина, ключ): 0, если все разрешают, иначе секунды до повтора"""
+    return max((bucket.consume(key) for bucket, key in checks if bucket), default=0)
+
+
+def rehash_password(user, password):
+    """Пересчет хеша после успешного входа, если изменились метод или параметры"""
+    if not password_needs_rehash(user.password_hash):
+        return
+    try:
+        user.set_password(password)
+    except PasswordHashBusy:
+        return  # пересчитаем при следующем входе
+    db.session.commit()
+    user_cache.invalidate(user.id)
+
+
+def too_many_attempts(template, retry_after):
+    flash(f'Слишком много попыток. Повторите через {retry_after} с', 'danger')
+    return render_template(template), 429, {'Retry-After': str(retry_after)}
+
+
+@app.errorhandler(PasswordHashBusy)
+def handle_password_hash_busy(error):
+    flash('Сервер перегружен, повторите попытку через несколько секунд', 'warning')
+    return redirect(request.referrer or url_for('index'))
+
+# --- МОДЕЛИ БАЗЫ ДАННЫХ ---
+
+class User(db.Model, UserMixin):
+    """Модель пользователя"""
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), unique=True, nullable=False)
+    email = db.Column(db.String(120), unique=True, nullable=False)
+    password_hash = db.Column(db.String(200), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Часовой пояс IANA: в нем считается статистика по месяцам, часам и дням недели
+    timezone = db.Column(db.String(50), nullable=False, default='UTC')
+    notes = db.relationship('Note', backref='author', lazy=True)
+    
+    def set_password(self, password):
+        """Хеширование пароля (в пуле хеширования)"""
+        self.password_hash = password_pool.run(hash_password, password)
+    
+    def check_password(self, password):
+        """Проверка пароля (в пуле хеширования)"""
+        return password_pool.run(verify_password, self.password_hash, password)
+    
+    def __repr__(self):
+        return f'<User {self.username}>'
+
+
+class Category(db.Model):
+    """Модель категории"""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), nullable=False)
+    color = db.Column(db.String(20), default='primary')
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # Версия данных пользователя, в которой категория изменилась последний раз
+    change_seq = db.Column(db.Integer, nullable=False, default=0)
+    notes = db.relationship('Note', backref='category_ref', lazy=True)
+    
+    __table_args__ = (
+        # Поиск категории по имени при создании и импорте
+        db.Index('ix_category_user_name', 'user_id', 'name'),
+        # Изменения после курсора синхронизации
+        db.Index('ix_category_user_change', 'user_id', 'change_seq'),
+    )
+    
+    def __repr__(self):
+        return f'<Category {self.name}>'
+
+
+# Связь заметок и тегов (многие ко многим)
+note_tags = db.Table(
+    'note_tags',
+    db.Column('note_id', db.Integer, db.ForeignKey('note.id'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
+    db.Index('ix_note_tags_tag_id', 'tag_id', 'note_id')
+)
+
+
+class Tag(db.Model):
+    """Модель тега"""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_tag_user_name', 'user_id', 'name', unique=True),
+    )
+    
+    def __repr__(self):
+        return f'<Tag {self.name}>'
+
+
+# Длина сохраняемого начала заметки для карточек в списках
+NOTE_PREVIEW_LENGTH = 100
+
+
+def content_summary(content):
+    """Превью и счетчики, хранимые рядом с содержанием заметки"""
+    content = content or ''
+    return {
+        'preview': content[:NOTE_PREVIEW_LENGTH],
+        'word_count': len(content.split()),
+        'char_count': len(content),
+    }
+
+
+class Note(db.Model):
+    """Модель заметки"""
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(100), nullable=False)
+    content = db.Column(CompressedText, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
+    is_pinned = db.Column(db.Boolean, default=False)
+    tags = db.Column(db.String(200))
+    is_archived = db.Column(db.Boolean, default=False)
+    # Списки показывают только превью: content туда не загружается
+    preview = db.Column(db.String(NOTE_PREVIEW_LENGTH), nullable=False, default='')
+    word_count = db.Column(db.Integer, nullable=False, default=0)
+    char_count = db.Column(db.Integer, nullable=False, default=0)
+    # Версия данных пользователя, в которой заметка изменилась последний раз
+    change_seq = db.Column(db.Integer, nullable=False, default=0)
+    # В tags хранится нормализованная строка для отображения,
+    # а фильтрация и подсчеты идут по таблице тегов
+    tag_refs = db.relationship('Tag', secondary=note_tags, lazy=True, backref='notes')
+    
+    __table_args__ = (
+        # Списки дашборда: фильтр по пользователю и архиву,
+        # сортировка "сначала закрепленные" и по дате / названию
+        db.Index('ix_note_list_updated', 'user_id', 'is_archived', 'is_pinned', 'updated_at'),
+        db.Index('ix_note_list_created', 'user_id', 'is_archived', 'is_pinned', 'created_at'),
+        # Для названия направления сортировки разные: закрепленные по убыванию, название по возрастанию
+        db.Index('ix_note_list_title', 'user_id', 'is_archived', db.text('is_pinned DESC'), 'title'),
+        # Фильтр по категории и счетчики по категориям
+        db.Index('ix_note_user_category', 'user_id', 'category_id'),
+        # Статистика по датам создания и изменения
+        db.Index('ix_note_user_created', 'user_id', 'created_at'),
+        db.Index('ix_note_user_updated', 'user_id', 'updated_at'),
+        # Изменения после курсора синхронизации
+        db.Index('ix_note_user_change', 'user_id', 'change_seq'),
+    )
+    
+    @validates('content')
+    def validate_content(self, key, content):
+        """Пересчет превью и счетчиков при каждом изменении содержания"""
+        for field, value in content_summary(content).items():
+            setattr(self, field, value)
+        return content
+    
+    def __repr__(self):
+        return f'<Note {self.title}>'
+
+class NoteRevision(db.Model):
+    """Версия заметки после сохранения: заголовок и сжатое содержание.
+    
+    data - zlib от полного текста (снимок, base_number пуст) или от разницы
+    по строкам со снимком base_number той же заметки.
+    """
+    __tablename__ = 'note_revision'
+    id = db.Column(db.Integer, primary_key=True)
+    note_id = db.Column(db.Integer, db.ForeignKey('note.id'), nullable=False)
+    number = db.Column(db.Integer, nullable=False)
+    base_number = db.Column(db.Integer)
+    title = db.Column(db.String(100), nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    size = db.Column(db.Integer, nullable=False, default=0)  # длина содержания в символах
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_note_revision_note_number', 'note_id', 'number', unique=True),
+    )
+    
+    def __repr__(self):
+        return f'<NoteRevision {self.note_id}#{self.number}>'
+
+class PasswordResetToken(db.Model):
+    """Токен для сброса пароля"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # В базе только sha256 от токена из ссылки: утечка таблицы не дает сбросить пароль
+    token_hash = db.Column('token', db.String(100), unique=True, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    is_used = db.Column(db.Boolean, default=False)
+    
+    user = db.relationship('User', backref='reset_tokens')
+    
+    __table_args__ = (
+        db.Index('ix_password_reset_token_user', 'user_id'),
+        # Очистка просроченных токенов
+        db.Index('ix_password_reset_token_expires', 'expires_at'),
+    )
+    
+    def is_valid(self):
+        """Проверка валидности токена"""
+        return (datetime.utcnow() < self.expires_at and 
+                not self.is_used)
+    
+    def __repr__(self):
+        return f'<PasswordResetToken {self.token_hash[:10]}...>'
+
+
+class UserState(db.Model):
+    """Версия данных пользователя: растет при любой записи заметок и категорий"""
+    __tablename__ = 'user_state'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<UserState {self.user_id} v{self.version}>'
+
+
+class NoteCounter(db.Model):
+    """Готовые счетчики заметок пользователя по категории (0 - без категории).
+    
+    Итоги пользователя - сумма его строк; поддерживаются в той же транзакции,
+    что и изменения заметок (см. раздел СЧЕТЧИКИ ЗАМЕТОК).
+    """
+    __tablename__ = 'note_counter'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    category_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    pinned = db.Column(db.Integer, nullable=False, default=0)  # закрепленные вне архива
+    archived = db.Column(db.Integer, nullable=False, default=0)
+    active = db.Column(db.Integer, nullable=False, default=0)  # не в архиве
+    
+    def __repr__(self):
+        return f'<NoteCounter {self.user_id}/{self.category_id}: {self.total}>'
+
+
+class Tombstone(db.Model):
+    """След удаленной заметки или категории для синхронизации клиентов"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    entity = db.Column(db.String(20), nullable=False)  # имя таблицы: note, category
+    entity_id = db.Column(db.Integer, nullable=False)
+    change_seq = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_tombstone_user_change', 'user_id', 'change_seq'),
+    )
+    
+    def __repr__(self):
+        return f'<Tombstone {self.entity} {self.entity_id}>'
+
+
+class Job(db.Model):
+    """Фоновая задача: экспорт, импорт, пересчет статистики, переиндексация"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # None - системная задача
+    kind = db.Column(db.String(50), nullable=False)
+    params = db.Column(db.Text, nullable=False, default='{}')  # JSON
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    worker = db.Column(db.String(100))
+    error = db.Column(db.Text)
+    result = db.Column(db.Text)  # JSON
+    result_path = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_job_status_run_after', 'status', 'run_after'),
+        db.Index('ix_job_user_created', 'user_id', 'created_at'),
+    )
+    
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind} {self.status}>'
+
+# --- КЕШ ПОЛЬЗОВАТЕЛЕЙ ---
+
+class MemoryCacheBackend:
+    """LRU-кеш в памяти процесса с ограничением по размеру и времени жизни"""
+    
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+    
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+    
+    def __len__(self):
+        return len(self._items)
+
+
+class SQLiteCacheBackend:
+    """Общий кеш в файле SQLite для нескольких воркеров на одной машине"""
+    
+    def __init__(self, path, maxsize=1024, ttl=300):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._local = threading.local()
+        # В кеше адреса почты: файл доступен только владельцу процесса
+        os.close(os.open(path, os.O_CREAT | os.O_RDWR, 0o600))
+        os.chmod(path, 0o600)
+        with self._connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+    
+    def _connection(self):
+        # Соединение sqlite3 нельзя делить между потоками - по одному на поток
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self._local.conn = conn
+        return conn
+    
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value FROM cache WHERE key = ? AND expires_at >= ?',
+            (str(key), time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def set(self, key, value):
+        conn = self._connection()
+        now = time.time()
+        conn.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+            (str(key), json.dumps(value), now + self.ttl)
+        )
+        # Вытесняем просроченные записи и самые старые сверх лимита
+        conn.execute('DELETE FROM cache WHERE expires_at < ?', (now,))
+        conn.execute(
+            'DELETE FROM cache WHERE key IN ('
+            'SELECT key FROM cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?)',
+            (self.maxsize,)
+        )
+    
+    def delete(self, key):
+        self._connection().execute('DELETE FROM cache WHERE key = ?', (str(key),))
+    
+    def clear(self):
+        self._connection().execute('DELETE FROM cache')
+    
+    def __len__(self):
+        return self._connection().execute('SELECT count(*) FROM cache').fetchone()[0]
+
+
+class UserCache:
+    """Кеш данных пользователя для load_user() с подсчетом попаданий"""
+    
+    # Колонки User, из которых восстанавливается объект без запроса к базе.
+    # password_hash не кешируется: он догружается из базы при обращении,
+    # то есть только при входе и смене пароля
+    FIELDS = ('id', 'username', 'email', 'created_at', 'timezone')
+    
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+    
+    def get(self, user_id):
+        """Пользователь из кеша, присоединенный к сессии, или None"""
+        if self.backend is None:
+            return None
+        
+        data = self.backend.get(user_id)
+        # Запись старого формата (до появления колонки) считаем промахом
+        if data is None or len(data) != len(self.FIELDS):
+            self.misses += 1
+            return None
+        
+        self.hits += 1
+        user = User(**data)
+        if data['created_at']:
+            user.created_at = datetime.fromisoformat(data['created_at'])
+        make_transient_to_detached(user)
+        # load=False - объект попадает в identity map без SELECT
+        return db.session.merge(user, load=False)
+    
+    def set(self, user):
+        if self.backend is None:
+            return
+        data = {field: getattr(user, field) for field in self.FIELDS}
+        data['created_at'] = user.created_at.isoformat() if user.created_at else None
+        self.backend.set(user.id, data)
+    
+    def invalidate(self, user_id):
+        """Сброс записи после изменения пользователя"""
+        if self.backend is None:
+            return
+        self.backend.delete(user_id)
+        self.invalidations += 1
+    
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__ if self.backend else None,
+            'size': len(self.backend) if self.backend else 0,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_rate': round(self.hits / requests, 4) if requests else None,
+        }
+
+
+def create_user_cache(backend, maxsize, ttl, path=None):
+    """Кеш пользователей по имени бэкенда: memory, sqlite или none"""
+    if backend == 'memory':
+        return UserCache(MemoryCacheBackend(maxsize, ttl))
+    if backend == 'sqlite':
+        if path is None:
+            os.makedirs(app.instance_path, exist_ok=True)
+            path = os.path.join(app.instance_path, 'user-cache.db')
+        return UserCache(SQLiteCacheBackend(path, maxsize, ttl))
+    if backend == 'none':
+        return UserCache()
+    raise ValueError(f'Неизвестный бэкенд кеша пользователей: {backend}')
+
+
+user_cache = create_user_cache(
+    app.config['USER_CACHE_BACKEND'],
+    app.config['USER_CACHE_SIZE'],
+    app.config['USER_CACHE_TTL'],
+    app.config['USER_CACHE_PATH']
+)
+
+# --- ТОКЕНЫ СБРОСА ПАРОЛЯ ---
+
+def hash_reset_token(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def find_reset_token(token):
+    """Токен по значению из ссылки.
+    
+    Поиск идет по sha256, поэтому время сравнения в индексе зависит только от
+    хеша и ничего не говорит о самом токене.
+    """
+    return PasswordResetToken.query.filter_by(token_hash=hash_reset_token(token)).first()
+
+
+def issue_reset_token(user):
+    """Новый токен сброса; самые старые действующие токены сверх лимита удаляются"""
+    now = datetime.utcnow()
+    keep = app.config['RESET_TOKENS_PER_USER'] - 1
+    outdated = db.select(PasswordResetToken.id).where(
+        PasswordResetToken.user_id == user.id,
+        PasswordResetToken.is_used.is_(False),
+        PasswordResetToken.expires_at > now
+    ).order_by(PasswordResetToken.created_at.desc(), PasswordResetToken.id.desc()).offset(keep)
+    db.session.execute(db.delete(PasswordResetToken).where(
+        PasswordResetToken.id.in_(outdated.scalar_subquery())
+    ))
+    
+    token = secrets.token_urlsafe(32)
+    db.session.add(PasswordResetToken(
+        user_id=user.id,
+        token_hash=hash_reset_token(token),
+        expires_at=now + timedelta(hours=app.config['RESET_TOKEN_TTL'])
+    ))
+    return token
+
+
+def sweep_reset_tokens(batch_size=1000):
+    """Удаление просроченных и использованных токенов партиями; возвращает их число"""
+    deleted = 0
+    stale = db.or_(
+        PasswordResetToken.expires_at <= datetime.utcnow(),
+        PasswordResetToken.is_used.is_(True)
+    )
+    
+    while True:
+        ids = db.session.scalars(
+            db.select(PasswordResetToken.id).where(stale).limit(batch_size)
+        ).all()
+        if not ids:
+            break
+        db.session.execute(db.delete(PasswordResetToken).where(PasswordResetToken.id.in_(ids)))
+        db.session.commit()
+        deleted += len(ids)
+    
+    return deleted
+
+
+def hash_stored_reset_tokens():
+    """Замена открытых токенов их хешами (для миграции)"""
+    sweep_reset_tokens()
+    rows = db.session.execute(db.select(PasswordResetToken.id, PasswordResetToken.token_hash)).all()
+    if rows:
+        table = PasswordResetToken.__table__
+        db.session.execute(table.update().where(
+            table.c.id == db.bindparam('token_id')
+        ).values(token=db.bindparam('hashed')), [
+            {'token_id': token_id, 'hashed': hash_reset_token(token)} for token_id, token in rows
+        ])
+
+# --- МИГРАЦИИ СХЕМЫ ---
+
+class SchemaVersion(db.Model):
+    """Примененная миграция схемы"""
+    __tablename__ = 'schema_version'
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# Список (версия, описание, функция); заполняется декоратором migration
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Регистрация функции миграции схемы под номером версии"""
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+
+def add_column(table, column, ddl):
+    """ALTER TABLE ... ADD COLUMN, если колонки еще нет"""
+    columns = {item['name'] for item in db.inspect(db.session.connection()).get_columns(table)}
+    if column not in columns:
+        # "user" - зарезервированное слово в PostgreSQL
+        quoted = db.engine.dialect.identifier_preparer.quote(table)
+        db.session.execute(db.text(f'ALTER TABLE {quoted} ADD COLUMN {column} {ddl}'))
+
+
+def create_indexes(*names):
+    """Создание перечисленных индексов моделей, которых еще нет в базе.
+    
+    Миграция называет свои индексы явно: индексы, добавленные в модели позже,
+    могут ссылаться на колонки, которые появятся только в следующих миграциях.
+    """
+    indexes = {index.name: index for table in db.metadata.tables.values() for index in table.indexes}
+    connection = db.session.connection()
+    for name in names:
+        indexes[name].create(bind=connection, checkfirst=True)
+
+
+def migrate_database():
+    """Создание новых таблиц и применение еще не примененных миграций"""
+    db.create_all()
+    
+    applied = {version for (version,) in db.session.query(SchemaVersion.version)}
+    done = []
+    
+    for version, description, func in sorted(MIGRATIONS, key=lambda item: item[0]):
+        if version in applied:
+            continue
+        func()
+        db.session.add(SchemaVersion(version=version, description=description))
+        db.session.commit()
+        done.append((version, description))
+    
+    return done
+
+# --- ТЕГИ ---
+
+def parse_tags(raw):
+    """Нормализованные имена тегов из строки через запятую, без повторов"""
+    names = []
+    length = 0
+    for part in (raw or '').split(','):
+        name = part.strip().lower()[:50]
+        if not name or name in names:
+            continue
+        # Строка тегов должна помещаться в колонку Note.tags
+        length += len(name) + (2 if names else 0)
+        if length > 200:
+            break
+        names.append(name)
+    return names
+
+
+def get_or_create_tags(user_id, names):
+    """Теги пользователя по именам; недостающие создаются"""
+    if not names:
+        return []
+    
+    by_name = {
+        tag.name: tag
+        for tag in Tag.query.filter(Tag.user_id == user_id, Tag.name.in_(names))
+    }
+    
+    for name in names:
+        if name not in by_name:
+            by_name[name] = Tag(name=name, user_id=user_id)
+            db.session.add(by_name[name])
+    
+    return [by_name[name] for name in names]
+
+
+def set_note_tags(note, raw):
+    """Установка тегов заметки из строки через запятую"""
+    names = parse_tags(raw)
+    note.tags = ', '.join(names)
+    note.tag_refs = get_or_create_tags(note.user_id, names)
+
+
+def ensure_tag_ids(user_id, names):
+    """id тегов пользователя по именам; недостающие вставляются одним запросом"""
+    if not names:
+        return {}
+    
+    existing = dict(db.session.query(Tag.name, Tag.id).filter(
+        Tag.user_id == user_id,
+        Tag.name.in_(names)
+    ))
+    missing = [{'name': name, 'user_id': user_id} for name in names if name not in existing]
+    
+    if missing:
+        db.session.execute(db.insert(Tag), missing)
+        existing = dict(db.session.query(Tag.name, Tag.id).filter(
+            Tag.user_id == user_id,
+            Tag.name.in_(names)
+        ))
+    
+    return existing
+
+
+def backfill_tags(batch_size=1000):
+    """Перенос тегов из строк Note.tags в таблицу тегов; возвращает число заметок"""
+    processed = 0
+    last_id = 0
+    
+    while True:
+        rows = db.session.query(Note.id, Note.user_id, Note.tags).filter(
+            Note.id > last_id,
+            Note.tags.isnot(None),
+            Note.tags != ''
+        ).order_by(Note.id).limit(batch_size).all()
+        
+        if not rows:
+            break
+        last_id = rows[-1].id
+        
+        # Недостающие теги создаем пачкой для всех пользователей партии
+        wanted = {}
+        for row in rows:
+            wanted.setdefault(row.user_id, set()).update(parse_tags(row.tags))
+        
+        tag_ids = {}
+        for user_id, names in wanted.items():
+            for name, tag_id in ensure_tag_ids(user_id, names).items():
+                tag_ids[(user_id, name)] = tag_id
+        
+        # Уже существующие связи не дублируем
+        linked = set(db.session.query(note_tags.c.note_id, note_tags.c.tag_id).filter(
+            note_tags.c.note_id.in_([row.id for row in rows])
+        ))
+        links = []
+        for row in rows:
+            for name in parse_tags(row.tags):
+                key = (row.id, tag_ids[(row.user_id, name)])
+                if key not in linked:
+                    linked.add(key)
+                    links.append({'note_id': key[0], 'tag_id': key[1]})
+        if links:
+            db.session.execute(note_tags.insert(), links)
+        
+        db.session.commit()
+        processed += len(rows)
+    
+    return processed
+
+
+def top_tags(user_id, limit=10):
+    """Самые частые теги пользователя: [(имя, число заметок)]"""
+    count = db.func.count(note_tags.c.note_id)
+    return db.session.query(Tag.name, count).join(
+        note_tags, note_tags.c.tag_id == Tag.id
+    ).filter(
+        Tag.user_id == user_id
+    ).group_by(Tag.id, Tag.name).order_by(count.desc(), Tag.name).limit(limit).all()
+
+# --- ЭКСПОРТ ---
+
+# Формат: (MIME-тип, расширение файла)
+EXPORT_FORMATS = {
+    'md': ('text/markdown', 'md'),
+    'zip': ('application/zip', 'zip'),
+    'jsonl': ('application/x-ndjson', 'jsonl'),
+}
+
+EXPORT_BATCH_SIZE = 500
+
+
+class StreamBuffer(io.RawIOBase):
+    """Буфер только для записи: ZipFile пишет в него, а мы забираем готовые куски"""
+    
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def export_notes_query(user_id):
+    """Неархивные заметки пользователя, читаемые из базы партиями"""
+    return Note.query.filter_by(
+        user_id=user_id,
+        is_archived=False
+    ).order_by(Note.created_at.desc(), Note.id.desc()).yield_per(EXPORT_BATCH_SIZE)
+
+
+def note_markdown(note, category_name=None):
+    """Раздел Markdown для одной заметки (формат понимает и импорт)"""
+    parts = [f"## {note.title}\n\n"]
+    
+    if category_name:
+        parts.append(f"**Категория:** {category_name}\n\n")
+    
+    if note.tags:
+        parts.append(f"**Теги:** {note.tags}\n\n")
+    
+    parts.append(f"**Создано:** {note.created_at.strftime('%d.%m.%Y %H:%M')}\n")
+    parts.append(f"**Обновлено:** {note.updated_at.strftime('%d.%m.%Y %H:%M')}\n\n")
+    
+    if note.content:
+        parts.append(f"{note.content}\n")
+    
+    parts.append("\n---\n\n")
+    return ''.join(parts)
+
+
+def note_export_record(note, category_name=None):
+    """Заметка в виде словаря для JSON Lines"""
+    return {
+        'id': note.id,
+        'title': note.title,
+        'content': note.content,
+        'category': category_name,
+        'tags': parse_tags(note.tags),
+        'is_pinned': bool(note.is_pinned),
+        'created_at': note.created_at.isoformat(),
+        'updated_at': note.updated_at.isoformat(),
+    }
+
+
+def note_export_filename(note):
+    """Имя файла заметки внутри ZIP-архива"""
+    slug = re.sub(r'[^\w-]+', '_', note.title).strip('_')[:50] or 'note'
+    return f"{note.created_at.strftime('%Y%m%d')}_{note.id}_{slug}.md"
+
+
+def export_chunks(export_format, user_id, username):
+    """Генератор частей файла экспорта: в памяти держится одна партия заметок"""
+    # Категории загружаем один раз, а не по запросу на заметку
+    categories = dict(db.session.query(Category.id, Category.name).filter_by(user_id=user_id))
+    notes = export_notes_query(user_id)
+    
+    if export_format == 'jsonl':
+        for note in notes:
+            record = note_export_record(note, categories.get(note.category_id))
+            yield json.dumps(record, ensure_ascii=False) + '\n'
+    
+    elif export_format == 'zip':
+        buffer = StreamBuffer()
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for note in notes:
+                archive.writestr(
+                    note_export_filename(note),
+                    note_markdown(note, categories.get(note.category_id))
+                )
+                yield buffer.drain()
+        # Центральный каталог архива пишется при закрытии
+        yield buffer.drain()
+    
+    else:
+        total = Note.query.filter_by(user_id=user_id, is_archived=False).count()
+        yield (
+            f"# Экспорт заметок из NoteFlow\n\n"
+            f"Пользователь: {username}\n"
+            f"Дата экспорта: {datetime.utcnow().strftime('%d.%m.%Y %H:%M')}\n"
+            f"Всего заметок: {total}\n\n"
+        )
+        for note in notes:
+            yield note_markdown(note, categories.get(note.category_id))
+
+# --- ИМПОРТ ---
+
+IMPORT_BATCH_SIZE = 500
+IMPORT_MAX_ERRORS = 100
+
+# Расширение файла -> формат импорта
+IMPORT_EXTENSIONS = {
+    '.md': 'md',
+    '.markdown': 'md',
+    '.txt': 'md',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.zip': 'zip',
+}
+
+MARKDOWN_META_RE = re.compile(r'^\*\*(Категория|Теги|Создано|Обновлено):\*\*\s?(.*)$')
+MARKDOWN_META_FIELDS = {
+    'Категория': 'category',
+    'Теги': 'tags',
+    'Создано': 'created_at',
+    'Обновлено': 'updated_at',
+}
+
+
+class NoteImportError(ValueError):
+    """Ошибка импорта: неверный файл или отдельная запись"""
+
+
+def import_format_for(filename):
+    """Формат импорта по расширению файла"""
+    return IMPORT_EXTENSIONS.get(os.path.splitext(filename or '')[1].lower())
+
+
+def parse_markdown_export(lines, source='md'):
+    """Построчный разбор Markdown-экспорта: пары (место в файле, запись)"""
+    record = None
+    body = []
+    start = 0
+    in_meta = False
+    
+    for line_no, raw_line in enumerate(lines, 1):
+        line = raw_line.rstrip('\r\n')
+        
+        # Новая заметка: заголовок в начале файла или сразу после разделителя
+        if line.startswith('## ') and (record is None or body[-2:] == ['---', '']):
+            if record is not None:
+                record['content'] = '\n'.join(body[:-2]).strip()
+                yield f'{source}:{start}', record
+            record = {'title': line[3:].strip()}
+            body = []
+            start = line_no
+            in_meta = True
+            continue
+        
+        # Шапка экспорта до первой заметки
+        if record is None:
+            continue
+        
+        if in_meta:
+            match = MARKDOWN_META_RE.match(line)
+            if match:
+                record[MARKDOWN_META_FIELDS[match.group(1)]] = match.group(2).strip()
+                continue
+            if not line.strip():
+                continue
+            in_meta = False
+        
+        body.append(line)
+    
+    if record is not None:
+        while body and body[-1].strip() in ('', '---'):
+            body.pop()
+        record['content'] = '\n'.join(body).strip()
+        yield f'{source}:{start}', record
+
+
+def parse_jsonl_export(lines, source='jsonl'):
+    """Построчный разбор JSON Lines: пары (место в файле, запись или ошибка)"""
+    for line_no, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        
+        ref = f'{source}:{line_no}'
+        try:
+            record = json.loads(line)
+        except ValueError as error:
+            yield ref, NoteImportError(f'некорректный JSON: {error}')
+            continue
+        
+        if not isinstance(record, dict):
+            yield ref, NoteImportError('ожидается JSON-объект')
+            continue
+        
+        yield ref, record
+
+
+TEXT_PARSERS = {
+    'md': parse_markdown_export,
+    'jsonl': parse_jsonl_export,
+}
+
+
+def parse_zip_export(stream):
+    """Разбор ZIP-архива: каждый .md или .jsonl файл читается потоком"""
+    try:
+        archive = zipfile.ZipFile(stream)
+    except zipfile.BadZipFile:
+        raise NoteImportError('файл не является ZIP-архивом')
+    
+    with archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            
+            parser = TEXT_PARSERS.get(import_format_for(info.filename))
+            if parser is None:
+                yield info.filename, NoteImportError('неподдерживаемый тип файла')
+                continue
+            
+            with archive.open(info) as member:
+                yield from parser(io.TextIOWrapper(member, encoding='utf-8'), info.filename)
+
+
+def import_records(stream, filename, import_format=None):
+    """Поток записей из загруженного файла (бинарный поток)"""
+    import_format = import_format or import_format_for(filename)
+    
+    if import_format == 'zip':
+        return parse_zip_export(stream)
+    if import_format in TEXT_PARSERS:
+        text = io.TextIOWrapper(stream, encoding='utf-8')
+        return TEXT_PARSERS[import_format](text, filename or import_format)
+    
+    raise NoteImportError('неизвестный формат: ожидается .md, .jsonl или .zip')
+
+
+def parse_import_datetime(value):
+    """Дата из ISO 8601 или из формата Markdown-экспорта"""
+    if not value:
+        return None
+    
+    for parse in (datetime.fromisoformat, lambda text: datetime.strptime(text, '%d.%m.%Y %H:%M')):
+        try:
+            return parse(str(value).strip())
+        except ValueError:
+            continue
+    
+    raise NoteImportError(f'некорректная дата: {value}')
+
+
+def normalize_import_record(record):
+    """Проверка записи импорта и приведение к полям заметки"""
+    title = str(record.get('title') or '').strip()
+    if not title:
+        raise NoteImportError('отсутствует заголовок')
+    if len(title) > 100:
+        raise NoteImportError('заголовок длиннее 100 символов')
+    
+    content = record.get('content') or ''
+    if not isinstance(content, str):
+        raise NoteImportError('содержание должно быть строкой')
+    
+    category = str(record.get('category') or '').strip()
+    if len(category) > 50:
+        raise NoteImportError('название категории длиннее 50 символов')
+    
+    tags = record.get('tags') or ''
+    if isinstance(tags, list):
+        tags = ','.join(str(tag) for tag in tags)
+    
+    created_at = parse_import_datetime(record.get('created_at')) or datetime.utcnow()
+    updated_at = parse_import_datetime(record.get('updated_at')) or created_at
+    
+    return {
+        'title': title,
+        'content': content.strip(),
+        'category': category,
+        'tags': parse_tags(str(tags)),
+        'is_pinned': bool(record.get('is_pinned')),
+        'created_at': created_at,
+        'updated_at': updated_at,
+    }
+
+
+def insert_import_batch(user_id, batch, category_ids):
+    """Вставка партии заметок executemany-запросами в одной транзакции"""
+    seq = bump_user_version(user_id)
+    
+    # Недостающие категории создаем одним запросом
+    missing = {row['category'] for row in batch if row['category']} - set(category_ids)
+    if missing:
+        db.session.execute(db.insert(Category), [
+            {'name': name, 'user_id': user_id, 'color': 'primary', 'change_seq': seq}
+            for name in missing
+        ])
+        category_ids.update(db.session.query(Category.name, Category.id).filter(
+            Category.user_id == user_id,
+            Category.name.in_(missing)
+        ))
+    
+    note_ids = db.session.execute(
+        db.insert(Note).returning(Note.id, sort_by_parameter_order=True),
+        [{
+            'title': row['title'],
+            'content': row['content'],
+            **content_summary(row['content']),
+            'tags': ', '.join(row['tags']),
+            'user_id': user_id,
+            'category_id': category_ids.get(row['category']),
+            'is_pinned': row['is_pinned'],
+            'is_archived': False,
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at'],
+            'change_seq': seq,
+        } for row in batch]
+    ).scalars().all()
+    
+    tag_ids = ensure_tag_ids(user_id, {name for row in batch for name in row['tags']})
+    links = [
+        {'note_id': note_id, 'tag_id': tag_ids[name]}
+        for note_id, row in zip(note_ids, batch)
+        for name in row['tags']
+    ]
+    if links:
+        db.session.execute(note_tags.insert(), links)
+    
+    deltas = {}
+    for row in batch:
+        counter_delta(deltas, user_id, category_ids.get(row['category']), row['is_pinned'], False, 1)
+    add_counter_deltas(deltas)
+    
+    db.session.commit()
+
+
+def import_notes(user_id, records, batch_size=IMPORT_BATCH_SIZE):
+    """Импорт потока записей партиями; возвращает отчет со скоростью и ошибками"""
+    started = time.perf_counter()
+    report = {'imported': 0, 'failed': 0, 'errors': []}
+    category_ids = dict(db.session.query(Category.name, Category.id).filter_by(user_id=user_id))
+    batch = []
+    
+    def fail(ref, error):
+        report['failed'] += 1
+        if len(report['errors']) < IMPORT_MAX_ERRORS:
+            report['errors'].append({'ref': ref, 'error': str(error)})
+    
+    try:
+        for ref, record in records:
+            if isinstance(record, Exception):
+                fail(ref, record)
+                continue
+            
+            try:
+                batch.append(normalize_import_record(record))
+            except NoteImportError as error:
+                fail(ref, error)
+                continue
+            
+            if len(batch) >= batch_size:
+                insert_import_batch(user_id, batch, category_ids)
+                report['imported'] += len(batch)
+                batch = []
+    except (NoteImportError, UnicodeDecodeError) as error:
+        # Файл дальше читать нельзя: сохраняем то, что уже разобрано
+        fail('file', error)
+    
+    if batch:
+        insert_import_batch(user_id, batch, category_ids)
+        report['imported'] += len(batch)
+    
+    elapsed = time.perf_counter() - started
+    report['seconds'] = round(elapsed, 3)
+    report['notes_per_second'] = round(report['imported'] / elapsed, 1) if elapsed else 0.0
+    return report
+
+# --- ПОЛНОТЕКСТОВЫЙ ПОИСК ---
+
+# Выражение для PostgreSQL: по нему строится GIN-индекс и тем же выражением
+# фильтруется запрос, иначе планировщик индекс не использует
+PG_SEARCH_VECTOR = (
+    "to_tsvector('simple', coalesce(note.title, '') || ' ' || "
+    "coalesce(note.content, '') || ' ' || coalesce(note.tags, ''))"
+)
+
+SQLITE_SEARCH_DDL = [
+    # Таблица без собственного содержимого (content=''): хранится только индекс
+    """CREATE VIRTUAL TABLE note_fts USING fts5(
+        title, content, tags,
+        content='', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS note_fts_ai AFTER INSERT ON note BEGIN
+        INSERT INTO note_fts(rowid, title, content, tags)
+        VALUES (new.id, new.title, noteflow_plaintext(new.content), coalesce(new.tags, ''));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS note_fts_ad AFTER DELETE ON note BEGIN
+        INSERT INTO note_fts(note_fts, rowid, title, content, tags)
+        VALUES ('delete', old.id, old.title, noteflow_plaintext(old.content), coalesce(old.tags, ''));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS note_fts_au AFTER UPDATE OF title, content, tags ON note BEGIN
+        INSERT INTO note_fts(note_fts, rowid, title, content, tags)
+        VALUES ('delete', old.id, old.title, noteflow_plaintext(old.content), coalesce(old.tags, ''));
+        INSERT INTO note_fts(rowid, title, content, tags)
+        VALUES (new.id, new.title, noteflow_plaintext(new.content), coalesce(new.tags, ''));
+    END""",
+]
+
+SQLITE_SEARCH_FILL = (
+    "INSERT INTO note_fts(rowid, title, content, tags) "
+    "SELECT id, title, noteflow_plaintext(content), coalesce(tags, '') FROM note"
+)
+
+
+def init_search_index():
+    """Создание полнотекстового индекса (FTS5 для SQLite, GIN для PostgreSQL)"""
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        db.session.execute(db.text(
+            f"CREATE INDEX IF NOT EXISTS ix_note_search ON note USING GIN ({PG_SEARCH_VECTOR})"
+        ))
+    elif dialect == 'sqlite':
+        exists = db.session.execute(db.text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'note_fts'"
+        )).first()
+
+        if not exists:
+            for statement in SQLITE_SEARCH_DDL:
+                db.session.execute(db.text(statement))
+            # Индексируем заметки, созданные до появления поиска
+            db.session.execute(db.text(SQLITE_SEARCH_FILL))
+
+    db.session.commit()
+
+
+def rebuild_search_index():
+    """Полная переиндексация заметок (после сбоя или правки базы в обход триггеров)"""
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        db.session.execute(db.text('REINDEX INDEX ix_note_search'))
+    elif dialect == 'sqlite':
+        db.session.execute(db.text("INSERT INTO note_fts(note_fts) VALUES ('delete-all')"))
+        db.session.execute(db.text(SQLITE_SEARCH_FILL))
+
+    db.session.commit()
+
+
+def recreate_search_triggers():
+    """Пересоздание триггеров FTS5 по текущему SQLITE_SEARCH_DDL (индекс не трогается)"""
+    if db.engine.dialect.name != 'sqlite':
+        return
+    for name in ('note_fts_ai', 'note_fts_ad', 'note_fts_au'):
+        db.session.execute(db.text(f'DROP TRIGGER IF EXISTS {name}'))
+    for statement in SQLITE_SEARCH_DDL:
+        if statement.startswith('CREATE TRIGGER'):
+            db.session.execute(db.text(statement))
+
+
+@contextlib.contextmanager
+def search_index_suspended():
+    """Массовая вставка заметок без построчной индексации (SQLite): триггер
+    вставки снимается, а индекс перестраивается одним запросом в конце"""
+    if db.engine.dialect.name != 'sqlite':
+        yield
+        return
+    
+    trigger = next(ddl for ddl in SQLITE_SEARCH_DDL if 'note_fts_ai' in ddl)
+    db.session.execute(db.text('DROP TRIGGER IF EXISTS note_fts_ai'))
+    db.session.commit()
+    try:
+        yield
+    finally:
+        db.session.rollback()
+        db.session.execute(db.text(trigger))
+        rebuild_search_index()
+
+
+def search_terms(search_query):
+    """Разбивка поискового запроса на слова без служебных символов"""
+    return [term.lower() for term in re.findall(r'\w+', search_query)]
+
+
+def search_subquery(search_query):
+    """Подзапрос (note_id, rank) с релевантностью: чем меньше rank, тем выше"""
+    terms = search_terms(search_query)
+    if not terms:
+        return None
+
+    if db.engine.dialect.name == 'postgresql':
+        # Префиксный поиск: "заме" найдет "заметка"
+        ts_query = ' & '.join(f'{term}:*' for term in terms)
+        statement = db.text(
+            f"SELECT id AS note_id, -ts_rank({PG_SEARCH_VECTOR}, to_tsquery('simple', :q)) AS rank "
+            f"FROM note WHERE {PG_SEARCH_VECTOR} @@ to_tsquery('simple', :q)"
+        )
+    else:
+        ts_query = ' '.join(f'"{term}"*' for term in terms)
+        # Совпадение в заголовке весит больше, чем в тегах и тексте
+        statement = db.text(
+            "SELECT rowid AS note_id, bm25(note_fts, 10.0, 1.0, 5.0) AS rank "
+            "FROM note_fts WHERE note_fts MATCH :q"
+        )
+
+    return statement.bindparams(q=ts_query).columns(
+        note_id=db.Integer,
+        rank=db.Float
+    ).subquery('search')
+
+# --- ПОСТРАНИЧНАЯ ВЫДАЧА ---
+
+def note_sort_keys(sort_by, search=None):
+    """Ключи сортировки (колонка, по убыванию): закрепленные всегда первыми, id - для однозначности"""
+    if sort_by == 'relevance' and search is not None:
+        return [(Note.is_pinned, True), (search.c.rank, False), (Note.id, False)]
+    if sort_by == 'created':
+        return [(Note.is_pinned, True), (Note.created_at, True), (Note.id, True)]
+    if sort_by == 'title':
+        return [(Note.is_pinned, True), (Note.title, False), (Note.id, False)]
+    # updated (по умолчанию)
+    return [(Note.is_pinned, True), (Note.updated_at, True), (Note.id, True)]
+
+
+def encode_cursor(values):
+    """Курсор - значения ключей сортировки последней строки страницы"""
+    payload = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode('utf-8')).decode('ascii')
+
+
+def cursor_value(column, value):
+    """Значение ключа из курсора с типом колонки; TypeError, если тип не тот"""
+    if value is None:
+        return None
+    python_type = column.type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    # JSON не различает 1 и 1.0, но True - не число
+    if python_type is float and type(value) is int:
+        return float(value)
+    if type(value) is not python_type:
+        raise TypeError(f'{column.key}: ожидался {python_type.__name__}')
+    return value
+
+
+def decode_cursor(cursor, columns):
+    """Разбор курсора; для поврежденного или чужого курсора возвращает None"""
+    if not cursor:
+        return None
+    
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if not isinstance(payload, list) or len(payload) != len(columns):
+            return None
+        return [cursor_value(column, value) for column, value in zip(columns, payload)]
+    except (ValueError, TypeError, binascii.Error):
+        return None
+
+
+def keyset_condition(keys, values):
+    """Условие "строго после курсора" для составного ключа сортировки"""
+    # Значения передаем параметрами с типом колонки (в т.ч. для булевых)
+    bound = [db.literal(value, type_=column.type) for (column, _), value in zip(keys, values)]
+    
+    clauses = []
+    for i, (column, descending) in enumerate(keys):
+        equal = [keys[j][0] == bound[j] for j in range(i)]
+        after = column < bound[i] if descending else column > bound[i]
+        clauses.append(db.and_(*equal, after))
+    return db.or_(*clauses)
+
+
+def keyset_page(query, keys, cursor, page_size):
+    """Страница результатов после курсора и курсор следующей страницы"""
+    columns = [column for column, _ in keys]
+    
+    values = decode_cursor(cursor, columns)
+    if values is not None:
+        query = query.filter(keyset_condition(keys, values))
+    
+    query = query.order_by(*[
+        column.desc() if descending else column.asc()
+        for column, descending in keys
+    ])
+    
+    # Лишняя строка показывает, есть ли следующая страница
+    rows = query.add_columns(*columns).limit(page_size + 1).all()
+    items = [row[0] for row in rows[:page_size]]
+    
+    next_cursor = None
+    if len(rows) > page_size:
+        next_cursor = encode_cursor(rows[page_size - 1][1:])
+    
+    return items, next_cursor
+
+# --- ФИЛЬТРЫ И МАССОВЫЕ ОПЕРАЦИИ ---
+
+def filter_notes(query, user_id, args, categories):
+    """Фильтры списка заметок из параметров запроса (архив, поиск, тег, категория).
+    
+    Возвращает запрос, подзапрос поиска (для сортировки по релевантности)
+    и разобранные значения фильтров.
+    """
+    filters = {
+        'search_query': args.get('search', '').strip(),
+        'category_filter': args.get('category', 'all'),
+        'tag_filter': args.get('tag', '').strip().lower(),
+        'show_archived': args.get('archived', 'false') == 'true',
+    }
+    
+    # Фильтрация по архивированным
+    if not filters['show_archived']:
+        query = query.filter(Note.is_archived.is_(False))
+    
+    # Поиск по тексту через полнотекстовый индекс
+    search = None
+    if filters['search_query']:
+        search = search_subquery(filters['search_query'])
+        if search is None:
+            query = query.filter(db.false())
+        else:
+            query = query.join(search, search.c.note_id == Note.id)
+    
+    # Точная фильтрация по тегу
+    if filters['tag_filter']:
+        tag = Tag.query.filter_by(user_id=user_id, name=filters['tag_filter']).first()
+        query = query.filter(Note.id.in_(
+            db.select(note_tags.c.note_id).where(note_tags.c.tag_id == tag.id)
+        ) if tag else db.false())
+    
+    # Фильтрация по категории (только своей)
+    category_filter = filters['category_filter']
+    categories_by_id = {str(category.id): category for category in categories}
+    if category_filter == 'uncategorized':
+        query = query.filter(Note.category_id.is_(None))
+    elif category_filter in categories_by_id:
+        query = query.filter(Note.category_id == categories_by_id[category_filter].id)
+    
+    return query, search, filters
+
+
+def tag_list_expression():
+    """Строка тегов заметки, собранная из таблицы связей"""
+    if db.engine.dialect.name == 'postgresql':
+        names = db.func.string_agg(Tag.name, ', ')
+    else:
+        names = db.func.group_concat(Tag.name, ', ')
+    
+    return db.func.coalesce(
+        db.select(names).select_from(note_tags).join(
+            Tag, Tag.id == note_tags.c.tag_id
+        ).where(note_tags.c.note_id == Note.id).scalar_subquery(),
+        ''
+    )
+
+
+# id заметок в одном IN массового действия (лимит параметров SQLite - 32766)
+BATCH_ID_CHUNK = 10000
+
+
+def apply_batch_action(user_id, action, note_ids, params):
+    """Массовое действие UPDATE/DELETE-запросами на набор заметок.
+    
+    note_ids - подзапрос или список id. Подзапрос раскрывается в список один раз
+    до первого запроса: фильтр дашборда (например, по тегу) перестает совпадать,
+    как только действие меняет связи с тегами или удаляет заметки.
+    Возвращает число затронутых заметок.
+    """
+    ids = db.session.scalars(
+        db.select(Note.id).where(Note.user_id == user_id, Note.id.in_(note_ids)).order_by(Note.id)
+    ).all()
+    if not ids:
+        return 0
+    
+    seq = bump_user_version(user_id)
+    return sum(
+        apply_batch_chunk(user_id, action, ids[start:start + BATCH_ID_CHUNK], params, seq)
+        for start in range(0, len(ids), BATCH_ID_CHUNK)
+    )
+
+
+def apply_batch_chunk(user_id, action, ids, params, seq):
+    """Действие над частью заметок: все запросы идут по одному и тому же списку id"""
+    target = db.and_(Note.user_id == user_id, Note.id.in_(ids))
+    
+    if action in BATCH_UPDATES:
+        count_note_changes(target, BATCH_UPDATES[action])
+        result = db.session.execute(
+            db.update(Note).where(target).values(**BATCH_UPDATES[action], change_seq=seq),
+            execution_options={'synchronize_session': False}
+        )
+        return result.rowcount
+    
+    if action == 'move':
+        count_note_changes(target, {'category_id': params.get('category_id')})
+        result = db.session.execute(
+            db.update(Note).where(target).values(category_id=params.get('category_id'), change_seq=seq),
+            execution_options={'synchronize_session': False}
+        )
+        return result.rowcount
+    
+    if action == 'add_tag':
+        name = params['tag']
+        tag_id = ensure_tag_ids(user_id, [name])[name]
+        already_tagged = db.select(note_tags.c.note_id).where(note_tags.c.tag_id == tag_id)
+        # Строка тегов должна поместиться в колонку Note.tags
+        fits = db.func.length(db.func.coalesce(Note.tags, '')) + len(name) + 2 <= 200
+        
+        result = db.session.execute(note_tags.insert().from_select(
+            ['note_id', 'tag_id'],
+            db.select(Note.id, db.literal(tag_id)).where(
+                target, fits, Note.id.not_in(already_tagged)
+            )
+        ))
+        count = result.rowcount
+    
+    elif action == 'remove_tag':
+        tag = Tag.query.filter_by(user_id=user_id, name=params['tag']).first()
+        if tag is None:
+            return 0
+        
+        result = db.session.execute(note_tags.delete().where(
+            note_tags.c.tag_id == tag.id,
+            note_tags.c.note_id.in_(ids)
+        ))
+        count = result.rowcount
+    
+    elif action == 'delete':
+        # Надгробия для синхронизации, связи с тегами, затем сами заметки
+        record_deletion(user_id, Note, target, seq)
+        db.session.execute(note_tags.delete().where(note_tags.c.note_id.in_(ids)))
+        db.session.execute(db.delete(NoteRevision).where(NoteRevision.note_id.in_(ids)))
+        count_note_changes(target, None)
+        result = db.session.execute(
+            db.delete(Note).where(target),
+            execution_options={'synchronize_session': False}
+        )
+        return result.rowcount
+    
+    else:
+        raise ValueError(f'Неизвестное действие: {action}')
+    
+    # Пересобираем строку тегов у затронутых заметок
+    if count:
+        db.session.execute(
+            db.update(Note).where(target).values(tags=tag_list_expression(), change_seq=seq),
+            execution_options={'synchronize_session': False}
+        )
+    return count
+
+
+# Действия, которые сводятся к установке значений колонок
+BATCH_UPDATES = {
+    'archive': {'is_archived': True, 'is_pinned': False},
+    'unarchive': {'is_archived': False},
+    'pin': {'is_pinned': True},
+    'unpin': {'is_pinned': False},
+}
+
+# --- ИСТОРИЯ ВЕРСИЙ ЗАМЕТОК ---
+# Версия - состояние заметки после сохранения. Содержание хранится сжатым снимком
+# или разницей с последним снимком (не с предыдущей версией), поэтому любая версия
+# собирается из двух строк: снимок + одна разница, без проигрывания цепочки правок.
+# Новый снимок - каждые NOTE_REVISION_SNAPSHOT_EVERY версий или когда разница
+# перестает быть заметно меньше полного текста
+
+REVISION_COMPRESS_LEVEL = 6
+# Версий в списке на странице заметки
+REVISION_LIST_LIMIT = 20
+
+
+def encode_revision_delta(base, content):
+    """Сжатая разница content со снимком base: JSON-список операций по строкам.
+    
+    [i, j] - взять строки снимка с i по j, строка - вставить текст.
+    """
+    base_lines = base.splitlines(keepends=True)
+    lines = content.splitlines(keepends=True)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, base_lines, lines).get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(lines[j1:j2]))
+    return zlib.compress(json.dumps(ops, ensure_ascii=False).encode(), REVISION_COMPRESS_LEVEL)
+
+
+def apply_revision_delta(base, data):
+    """Текст версии по снимку base и сжатой разнице"""
+    base_lines = base.splitlines(keepends=True)
+    return ''.join(
+        ''.join(base_lines[op[0]:op[1]]) if isinstance(op, list) else op
+        for op in json.loads(zlib.decompress(data))
+    )
+
+
+def encode_revision(revision, content, base=None, base_content=None):
+    """Заполняет data версии: разница со снимком base, если она вдвое меньше снимка, иначе снимок"""
+    full = zlib.compress(content.encode(), REVISION_COMPRESS_LEVEL)
+    revision.base_number, revision.data, revision.size = None, full, len(content)
+    
+    if base is not None and revision.number - base.number < app.config['NOTE_REVISION_SNAPSHOT_EVERY']:
+        delta = encode_revision_delta(base_content, content)
+        if len(delta) * 2 < len(full):
+            revision.base_number, revision.data = base.number, delta
+    return revision
+
+
+def revision_content(revision, base=None):
+    """Содержание версии; base - ее снимок, если уже загружен"""
+    if revision.base_number is None:
+        return zlib.decompress(revision.data).decode()
+    if base is None:
+        base = NoteRevision.query.filter_by(note_id=revision.note_id, number=revision.base_number).one()
+    return apply_revision_delta(revision_content(base), revision.data)
+
+
+def load_revisions(note_id, numbers):
+    """{номер: (версия, содержание)} одним запросом на версии и одним на их снимки"""
+    revisions = NoteRevision.query.filter(
+        NoteRevision.note_id == note_id,
+        NoteRevision.number.in_(numbers)
+    ).all()
+    missing = {revision.base_number for revision in revisions} - {None} - set(numbers)
+    bases = {revision.number: revision for revision in revisions}
+    if missing:
+        bases.update((revision.number, revision) for revision in NoteRevision.query.filter(
+            NoteRevision.note_id == note_id,
+            NoteRevision.number.in_(missing)
+        ))
+    return {
+        revision.number: (revision, revision_content(revision, bases.get(revision.base_number)))
+        for revision in revisions
+    }
+
+
+def latest_revision(note_id):
+    return NoteRevision.query.filter_by(note_id=note_id).order_by(NoteRevision.number.desc()).first()
+
+
+def record_revision(note, title, content):
+    """Новая версия заметки, если меняются заголовок или содержание.
+    
+    Вызывать до присваивания новых значений: у заметки без истории сначала
+    сохраняется ее текущее состояние - с него история и начинается.
+    """
+    if title == note.title and content == note.content:
+        return None
+    
+    latest = latest_revision(note.id)
+    if latest is None:
+        latest = encode_revision(
+            NoteRevision(note_id=note.id, number=1, title=note.title, created_at=note.updated_at),
+            note.content or ''
+        )
+        db.session.add(latest)
+        base, base_content = latest, note.content or ''
+    elif latest.base_number is None:
+        base = latest
+        base_content = revision_content(base)
+    else:
+        base = NoteRevision.query.filter_by(note_id=note.id, number=latest.base_number).one()
+        base_content = revision_content(base)
+    
+    revision = encode_revision(
+        NoteRevision(note_id=note.id, number=latest.number + 1, title=title, created_at=datetime.utcnow()),
+        content, base, base_content
+    )
+    db.session.add(revision)
+    prune_revisions(note.id, revision.number)
+    return revision
+
+
+def prune_revisions(note_id, latest_number):
+    """Удаление версий сверх NOTE_REVISIONS_KEEP.
+    
+    Оставшиеся разницы с удаляемым снимком перекодируются: первая из них
+    становится снимком, остальные - разницами с ним.
+    """
+    keep = app.config['NOTE_REVISIONS_KEEP']
+    first_kept = latest_number - keep + 1
+    if keep <= 0 or first_kept <= 1:
+        return
+    
+    orphans = NoteRevision.query.filter(
+        NoteRevision.note_id == note_id,
+        NoteRevision.number >= first_kept,
+        NoteRevision.base_number < first_kept
+    ).order_by(NoteRevision.number).all()
+    if orphans:
+        contents = load_revisions(note_id, [revision.number for revision in orphans])
+        base, base_content = None, None
+        for revision in orphans:
+            content = contents[revision.number][1]
+            encode_revision(revision, content, base, base_content)
+            if revision.base_number is None:
+                base, base_content = revision, content
+    
+    db.session.execute(db.delete(NoteRevision).where(
+        NoteRevision.note_id == note_id,
+        NoteRevision.number < first_kept
+    ))
+
+
+def revision_list(note_id, limit=REVISION_LIST_LIMIT):
+    """Последние версии заметки без содержимого - для списка на странице заметки"""
+    return db.session.execute(
+        db.select(NoteRevision.number, NoteRevision.title, NoteRevision.size, NoteRevision.created_at)
+        .where(NoteRevision.note_id == note_id)
+        .order_by(NoteRevision.number.desc())
+        .limit(limit)
+    ).all()
+
+
+def revision_diff(note_id, number):
+    """Изменения версии относительно предыдущей.
+    
+    Возвращает (версия, прежний заголовок, строки [(вид, текст)]) или None,
+    вид - hunk, add, del или context. Для самой старой из хранимых версий
+    сравнение идет с пустой заметкой.
+    """
+    loaded = load_revisions(note_id, [number - 1, number])
+    if number not in loaded:
+        return None
+    revision, content = loaded[number]
+    previous, previous_content = loaded.get(number - 1, (None, ''))
+    
+    kinds = {'@': 'hunk', '+': 'add', '-': 'del', ' ': 'context'}
+    # Первые две строки - заголовки файлов "---" и "+++"
+    lines = list(difflib.unified_diff(previous_content.splitlines(), content.splitlines(), lineterm='', n=3))[2:]
+    return revision, previous.title if previous else None, [
+        (kinds[line[0]], line if line[0] == '@' else line[1:])
+        for line in lines
+    ]
+
+# --- СЧЕТЧИКИ ЗАМЕТОК ---
+# note_counter меняется в той же транзакции, что и заметки: ORM-изменения учитывает
+# слушатель after_flush, массовые UPDATE/DELETE - count_note_changes() перед запросом,
+# импорт - add_counter_deltas(). Запись в обход этих путей (ручная правка базы, seed)
+# исправляет reconcile_note_counters() / flask reconcile-counters
+
+COUNTER_FIELDS = ('total', 'pinned', 'archived', 'active')
+# Колонки заметки, от которых зависят счетчики
+COUNTED_NOTE_FIELDS = ('category_id', 'is_pinned', 'is_archived')
+
+
+def counter_delta(deltas, user_id, category_id, is_pinned, is_archived, count):
+    """Прибавляет к deltas вклад count заметок (отрицательный count - вычитает).
+    
+    deltas: {(user_id, категория): [всего, закреплено, в архиве, активных]}
+    """
+    values = deltas.setdefault((user_id, int(category_id) if category_id else 0), [0, 0, 0, 0])
+    values[0] += count
+    if is_archived:
+        values[2] += count
+    else:
+        values[3] += count
+        if is_pinned:
+            values[1] += count
+
+
+def add_counter_deltas(deltas, connection=None):
+    """Применение разниц к note_counter одним upsert-запросом"""
+    rows = [
+        {'user_id': user_id, 'category_id': category_id, **dict(zip(COUNTER_FIELDS, values))}
+        for (user_id, category_id), values in deltas.items()
+        if any(values)
+    ]
+    if not rows:
+        return
+    
+    insert = pg_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+    statement = insert(NoteCounter.__table__)
+    statement = statement.on_conflict_do_update(
+        index_elements=[NoteCounter.user_id, NoteCounter.category_id],
+        set_={field: getattr(NoteCounter, field) + statement.excluded[field] for field in COUNTER_FIELDS}
+    )
+    (connection or db.session.connection()).execute(statement, rows)
+
+
+def note_counter_groups(condition):
+    """(user_id, category_id, is_pinned, is_archived, число заметок) по условию"""
+    columns = (Note.user_id, Note.category_id, Note.is_pinned, Note.is_archived)
+    return db.session.execute(
+        db.select(*columns, db.func.count()).where(condition).group_by(*columns)
+    ).all()
+
+
+def count_note_changes(condition, values):
+    """Учет в счетчиках массового изменения заметок по condition.
+    
+    values - новые значения колонок (category_id, is_pinned, is_archived),
+    None - удаление. Вызывать до UPDATE/DELETE: группы считаются по старым значениям.
+    """
+    deltas = {}
+    for user_id, category_id, is_pinned, is_archived, count in note_counter_groups(condition):
+        counter_delta(deltas, user_id, category_id, is_pinned, is_archived, -count)
+        if values is not None:
+            counter_delta(deltas, user_id,
+                          values.get('category_id', category_id),
+                          values.get('is_pinned', is_pinned),
+                          values.get('is_archived', is_archived),
+                          count)
+    add_counter_deltas(deltas)
+
+
+def previous_value(note, field):
+    """Значение колонки заметки до изменений, которые сейчас записываются"""
+    history = db.inspect(note).attrs[field].history
+    if history.deleted:
+        return history.deleted[0]
+    return history.unchanged[0] if history.unchanged else None
+
+
+@event.listens_for(db.session, 'after_flush')
+def count_flushed_notes(session, flush_context):
+    """Счетчики по заметкам, добавленным, измененным и удаленным через ORM.
+    
+    В after_flush списки new/dirty/deleted и история атрибутов еще прежние.
+    """
+    deltas = {}
+    for note in session.new:
+        if isinstance(note, Note):
+            counter_delta(deltas, note.user_id, note.category_id, note.is_pinned, note.is_archived, 1)
+    
+    for note in session.deleted:
+        if isinstance(note, Note):
+            previous = [previous_value(note, field) for field in COUNTED_NOTE_FIELDS]
+            counter_delta(deltas, note.user_id, *previous, -1)
+    
+    for note in session.dirty:
+        state = db.inspect(note)
+        if not isinstance(note, Note) or state.deleted or state.was_deleted:
+            continue
+        if not any(state.attrs[field].history.has_changes() for field in COUNTED_NOTE_FIELDS):
+            continue
+        previous = [previous_value(note, field) for field in COUNTED_NOTE_FIELDS]
+        counter_delta(deltas, note.user_id, *previous, -1)
+        counter_delta(deltas, note.user_id, note.category_id, note.is_pinned, note.is_archived, 1)
+    
+    add_counter_deltas(deltas, session.connection())
+
+
+def reconcile_note_counters(user_id=None):
+    """Пересчет note_counter по заметкам с исправлением расхождений.
+    
+    Каждый пользователь - отдельная транзакция под блокировкой его строки
+    user_state, через которую проходят все записи заметок.
+    Возвращает {user_id: число исправленных строк} для пользователей с расхождениями.
+    """
+    user_ids = [user_id] if user_id is not None else db.session.scalars(
+        db.select(User.id).order_by(User.id)
+    ).all()
+    repaired = {}
+    
+    for uid in user_ids:
+        db.session.execute(db.select(UserState.user_id).where(UserState.user_id == uid).with_for_update())
+        
+        actual = {}
+        for _, category_id, is_pinned, is_archived, count in note_counter_groups(Note.user_id == uid):
+            counter_delta(actual, uid, category_id, is_pinned, is_archived, count)
+        stored = {
+            (uid, counter.category_id): [getattr(counter, field) for field in COUNTER_FIELDS]
+            for counter in db.session.scalars(db.select(NoteCounter).where(NoteCounter.user_id == uid))
+        }
+        
+        deltas = {}
+        for key in actual.keys() | stored.keys():
+            want = actual.get(key, [0, 0, 0, 0])
+            have = stored.get(key, [0, 0, 0, 0])
+            if want != have:
+                deltas[key] = [a - b for a, b in zip(want, have)]
+        
+        add_counter_deltas(deltas)
+        # Строки удаленных категорий больше не нужны
+        db.session.execute(db.delete(NoteCounter).where(NoteCounter.user_id == uid, NoteCounter.total == 0))
+        db.session.commit()
+        if deltas:
+            repaired[uid] = len(deltas)
+    
+    return repaired
+
+# --- СТАТИСТИКА ---
+
+def note_stats_statement(user_id):
+    """Счетчики заметок пользователя по категориям: чтение строк note_counter по первичному ключу"""
+    return db.select(
+        db.func.nullif(NoteCounter.category_id, 0),
+        NoteCounter.total,
+        NoteCounter.pinned,
+        NoteCounter.archived,
+        NoteCounter.active
+    ).where(NoteCounter.user_id == user_id)
+
+
+def user_note_stats(user_id):
+    """Счетчики заметок пользователя: всего, закрепленные, в архиве, по категориям"""
+    return summarize_note_stats(db.session.execute(note_stats_statement(user_id)).all())
+
+
+def summarize_note_stats(rows):
+    """Итоги по строкам note_stats_statement()"""
+    stats = {
+        'total_notes': 0,
+        'pinned_notes': 0,
+        'archived_notes': 0,
+        'by_category': {}  # {category_id: число неархивных заметок}
+    }
+    
+    for category_id, total, pinned, archived, active_count in rows:
+        stats['total_notes'] += total
+        stats['pinned_notes'] += pinned or 0
+        stats['archived_notes'] += archived or 0
+        if category_id is not None:
+            stats['by_category'][category_id] = active_count or 0
+    
+    return stats
+
+
+def api_stats_statements(user_id):
+    """Запросы для /api/stats; выполняются и синхронно, и через async-движок (asgi.py)"""
+    return {
+        'stats': note_stats_statement(user_id),
+        'categories': db.select(Category.id, Category.name, Category.color).where(
+            Category.user_id == user_id
+        ).order_by(Category.id),
+        'recent': db.select(*NOTE_SUMMARY_COLUMNS).where(
+            Note.user_id == user_id,
+            Note.is_archived.is_(False)
+        ).order_by(Note.updated_at.desc()).limit(5),
+    }
+
+
+def api_stats_payload(rows):
+    """Ответ /api/stats из результатов api_stats_statements()"""
+    stats = summarize_note_stats(rows['stats'])
+    return {
+        'success': True,
+        'data': {
+            'total_notes': stats['total_notes'],
+            'pinned_notes': stats['pinned_notes'],
+            'archived_notes': stats['archived_notes'],
+            'category_stats': [{
+                'name': category.name,
+                'color': category.color,
+                'count': stats['by_category'].get(category.id, 0)
+            } for category in rows['categories']],
+            'recent_notes': [{
+                'id': note.id,
+                'title': note.title,
+                'updated_at': note.updated_at.strftime('%d.%m.%Y %H:%M')
+            } for note in rows['recent']]
+        }
+    }
+
+
+def month_starts(months, now=None):
+    """Начала последних календарных месяцев, от старого к новому"""
+    now = now or datetime.utcnow()
+    year, month = now.year, now.month
+    
+    starts = []
+    for _ in range(months):
+        starts.append(datetime(year, month, 1))
+        year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+    
+    return starts[::-1]
+
+
+@functools.lru_cache(maxsize=1)
+def timezone_names():
+    """Имена часовых поясов IANA, известных zoneinfo"""
+    return frozenset(available_timezones())
+
+
+def user_timezone(user):
+    """ZoneInfo часового пояса пользователя; неизвестный пояс - UTC"""
+    if user.timezone in timezone_names():
+        return ZoneInfo(user.timezone)
+    return timezone.utc
+
+
+def activity_hour_key(column):
+    """Час UTC как строка 'YYYY-MM-DD HH' - ключ группировки"""
+    if db.engine.dialect.name == 'postgresql':
+        return db.func.to_char(column, 'YYYY-MM-DD HH24')
+    return db.func.strftime('%Y-%m-%d %H', column)
+
+
+def edited_after_creation():
+    """Заметка изменялась позже чем через минуту после создания"""
+    if db.engine.dialect.name == 'postgresql':
+        return Note.updated_at - Note.created_at > timedelta(minutes=1)
+    return (db.func.julianday(Note.updated_at) - db.func.julianday(Note.created_at)) * 1440 > 1
+
+
+def activity_statement(user_id, since):
+    """Созданные и измененные после since заметки по часам UTC одним запросом.
+    
+    Каждая ветка UNION ALL читает диапазон индекса (user_id, created_at) или
+    (user_id, updated_at), поэтому стоимость зависит от окна, а не от всей истории.
+    """
+    created = db.select(
+        activity_hour_key(Note.created_at).label('hour'),
+        db.literal(1).label('created'),
+        db.literal(0).label('edited')
+    ).where(Note.user_id == user_id, Note.created_at >= since)
+    edited = db.select(
+        activity_hour_key(Note.updated_at).label('hour'),
+        db.literal(0).label('created'),
+        db.literal(1).label('edited')
+    ).where(Note.user_id == user_id, Note.updated_at >= since, edited_after_creation())
+    events = db.union_all(created, edited).subquery()
+    
+    return db.select(
+        events.c.hour,
+        db.func.sum(events.c.created),
+        db.func.sum(events.c.edited)
+    ).group_by(events.c.hour)
+
+
+def activity_histograms(user_id, tz, months=6, now=None):
+    """Созданные заметки по календарным месяцам, активность (создание и правка)
+    по часам суток и дням недели - все в часовом поясе tz.
+    
+    В SQL группируем по часам UTC, а в местное время переводим в Python:
+    так учитываются переходы на летнее время. Для поясов со смещением
+    не на целый час заметка попадает в час, в котором начался час UTC.
+    """
+    now = (now or datetime.utcnow()).replace(tzinfo=timezone.utc).astimezone(tz)
+    starts = month_starts(months, now)
+    since = starts[0].replace(tzinfo=tz).astimezone(timezone.utc).replace(tzinfo=None)
+    
+    by_month = {}
+    hours = [0] * 24
+    weekdays = [0] * 7  # с понедельника
+    for hour_key, created, edited in db.session.execute(activity_statement(user_id, since)):
+        local = datetime.strptime(hour_key, '%Y-%m-%d %H').replace(tzinfo=timezone.utc).astimezone(tz)
+        month = (local.year, local.month)
+        by_month[month] = by_month.get(month, 0) + created
+        hours[local.hour] += created + edited
+        weekdays[local.weekday()] += created + edited
+    
+    return {
+        'months': [{
+            'month': calendar.month_name[start.month],
+            'count': by_month.get((start.year, start.month), 0)
+        } for start in starts],
+        'hours': hours,
+        'weekdays': weekdays,
+    }
+
+# --- УСЛОВНЫЕ ЗАПРОСЫ И КЕШ ФРАГМЕНТОВ ---
+
+def bump_user_version(user_id):
+    """Увеличивает версию данных пользователя в текущей транзакции"""
+    insert = pg_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+    now = datetime.utcnow()
+    statement = insert(UserState).values(user_id=user_id, version=1, updated_at=now)
+    statement = statement.on_conflict_do_update(
+        index_elements=[UserState.user_id],
+        set_={'version': UserState.version + 1, 'updated_at': now}
+    ).returning(UserState.version)
+    # Без autoflush: изменения объектов уйдут в базу уже с новой версией
+    with db.session.no_autoflush:
+        return db.session.execute(statement).scalar_one()
+
+
+def user_version(user_id):
+    """(версия, время последнего изменения) данных пользователя"""
+    state = db.session.get(UserState, user_id)
+    if state is None:
+        return 0, None
+    return state.version, state.updated_at
+
+
+def make_etag(*parts):
+    """Сильный ETag из частей, от которых зависит ответ"""
+    return hashlib.sha1(':'.join(map(str, parts)).encode()).hexdigest()
+
+
+def http_datetime(value):
+    """Наивное UTC-время из базы в виде, пригодном для HTTP-заголовков"""
+    return value.replace(tzinfo=timezone.utc, microsecond=0)
+
+
+def with_validators(response, etag, last_modified=None):
+    """Добавляет к ответу ETag, Last-Modified и требование перепроверки"""
+    response = app.make_response(response)
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = http_datetime(last_modified)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+
+def not_modified(etag, last_modified=None):
+    """Ответ 304, если у клиента актуальная версия, иначе None"""
+    # Страница с flash-сообщениями должна отрисоваться, иначе они потеряются
+    if session.get('_flashes'):
+        return None
+    
+    if request.if_none_match:
+        # Клиент мог получить сжатое представление с ETag вида "<etag>-gzip"
+        matched = [tag for tag in (etag, f'{etag}-gzip', f'{etag}-br') if request.if_none_match.contains(tag)]
+        fresh = bool(matched)
+        if matched:
+            etag = matched[0]
+    elif request.if_modified_since and last_modified:
+        fresh = http_datetime(last_modified) <= request.if_modified_since
+    else:
+        fresh = False
+    
+    if not fresh:
+        return None
+    return with_validators(Response(status=304), etag, last_modified)
+
+
+# Карточки заметок по версии заметки: id, время изменения и категория
+fragment_cache = MemoryCacheBackend(maxsize=app.config['FRAGMENT_CACHE_SIZE'], ttl=24 * 3600)
+
+
+@app.template_global()
+def note_card(note):
+    """Отрисованная карточка _note_card.html из кеша фрагментов"""
+    category = note.category_ref
+    # Бейдж категории зависит от ее имени и цвета: переименование меняет ключ
+    key = (note.id, note.updated_at, category and (category.id, category.name, category.color))
+    html = fragment_cache.get(key)
+    if html is None:
+        html = render_template('_note_card.html', note=note)
+        fragment_cache.set(key, html)
+    return Markup(html)
+
+# --- ЖУРНАЛ ИЗМЕНЕНИЙ ДЛЯ СИНХРОНИЗАЦИИ ---
+# Версия данных пользователя (UserState.version) служит монотонной
+# последовательностью изменений: каждая запись получает новую версию,
+# а измененные строки и надгробия удаленных помечаются ею в change_seq
+
+SYNC_MAX_CHANGES = 500
+
+
+def record_change(user_id, *objects):
+    """Новая версия данных пользователя; переданные объекты помечаются ею"""
+    seq = bump_user_version(user_id)
+    for obj in objects:
+        obj.change_seq = seq
+    return seq
+
+
+def record_deletion(user_id, model, condition, seq):
+    """Надгробия для строк model, подходящих под condition; вызывать до удаления"""
+    db.session.execute(db.insert(Tombstone).from_select(
+        ['user_id', 'entity', 'entity_id', 'change_seq', 'deleted_at'],
+        db.select(
+            db.literal(user_id),
+            db.literal(model.__tablename__),
+            model.id,
+            db.literal(seq),
+            db.literal(datetime.utcnow(), type_=db.DateTime)
+        ).where(model.user_id == user_id, condition)
+    ))
+
+
+def remove_note(note):
+    """Удаление заметки с надгробием для синхронизации"""
+    seq = bump_user_version(note.user_id)
+    record_deletion(note.user_id, Note, Note.id == note.id, seq)
+    db.session.execute(db.delete(NoteRevision).where(NoteRevision.note_id == note.id))
+    db.session.delete(note)
+
+
+def remove_category(category):
+    """Удаление категории: ее заметки переносятся в "без категории" одним запросом"""
+    seq = bump_user_version(category.user_id)
+    in_category = db.and_(Note.category_id == category.id, Note.user_id == category.user_id)
+    count_note_changes(in_category, {'category_id': None})
+    db.session.execute(
+        db.update(Note).where(in_category).values(category_id=None, change_seq=seq),
+        execution_options={'synchronize_session': False}
+    )
+    record_deletion(category.user_id, Category, Category.id == category.id, seq)
+    db.session.execute(db.delete(Category).where(Category.id == category.id))
+
+
+def sync_upper_bound(user_id, since, limit):
+    """Версия, до которой включительно отдаются изменения, и есть ли изменения после нее.
+    
+    Граница проходит между версиями: строки одной версии (массовое действие)
+    всегда попадают в один ответ, даже если их больше limit.
+    """
+    changes = db.union_all(*[
+        db.select(model.change_seq).where(model.user_id == user_id, model.change_seq > since)
+        for model in (Note, Category, Tombstone)
+    ]).subquery()
+    seq = changes.c.change_seq
+    
+    # Версия первого изменения, не поместившегося в limit
+    cut = db.session.scalar(db.select(seq).order_by(seq).offset(limit).limit(1))
+    if cut is None:
+        return db.session.scalar(db.select(db.func.max(seq))) or since, False
+    
+    upper = db.session.scalar(db.select(db.func.max(seq)).where(seq < cut))
+    if upper is None:
+        upper = cut
+    has_more = db.session.scalar(db.select(seq).where(seq > upper).limit(1)) is not None
+    return upper, has_more
+
+
+def sync_changes(user_id, since, limit=SYNC_MAX_CHANGES):
+    """Заметки, категории и надгробия с версией в (since, upper]; since=0 - все данные"""
+    upper, has_more = sync_upper_bound(user_id, since, limit)
+    
+    def window(model):
+        return db.and_(model.user_id == user_id, model.change_seq > since, model.change_seq <= upper)
+    
+    notes = Note.query.filter(window(Note)).order_by(Note.change_seq, Note.id).all()
+    categories = Category.query.filter(window(Category)).order_by(Category.change_seq, Category.id).all()
+    
+    # При первой синхронизации (since=0) удаленное клиенту не нужно
+    deleted = {'note': [], 'category': []}
+    if since:
+        for entity, entity_id in db.session.query(Tombstone.entity, Tombstone.entity_id).filter(
+            window(Tombstone)
+        ).order_by(Tombstone.change_seq):
+            deleted[entity].append(entity_id)
+    
+    return {
+        'notes': notes,
+        'categories': categories,
+        'deleted_notes': deleted['note'],
+        'deleted_categories': deleted['category'],
+        'cursor': upper,
+        'has_more': has_more,
+    }
+
+
+def backfill_change_seq():
+    """Нумерация существующих заметок и категорий версиями их пользователей"""
+    for user_id in db.session.scalars(db.select(User.id).order_by(User.id)).all():
+        for model in (Category, Note):
+            ids = db.session.scalars(
+                db.select(model.id).where(model.user_id == user_id, model.change_seq == 0).order_by(model.id)
+            ).all()
+            if not ids:
+                continue
+            # Одна новая версия на каждую строку: клиенты получат их постранично
+            version, _ = user_version(user_id)
+            table = model.__table__
+            values = {'change_seq': db.bindparam('seq')}
+            if 'updated_at' in table.c:
+                # Явное присваивание, чтобы не сработал onupdate
+                values['updated_at'] = table.c.updated_at
+            db.session.execute(table.update().where(
+                table.c.id == db.bindparam('object_id')
+            ).values(**values), [
+                {'object_id': object_id, 'seq': version + i + 1}
+                for i, object_id in enumerate(ids)
+            ])
+            state = db.session.get(UserState, user_id) or UserState(user_id=user_id)
+            state.version = version + len(ids)
+            state.updated_at = datetime.utcnow()
+            db.session.add(state)
+            db.session.commit()
+
+# --- УВЕДОМЛЕНИЯ ОБ ИЗМЕНЕНИЯХ (SSE) ---
+# Событие notes-changed говорит клиенту, что пора вызвать /api/sync?since=<id события>.
+# В asgi.py канал обслуживается корутинами; маршрут /api/events здесь - запасной
+# вариант для WSGI, где каждое открытое соединение занимает поток воркера
+
+# Сколько id заметок перечислять в одном событии
+SSE_MAX_IDS = 100
+
+
+def sse_message(data=None, event=None, event_id=None, retry=None, comment=None):
+    """Сообщение в формате text/event-stream"""
+    lines = []
+    if comment:
+        lines.append(f': {comment}')
+    if event:
+        lines.append(f'event: {event}')
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    if retry:
+        lines.append(f'retry: {int(retry * 1000)}')
+    if data is not None:
+        lines.append('data: ' + json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+    return '\n'.join(lines) + '\n\n'
+
+
+def user_versions_statement(user_ids):
+    return db.select(UserState.user_id, UserState.version).where(UserState.user_id.in_(user_ids))
+
+
+def change_notice_statements(user_id, since):
+    """Id заметок, измененных и удаленных после версии since"""
+    return (
+        db.select(Note.id).where(
+            Note.user_id == user_id,
+            Note.change_seq > since
+        ).order_by(Note.change_seq).limit(SSE_MAX_IDS + 1),
+        db.select(Tombstone.entity_id).where(
+            Tombstone.user_id == user_id,
+            Tombstone.entity == Note.__tablename__,
+            Tombstone.change_seq > since
+        ).order_by(Tombstone.change_seq).limit(SSE_MAX_IDS + 1),
+    )
+
+
+def change_notice(since, version, note_ids, deleted_ids):
+    """Событие notes-changed; при большом числе изменений - без списков id"""
+    truncated = len(note_ids) > SSE_MAX_IDS or len(deleted_ids) > SSE_MAX_IDS
+    return sse_message({
+        'since': since,
+        'cursor': version,
+        'notes': [] if truncated else note_ids,
+        'deleted_notes': [] if truncated else deleted_ids,
+        'truncated': truncated,
+    }, event='notes-changed', event_id=version)
+
+
+def last_event_id(value):
+    """Версия из заголовка Last-Event-ID при переподключении клиента"""
+    try:
+        return max(int(value), 0) if value else None
+    except ValueError:
+        return None
+
+# --- ПРОЕКЦИИ СПИСКОВ ---
+
+# Колонки для коротких списков: заголовок и дата без содержания
+NOTE_SUMMARY_COLUMNS = (Note.id, Note.title, Note.updated_at)
+
+
+def note_list_options():
+    """Опции запроса карточек: без content, с категорией тем же запросом"""
+    # raiseload - обращение к content в списке станет ошибкой, а не запросом на каждую карточку
+    return (db.defer(Note.content, raiseload=True), db.joinedload(Note.category_ref))
+
+
+def compress_notes(batch_size=500):
+    """Приведение хранимого содержания заметок к текущим настройкам сжатия.
+    
+    Идет партиями по id; переписываются только строки, хранимое значение которых
+    отличается от нужного: длинные несжатые сжимаются, а после смены порога или
+    CONTENT_COMPRESSION=none - распаковываются. Возвращает отчет с байтами и CPU.
+    """
+    report = {'notes': 0, 'changed': 0, 'bytes_before': 0, 'bytes_after': 0, 'cpu_seconds': 0.0}
+    if db.engine.dialect.name != 'sqlite':
+        return report
+    
+    table = Note.__table__
+    # Хранимое значение без распаковки и запись готового значения без повторного сжатия
+    stored = db.type_coerce(table.c.content, db.Text)
+    update = db.update(table).where(table.c.id == db.bindparam('note_id')).values(
+        content=db.bindparam('stored', type_=db.Text),
+        updated_at=db.bindparam('updated')  # иначе сработает onupdate
+    )
+    last_id = 0
+    
+    while True:
+        rows = db.session.execute(
+            db.select(table.c.id, stored, table.c.updated_at)
+            .where(table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        
+        started = time.thread_time()
+        changes = []
+        for note_id, value, updated_at in rows:
+            value = value or ''
+            wanted = compress_content(decompress_content(value))
+            report['bytes_before'] += len(value.encode())
+            report['bytes_after'] += len(wanted.encode())
+            if wanted != value:
+                changes.append({'note_id': note_id, 'stored': wanted, 'updated': updated_at})
+        report['cpu_seconds'] += time.thread_time() - started
+        
+        if changes:
+            db.session.execute(update, changes)
+        db.session.commit()
+        report['notes'] += len(rows)
+        report['changed'] += len(changes)
+    
+    report['cpu_seconds'] = round(report['cpu_seconds'], 3)
+    return report
+
+
+def backfill_note_summaries(batch_size=200):
+    """Заполнение превью и счетчиков у заметок, созданных до их появления"""
+    processed = 0
+    last_id = 0
+    
+    while True:
+        rows = db.session.query(Note.id, Note.content, Note.updated_at).filter(
+            Note.id > last_id,
+            Note.char_count == 0,
+            Note.content != ''
+        ).order_by(Note.id).limit(batch_size).all()
+        
+        if not rows:
+            break
+        last_id = rows[-1].id
+        
+        # updated_at передаем явно, чтобы не сработал onupdate
+        db.session.execute(db.update(Note), [
+            {'id': row.id, 'updated_at': row.updated_at, **content_summary(row.content)}
+            for row in rows
+        ])
+        db.session.commit()
+        processed += len(rows)
+    
+    return processed
+
+# --- JSON API ---
+
+API_PREFIX = '/api/'
+# Максимум объектов в одном запросе массовой записи
+API_BULK_LIMIT = 500
+API_MAX_PAGE_SIZE = 100
+CATEGORY_COLORS = ('primary', 'secondary', 'success', 'danger', 'warning', 'info')
+
+# Поля для fields=: имя -> колонка; в списке заметок content по умолчанию не отдается
+NOTE_API_FIELDS = {
+    'id': Note.id,
+    'title': Note.title,
+    'content': Note.content,
+    'preview': Note.preview,
+    'word_count': Note.word_count,
+    'char_count': Note.char_count,
+    'category_id': Note.category_id,
+    'tags': Note.tags,
+    'is_pinned': Note.is_pinned,
+    'is_archived': Note.is_archived,
+    'created_at': Note.created_at,
+    'updated_at': Note.updated_at,
+    'change_seq': Note.change_seq,
+}
+NOTE_LIST_FIELDS = tuple(name for name in NOTE_API_FIELDS if name != 'content')
+CATEGORY_API_FIELDS = {
+    'id': Category.id,
+    'name': Category.name,
+    'color': Category.color,
+    'change_seq': Category.change_seq,
+}
+
+
+class ApiError(Exception):
+    """Ошибка запроса к JSON API с HTTP-статусом ответа"""
+    
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class AccessDenied(Exception):
+    """Объект принадлежит другому пользователю"""
+    
+    def __init__(self, model):
+        super().__init__(model.__name__)
+        self.model = model
+
+
+ACCESS_DENIED_MESSAGES = {
+    Note: 'У вас нет доступа к этой заметке',
+    Category: 'У вас нет доступа к этой категории',
+    Job: 'У вас нет доступа к этой задаче',
+}
+
+
+def is_api_request():
+    return request.path.startswith(API_PREFIX)
+
+
+def get_owned(model, object_id, *options):
+    """Объект текущего пользователя по id: 404 для несуществующего, AccessDenied для чужого"""
+    obj = db.session.get(model, object_id, options=options)
+    if obj is None:
+        abort(404)
+    if obj.user_id != current_user.id:
+        raise AccessDenied(model)
+    return obj
+
+
+@app.errorhandler(AccessDenied)
+def handle_access_denied(error):
+    # Через API чужой объект неотличим от несуществующего
+    if is_api_request():
+        return {'success': False, 'error': 'Не найдено'}, 404
+    flash(ACCESS_DENIED_MESSAGES[error.model], 'danger')
+    return redirect(url_for('dashboard'))
+
+
+@app.errorhandler(ApiError)
+def handle_api_error(error):
+    return {'success': False, 'error': str(error)}, error.status
+
+
+@app.errorhandler(HTTPException)
+def handle_http_error(error):
+    """Для /api/ ошибки HTTP отдаются в JSON, для страниц - как обычно"""
+    if is_api_request():
+        return {'success': False, 'error': error.description}, error.code
+    return error
+
+
+@login_manager.unauthorized_handler
+def unauthorized():
+    """JSON 401 для API вместо перенаправления на форму входа"""
+    if is_api_request():
+        return {'success': False, 'error': 'Требуется вход в систему'}, 401
+    flash(login_manager.login_message, login_manager.login_message_category)
+    return redirect(login_url(login_manager.login_view, request.url))
+
+
+def api_json_body():
+    """Тело запроса как JSON; некорректный JSON - ошибка 400"""
+    data = request.get_json(silent=True)
+    if data is None:
+        raise ApiError('Ожидается тело запроса в формате JSON')
+    return data
+
+
+def api_fields(allowed, default):
+    return parse_api_fields(request.args.get('fields', ''), allowed, default)
+
+
+def parse_api_fields(raw, allowed, default):
+    """Разбор fields= (разреженная выборка полей); id возвращается всегда"""
+    raw = raw.strip()
+    if not raw:
+        return list(default)
+    
+    fields = [name.strip() for name in raw.split(',') if name.strip()]
+    unknown = [name for name in fields if name not in allowed]
+    if unknown:
+        raise ApiError(f'Неизвестные поля: {", ".join(unknown)}')
+    return ['id'] + [name for name in fields if name != 'id']
+
+
+def api_page_size(default=None, maximum=API_MAX_PAGE_SIZE):
+    try:
+        page_size = int(request.args.get('limit', default or app.config['NOTES_PAGE_SIZE']))
+    except ValueError:
+        raise ApiError('limit должен быть числом')
+    return max(1, min(page_size, maximum))
+
+
+def api_cursor(keys):
+    """Курсор из запроса: поврежденный - ошибка 400, а не молча первая страница"""
+    cursor = request.args.get('cursor')
+    if cursor and decode_cursor(cursor, [column for column, _ in keys]) is None:
+        raise ApiError('Неверный курсор')
+    return cursor
+
+
+def api_value(field, value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if field == 'tags':
+        return parse_tags(value or '')
+    return value
+
+
+def api_object(obj, fields):
+    return {field: api_value(field, getattr(obj, field)) for field in fields}
+
+
+def api_row(row, fields):
+    """То же для строки Core-запроса с колонками fields"""
+    return {field: api_value(field, row._mapping[field]) for field in fields}
+
+
+def api_note_statement(user_id, note_id, fields):
+    """Заметка пользователя с колонками fields (для async-чтения в asgi.py)"""
+    return db.select(*[NOTE_API_FIELDS[field] for field in fields]).where(
+        Note.id == note_id,
+        Note.user_id == user_id
+    )
+
+
+def search_notes_statement(user_id, search_query, limit):
+    """Неархивные заметки пользователя по релевантности; None для пустого запроса"""
+    search = search_subquery(search_query)
+    if search is None:
+        return None
+    return db.select(*NOTE_SUMMARY_COLUMNS, Note.preview, search.c.rank).join(
+        search, search.c.note_id == Note.id
+    ).where(
+        Note.user_id == user_id,
+        Note.is_archived.is_(False)
+    ).order_by(search.c.rank, Note.id).limit(limit)
+
+
+def search_payload(rows):
+    return {'success': True, 'data': [{
+        'id': row.id,
+        'title': row.title,
+        'preview': row.preview,
+        'updated_at': row.updated_at.isoformat(),
+        'rank': round(row.rank, 4),
+    } for row in rows]}
+
+
+def api_flag(data, field):
+    value = data[field]
+    if not isinstance(value, bool):
+        raise ApiError(f'{field} должен быть true или false')
+    return value
+
+
+def note_changes(data, category_ids, partial=False):
+    """Проверенные изменения заметки из JSON; category_ids - id категорий пользователя"""
+    if not isinstance(data, dict):
+        raise ApiError('Ожидается JSON-объект')
+    unknown = set(data) - {'id', 'title', 'content', 'category_id', 'tags', 'is_pinned', 'is_archived'}
+    if unknown:
+        raise ApiError(f'Неизвестные поля: {", ".join(sorted(unknown))}')
+    
+    changes = {}
+    if 'title' in data or not partial:
+        title = data.get('title')
+        if not isinstance(title, str) or not title.strip():
+            raise ApiError('Заголовок обязателен')
+        if len(title.strip()) > 100:
+            raise ApiError('Заголовок длиннее 100 символов')
+        changes['title'] = title.strip()
+    
+    if 'content' in data or not partial:
+        content = data.get('content') or ''
+        if not isinstance(content, str):
+            raise ApiError('content должен быть строкой')
+        changes['content'] = content.strip()
+    
+    if 'category_id' in data:
+        category_id = data['category_id']
+        if category_id is not None and category_id not in category_ids:
+            raise ApiError('Категория не найдена')
+        changes['category_id'] = category_id
+    
+    if 'tags' in data:
+        tags = data['tags'] or ''
+        if isinstance(tags, list):
+            tags = ','.join(str(tag) for tag in tags)
+        if not isinstance(tags, str):
+            raise ApiError('tags должен быть строкой или списком')
+        changes['tags'] = tags
+    
+    for field in ('is_pinned', 'is_archived'):
+        if field in data:
+            changes[field] = api_flag(data, field)
+    
+    return changes
+
+
+def apply_note_changes(note, changes):
+    """Запись проверенных (note_changes) изменений; прежний текст сохраненной
+    заметки уходит в историю версий"""
+    if note.id is not None:
+        record_revision(note, changes.get('title', note.title), changes.get('content', note.content))
+    for field, value in changes.items():
+        if field == 'tags':
+            set_note_tags(note, value)
+        else:
+            setattr(note, field, value)
+    # Архивная заметка не бывает закрепленной - как в archive_note()
+    if note.is_archived:
+        note.is_pinned = False
+
 
-# Инициализация базы данных
-db = SQLAlchemy(app)
+def category_changes(data, partial=False):
+    """Проверенные изменения категории из JSON"""
+    if not isinstance(data, dict):
+        raise ApiError('Ожидается JSON-объект')
+    unknown = set(data) - {'id', 'name', 'color'}
+    if unknown:
+        raise ApiError(f'Неизвестные поля: {", ".join(sorted(unknown))}')
+    
+    changes = {}
+    if 'name' in data or not partial:
+        name = data.get('name')
+        if not isinstance(name, str) or not name.strip():
+            raise ApiError('Название категории обязательно')
+        if len(name.strip()) > 50:
+            raise ApiError('Название категории длиннее 50 символов')
+        changes['name'] = name.strip()
+    
+    if 'color' in data or not partial:
+        color = data.get('color', 'primary')
+        if color not in CATEGORY_COLORS:
+            raise ApiError(f'color должен быть одним из: {", ".join(CATEGORY_COLORS)}')
+        changes['color'] = color
+    
+    return changes
 
-# --- ИНИЦИАЛИЗАЦИЯ FLASK-LOGIN ---
-login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
-login_manager.login_message = 'Пожалуйста, войдите в систему'
-login_manager.login_message_category = 'warning'
 
-# --- ЗАГРУЗЧИК ПОЛЬЗОВАТЕЛЯ ---
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
+def check_category_names(user_id, names, exclude_ids=()):
+    """Названия категорий уникальны в пределах пользователя"""
+    if len(set(names)) != len(names):
+        raise ApiError('Повторяющиеся названия категорий')
+    taken = db.session.query(Category.name).filter(
+        Category.user_id == user_id,
+        Category.name.in_(names),
+        Category.id.notin_(exclude_ids)
+    ).first()
+    if taken:
+        raise ApiError(f'Категория «{taken.name}» уже существует', 409)
 
 
-# --- МОДЕЛИ БАЗЫ ДАННЫХ ---
+def bulk_items():
+    """Список объектов для массовой записи"""
+    items = api_json_body()
+    if isinstance(items, dict):
+        items = items.get('items')
+    if not isinstance(items, list) or not items:
+        raise ApiError('Ожидается непустой список объектов')
+    if len(items) > API_BULK_LIMIT:
+        raise ApiError(f'Не больше {API_BULK_LIMIT} объектов за запрос', 413)
+    return items
 
-class User(db.Model, UserMixin):
-    """Модель пользователя"""
-    id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(80), unique=True, nullable=False)
-    email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(200), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    notes = db.relationship('Note', backref='author', lazy=True)
+
+def validate_bulk(items, validate):
+    """Проверка всех объектов до записи; ошибки возвращаются с индексом объекта"""
+    changes, errors = [], []
+    for index, item in enumerate(items):
+        try:
+            item_id = item.get('id') if isinstance(item, dict) else None
+            if item_id is not None and not isinstance(item_id, int):
+                raise ApiError('id должен быть числом')
+            changes.append((item_id, validate(item, item_id is not None)))
+        except ApiError as error:
+            errors.append({'index': index, 'error': str(error)})
+    return changes, errors
+
+
+def compressible(response):
+    """Сжимаем только готовые текстовые ответы достаточного размера"""
+    return (
+        200 <= response.status_code < 300
+        and response.status_code != 204
+        and not response.direct_passthrough
+        and not response.is_streamed
+        and 'Content-Encoding' not in response.headers
+        and (response.mimetype.startswith('text/') or response.mimetype == 'application/json')
+        and response.content_length is not None
+        and response.content_length >= app.config['COMPRESS_MIN_SIZE']
+    )
+
+
+def preferred_encoding(accepted=None):
+    """Лучшее поддерживаемое клиентом сжатие: br, gzip или None"""
+    if accepted is None:
+        accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress_data(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=app.config['COMPRESS_LEVEL'])
+    return gzip.compress(data, compresslevel=app.config['COMPRESS_LEVEL'])
+
+
+@app.after_request
+def compress_response(response):
+    """gzip или brotli (если установлен модуль brotli) по Accept-Encoding"""
+    response.vary.add('Accept-Encoding')
+    if not compressible(response):
+        return response
     
-    def set_password(self, password):
-        """Хеширование пароля"""
-        self.password_hash = generate_password_hash(password)
+    encoding = preferred_encoding()
+    if encoding is None:
+        return response
     
-    def check_password(self, password):
-        """Проверка пароля"""
-        return check_password_hash(self.password_hash, password)
+    response.set_data(compress_data(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
     
-    def __repr__(self):
-        return f'<User {self.username}>'
+    # Сжатое представление - другие байты, значит и другой сильный ETag
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f'{etag}-{encoding}', weak=weak)
+    return response
 
+# --- ИНСТРУМЕНТИРОВАНИЕ ЗАПРОСОВ ---
+# Включается METRICS_ENABLED. Метрики копятся в памяти процесса: при
+# нескольких воркерах gunicorn у каждого свои (как и у кеша пользователей),
+# async-эндпоинты asgi.py мимо Flask не учитываются
 
-class Category(db.Model):
-    """Модель категории"""
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(50), nullable=False)
-    color = db.Column(db.String(20), default='primary')
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    notes = db.relationship('Note', backref='category_ref', lazy=True)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    """Гистограмма в формате Prometheus с метками"""
     
-    def __repr__(self):
-        return f'<Category {self.name}>'
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}  # метки -> [счетчики по корзинам, сумма, количество]
+        self.lock = threading.Lock()
+    
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{metric_labels(key, le=bound)} {bucket_count}')
+                lines.append(f'{self.name}_bucket{metric_labels(key, le="+Inf")} {count}')
+                lines.append(f'{self.name}_sum{metric_labels(key)} {total:.6f}')
+                lines.append(f'{self.name}_count{metric_labels(key)} {count}')
+        return lines
 
 
-class Note(db.Model):
-    """Модель заметки"""
-    id = db.Column(db.Integer, primary_key=True)
-    title = db.Column(db.String(100), nullable=False)
-    content = db.Column(db.Text, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
-    is_pinned = db.Column(db.Boolean, default=False)
-    tags = db.Column(db.String(200))
+class Counter:
+    """Счетчик в формате Prometheus с метками"""
     
-    def __repr__(self):
-        return f'<Note {self.title}>'
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.series = {}
+        self.lock = threading.Lock()
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for key, value in sorted(self.series.items()):
+                lines.append(f'{self.name}{metric_labels(key)} {value}')
+        return lines
 
-class PasswordResetToken(db.Model):
-    """Токен для сброса пароля"""
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    token = db.Column(db.String(100), unique=True, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    expires_at = db.Column(db.DateTime, nullable=False)
-    is_used = db.Column(db.Boolean, default=False)
+
+def metric_labels(key, **extra):
+    items = list(key) + list(extra.items())
+    if not items:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in items
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+request_latency = Histogram(
+    'noteflow_request_duration_seconds', 'Время обработки запроса', LATENCY_BUCKETS)
+request_queries = Histogram(
+    'noteflow_request_sql_queries', 'SQL-запросов на HTTP-запрос', QUERY_COUNT_BUCKETS)
+request_sql_time = Histogram(
+    'noteflow_request_sql_seconds', 'Суммарное время SQL за HTTP-запрос', LATENCY_BUCKETS)
+request_template_time = Histogram(
+    'noteflow_request_template_seconds', 'Время отрисовки шаблонов за HTTP-запрос', LATENCY_BUCKETS)
+slow_queries = Counter('noteflow_slow_queries_total', 'SQL-запросы дольше SLOW_QUERY_MS')
+n_plus_one = Counter('noteflow_n_plus_one_total', 'Запросы с повторяющимся SQL (подозрение на N+1)')
+# Сжатие идет и вне HTTP-запросов, поэтому считается независимо от METRICS_ENABLED
+content_bytes = Counter(
+    'noteflow_note_content_bytes_total', 'Байты сжатых заметок до (plain) и после (stored) сжатия')
+content_codec_seconds = Counter(
+    'noteflow_note_content_codec_seconds_total', 'Процессорное время сжатия и распаковки заметок')
+
+METRICS = (request_latency, request_queries, request_sql_time, request_template_time, slow_queries, n_plus_one,
+           content_bytes, content_codec_seconds)
+
+
+class RequestMetrics:
+    """Замеры одного HTTP-запроса (хранится в g)"""
     
-    user = db.relationship('User', backref='reset_tokens')
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.statements = {}  # текст SQL -> сколько раз выполнен
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.template_started = 0.0
+
+
+def current_request_metrics():
+    return g.get('request_metrics') if has_request_context() else None
+
+
+def metrics_endpoint():
+    return request.endpoint or 'unmatched'
+
+
+def on_before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def on_after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    metrics = current_request_metrics()
+    endpoint = metrics_endpoint() if metrics else 'background'
     
-    def is_valid(self):
-        """Проверка валидности токена"""
-        return (datetime.utcnow() < self.expires_at and 
-                not self.is_used)
+    if elapsed * 1000 >= app.config['SLOW_QUERY_MS']:
+        slow_queries.inc(endpoint=endpoint)
+        app.logger.warning('Медленный SQL (%.1f мс, %s): %s', elapsed * 1000, endpoint, statement[:500])
     
-    def __repr__(self):
-        return f'<PasswordResetToken {self.token[:10]}...>'
+    if metrics:
+        metrics.sql_count += 1
+        metrics.sql_time += elapsed
+        metrics.statements[statement] = metrics.statements.get(statement, 0) + 1
+
+
+def on_before_render_template(sender, template, context, **extra):
+    metrics = current_request_metrics()
+    if metrics:
+        # Вложенные отрисовки (карточки note_card) входят во внешнюю
+        if metrics.template_depth == 0:
+            metrics.template_started = time.perf_counter()
+        metrics.template_depth += 1
+
+
+def on_template_rendered(sender, template, context, **extra):
+    metrics = current_request_metrics()
+    if metrics:
+        metrics.template_depth -= 1
+        if metrics.template_depth == 0:
+            metrics.template_time += time.perf_counter() - metrics.template_started
+
+
+def start_request_metrics():
+    g.request_metrics = RequestMetrics()
+
+
+def finish_request_metrics(response):
+    """Запись гистограмм, поиск N+1 и заголовок Server-Timing"""
+    metrics = g.pop('request_metrics', None)
+    if metrics is None:
+        return response
+    
+    endpoint = metrics_endpoint()
+    elapsed = time.perf_counter() - metrics.started
+    request_latency.observe(elapsed, endpoint=endpoint, method=request.method, status=response.status_code)
+    request_queries.observe(metrics.sql_count, endpoint=endpoint)
+    request_sql_time.observe(metrics.sql_time, endpoint=endpoint)
+    request_template_time.observe(metrics.template_time, endpoint=endpoint)
+    
+    # Один и тот же SQL много раз за запрос - обычно ленивая загрузка в цикле
+    for statement, count in metrics.statements.items():
+        if count >= app.config['N_PLUS_ONE_THRESHOLD']:
+            n_plus_one.inc(endpoint=endpoint)
+            app.logger.warning('Возможный N+1 в %s: %d раз %s', endpoint, count, statement[:300])
+    
+    response.headers.add('Server-Timing', ', '.join((
+        f'app;dur={elapsed * 1000:.1f}',
+        f'db;dur={metrics.sql_time * 1000:.1f};desc="{metrics.sql_count} SQL"',
+        f'tpl;dur={metrics.template_time * 1000:.1f}',
+    )))
+    return response
+
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+if app.config['METRICS_ENABLED']:
+    event.listen(Engine, 'before_cursor_execute', on_before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', on_after_cursor_execute)
+    before_render_template.connect(on_before_render_template, app)
+    template_rendered.connect(on_template_rendered, app)
+    app.before_request(start_request_metrics)
+    app.after_request(finish_request_metrics)
+
+# --- ФОНОВЫЕ ЗАДАЧИ ---
+# Очередь - таблица job в той же базе, брокер не нужен. Задачи выполняет
+# JobRunner: в каждом веб-процессе (JOBS_ENABLED) и/или в отдельном процессе
+# flask jobs worker. Задачу забирает тот, чей UPDATE ... WHERE status = 'queued'
+# сработал первым, поэтому процессов может быть сколько угодно.
+
+JOB_API_FIELDS = (
+    'id', 'kind', 'status', 'attempts', 'max_attempts', 'error',
+    'created_at', 'started_at', 'finished_at',
+)
+JOB_LIST_LIMIT = 20
+# Как часто удалять задачи и файлы с истекшим сроком хранения (с)
+JOB_PURGE_INTERVAL = 600
+
+
+class JobKind:
+    """Тип фоновой задачи и его ограничения"""
+    
+    def __init__(self, name, func, concurrency, max_attempts, public):
+        self.name = name
+        self.func = func
+        self.concurrency = concurrency    # одновременно выполняемых задач во всех процессах
+        self.max_attempts = max_attempts  # попыток до статуса failed
+        self.public = public              # задачу может поставить пользователь через API
+
+
+# Тип задачи -> JobKind; заполняется декоратором job_handler
+JOB_KINDS = {}
+
+
+def job_handler(kind, concurrency=1, max_attempts=3, public=False):
+    """Регистрация обработчика задачи: func(job, params) -> словарь результата"""
+    def decorator(func):
+        JOB_KINDS[kind] = JobKind(kind, func, concurrency, max_attempts, public)
+        return func
+    return decorator
+
+
+def enqueue_job(kind, user_id=None, **params):
+    """Постановка задачи в очередь (с коммитом); ее сразу подхватит JobRunner процесса"""
+    job = Job(
+        kind=kind,
+        user_id=user_id,
+        params=json.dumps(params, ensure_ascii=False),
+        max_attempts=JOB_KINDS[kind].max_attempts
+    )
+    db.session.add(job)
+    db.session.commit()
+    job_runner.wake()
+    return job
+
+
+def claim_jobs(worker, limit):
+    """Захват до limit готовых задач с учетом лимита параллельности по типам"""
+    now = datetime.utcnow()
+    candidates = db.session.execute(db.select(Job.id, Job.kind).where(
+        Job.status == 'queued',
+        Job.run_after <= now,
+        Job.kind.in_(list(JOB_KINDS))
+    ).order_by(Job.run_after, Job.id).limit(limit * 4)).all()
+    
+    claimed = []
+    for job_id, kind in candidates:
+        if len(claimed) >= limit:
+            break
+        # Лимит проверяется в том же UPDATE, что и захват
+        other = db.aliased(Job)
+        running = db.select(db.func.count(other.id)).where(
+            other.kind == kind,
+            other.status == 'running'
+        ).scalar_subquery()
+        result = db.session.execute(db.update(Job).where(
+            Job.id == job_id,
+            Job.status == 'queued',
+            running < JOB_KINDS[kind].concurrency
+        ).values(
+            status='running',
+            worker=worker,
+            started_at=now,
+            attempts=Job.attempts + 1
+        ))
+        db.session.commit()
+        if result.rowcount:
+            claimed.append(job_id)
+    
+    return claimed
+
+
+def run_job(job_id):
+    """Выполнение захваченной задачи; при ошибке - повтор с растущей задержкой или failed"""
+    job = db.session.get(Job, job_id)
+    kind = JOB_KINDS[job.kind]
+    
+    try:
+        result = kind.func(job, json.loads(job.params or '{}'))
+    except Exception as error:
+        db.session.rollback()
+        app.logger.warning('Задача %s (%s) завершилась ошибкой: %s', job.id, job.kind, error)
+        job.error = str(error) or type(error).__name__
+        if job.attempts < job.max_attempts:
+            delay = app.config['JOB_RETRY_DELAY'] * 2 ** (job.attempts - 1)
+            job.status = 'queued'
+            job.run_after = datetime.utcnow() + timedelta(seconds=delay)
+        else:
+            job.status = 'failed'
+            job.finished_at = datetime.utcnow()
+    else:
+        job.status = 'done'
+        job.error = None
+        job.result = json.dumps(result or {}, ensure_ascii=False)
+        job.finished_at = datetime.utcnow()
+    
+    db.session.commit()
+
+
+def recover_stale_jobs(timeout):
+    """Задачи, чей процесс умер во время выполнения, возвращаются в очередь"""
+    now = datetime.utcnow()
+    stale = db.and_(Job.status == 'running', Job.started_at < now - timedelta(seconds=timeout))
+    
+    db.session.execute(db.update(Job).where(stale, Job.attempts < Job.max_attempts).values(
+        status='queued', run_after=now, error='Выполнение прервано'
+    ))
+    db.session.execute(db.update(Job).where(stale).values(
+        status='failed', finished_at=now, error='Выполнение прервано'
+    ))
+    db.session.commit()
+
+
+def purge_expired_jobs(ttl_hours):
+    """Удаление завершенных задач старше срока хранения вместе с файлами результатов"""
+    cutoff = datetime.utcnow() - timedelta(hours=ttl_hours)
+    expired = Job.query.filter(
+        Job.status.in_(('done', 'failed')),
+        Job.finished_at < cutoff
+    ).all()
+    
+    for job in expired:
+        if job.result_path and os.path.exists(job.result_path):
+            os.remove(job.result_path)
+        db.session.delete(job)
+    db.session.commit()
+    return len(expired)
+
+
+def enqueue_periodic(kind, interval):
+    """Постановка системной задачи, если такая не ждет, не выполняется и не
+    завершалась последние interval секунд (в любом процессе)"""
+    recent = db.session.query(Job.id).filter(
+        Job.kind == kind,
+        Job.user_id.is_(None),
+        db.or_(
+            Job.status.in_(('queued', 'running')),
+            Job.finished_at >= datetime.utcnow() - timedelta(seconds=interval)
+        )
+    ).first()
+    if recent is None:
+        enqueue_job(kind)
+
+
+class JobRunner:
+    """Пул потоков, выполняющий задачи из таблицы job.
+    
+    Поток-диспетчер раз в poll_interval (или сразу после enqueue_job в этом
+    процессе) захватывает столько задач, сколько свободно потоков пула.
+    """
+    
+    def __init__(self, workers, poll_interval):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.name = None
+        self.executor = None
+        self.thread = None
+        self.running = set()  # id задач, выполняемых этим процессом
+        self.purged_at = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+    
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+    
+    def start(self):
+        if self.is_alive():
+            return
+        with self.lock:
+            if self.is_alive():
+                return
+            # После fork потоков родителя нет: имя и пул создаются заново
+            self.name = f'{socket.gethostname()}:{os.getpid()}'
+            self.running = set()
+            self.stopping.clear()
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='job')
+            self.thread = threading.Thread(target=self.loop, name='job-dispatcher', daemon=True)
+            self.thread.start()
+    
+    def stop(self):
+        """Остановка: новые задачи не берутся, выполняемые дорабатывают"""
+        self.stopping.set()
+        self.wakeup.set()
+        if self.is_alive():
+            self.thread.join()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+    
+    def wake(self):
+        self.wakeup.set()
+    
+    def loop(self):
+        while not self.stopping.is_set():
+            try:
+                with app.app_context():
+                    self.dispatch()
+            except Exception:
+                app.logger.exception('Ошибка диспетчера фоновых задач')
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+    
+    def dispatch(self):
+        if time.monotonic() - self.purged_at > JOB_PURGE_INTERVAL:
+            recover_stale_jobs(app.config['JOB_TIMEOUT'])
+            purge_expired_jobs(app.config['JOB_RESULT_TTL'])
+            for kind, setting in PERIODIC_JOBS.items():
+                if app.config[setting]:
+                    enqueue_periodic(kind, app.config[setting])
+            self.purged_at = time.monotonic()
+        
+        with self.lock:
+            free = self.workers - len(self.running)
+        if free <= 0:
+            return
+        
+        for job_id in claim_jobs(self.name, free):
+            with self.lock:
+                self.running.add(job_id)
+            self.executor.submit(self.execute, job_id)
+    
+    def execute(self, job_id):
+        try:
+            with app.app_context():
+                run_job(job_id)
+        except Exception:
+            app.logger.exception('Не удалось выполнить задачу %s', job_id)
+        finally:
+            with self.lock:
+                self.running.discard(job_id)
+            self.wake()
+
+
+job_runner = JobRunner(app.config['JOB_WORKERS'], app.config['JOB_POLL_INTERVAL'])
+
+
+@app.before_request
+def start_job_runner():
+    # Запуск при первом запросе, а не при импорте: воркеры gunicorn форкаются
+    # после импорта модуля, а CLI-командам потоки задач не нужны
+    if app.config['JOBS_ENABLED']:
+        job_runner.start()
+
+
+def job_file_path(job, extension):
+    """Путь файла результата задачи в JOB_RESULTS_DIR"""
+    directory = app.config['JOB_RESULTS_DIR']
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f'job_{job.id}_{secrets.token_hex(8)}.{extension}')
+
+
+def save_job_upload(upload):
+    """Сохранение загруженного файла для задачи импорта"""
+    directory = os.path.join(app.config['JOB_RESULTS_DIR'], 'uploads')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, secrets.token_hex(16))
+    upload.save(path)
+    return path
+
+
+def job_result(job):
+    return json.loads(job.result) if job.result else None
+
+
+def job_payload(job):
+    """Задача в ответе API; для готового файла - ссылка на скачивание"""
+    data = api_object(job, JOB_API_FIELDS)
+    data['params'] = json.loads(job.params or '{}')
+    data['params'].pop('path', None)  # путь на сервере клиенту не нужен
+    data['result'] = job_result(job)
+    if job.status == 'done' and job.result_path:
+        data['download_url'] = url_for('download_job_result', job_id=job.id)
+    return data
+
+
+@job_handler('export', concurrency=2, public=True)
+def export_job(job, params):
+    """Файл экспорта заметок пользователя (params: format)"""
+    export_format = params.get('format', 'md')
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    user = db.session.get(User, job.user_id)
+    path = job_file_path(job, extension)
+    
+    try:
+        with open(path, 'wb') as output:
+            for chunk in export_chunks(export_format, user.id, user.username):
+                output.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    
+    job.result_path = path
+    return {
+        'filename': f'noteflow_export_{job.created_at.strftime("%Y%m%d")}.{extension}',
+        'mimetype': mimetype,
+        'size': os.path.getsize(path),
+    }
+
+
+# Импорт не идемпотентен (повтор создал бы копии заметок), поэтому одна попытка
+@job_handler('import', concurrency=1, max_attempts=1)
+def import_job(job, params):
+    """Импорт сохраненного файла (params: path, filename, format)"""
+    try:
+        with open(params['path'], 'rb') as stream:
+            records = import_records(stream, params['filename'], params.get('format'))
+            return import_notes(job.user_id, records)
+    finally:
+        os.remove(params['path'])
+
+
+@job_handler('stats', public=True)
+def stats_job(job, params):
+    """Полный отчет по заметкам пользователя"""
+    stats = user_note_stats(job.user_id)
+    return {
+        'total_notes': stats['total_notes'],
+        'pinned_notes': stats['pinned_notes'],
+        'archived_notes': stats['archived_notes'],
+        'by_category': stats['by_category'],
+        **activity_histograms(job.user_id, user_timezone(db.session.get(User, job.user_id)), months=12),
+        'top_tags': [{'name': name, 'count': count} for name, count in top_tags(job.user_id, limit=50)],
+    }
+
+
+@job_handler('reindex')
+def reindex_job(job, params):
+    """Перестроение полнотекстового индекса"""
+    started = time.perf_counter()
+    rebuild_search_index()
+    return {'seconds': round(time.perf_counter() - started, 3)}
+
+
+# Имя -> функция дозаполнения данных для задачи backfill
+BACKFILLS = {
+    'tags': backfill_tags,
+    'summaries': backfill_note_summaries,
+    'change_seq': backfill_change_seq,
+    'compression': compress_notes,
+}
+
+
+@job_handler('backfill')
+def backfill_job(job, params):
+    """Дозаполнение производных данных (params: name из BACKFILLS)"""
+    started = time.perf_counter()
+    result = BACKFILLS[params['name']]()
+    db.session.commit()
+    return {'name': params['name'], 'result': result, 'seconds': round(time.perf_counter() - started, 3)}
+
+
+@job_handler('sweep_reset_tokens')
+def sweep_reset_tokens_job(job, params):
+    """Очистка просроченных и использованных токенов сброса пароля"""
+    return {'deleted': sweep_reset_tokens()}
+
+
+@job_handler('reconcile_counters')
+def reconcile_counters_job(job, params):
+    """Сверка счетчиков заметок (params: user_id - один пользователь, иначе все)"""
+    repaired = reconcile_note_counters(params.get('user_id'))
+    return {'users': len(repaired), 'rows': sum(repaired.values())}
+
+
+# Системные задачи по расписанию: тип -> настройка с периодом в секундах (0 - выключено)
+PERIODIC_JOBS = {
+    'sweep_reset_tokens': 'RESET_TOKEN_SWEEP_INTERVAL',
+}
+
+# --- СПИСОК МИГРАЦИЙ ---
+# Каждая миграция должна быть безопасна для базы, созданной через create_all:
+# новые таблицы уже существуют, поэтому проверяем наличие колонок и индексов
+
+@migration(1, 'Колонка note.is_archived')
+def migration_note_is_archived():
+    add_column('note', 'is_archived', 'BOOLEAN DEFAULT FALSE')
+
+
+@migration(2, 'Полнотекстовый индекс заметок')
+def migration_search_index():
+    init_search_index()
+
+
+@migration(3, 'Перенос тегов в таблицу тегов')
+def migration_backfill_tags():
+    backfill_tags()
+
+
+@migration(4, 'Индексы для списков заметок, категорий и токенов')
+def migration_list_indexes():
+    create_indexes(
+        'ix_note_list_updated', 'ix_note_list_created', 'ix_note_list_title',
+        'ix_note_user_category', 'ix_note_user_created',
+        'ix_category_user_name', 'ix_password_reset_token_user'
+    )
+
+
+@migration(5, 'Превью и счетчики слов и символов заметок')
+def migration_note_summaries():
+    add_column('note', 'preview', f"VARCHAR({NOTE_PREVIEW_LENGTH}) NOT NULL DEFAULT ''")
+    add_column('note', 'word_count', 'INTEGER NOT NULL DEFAULT 0')
+    add_column('note', 'char_count', 'INTEGER NOT NULL DEFAULT 0')
+    backfill_note_summaries()
+
+
+@migration(6, 'Последовательность изменений и надгробия для синхронизации')
+def migration_change_seq():
+    add_column('note', 'change_seq', 'INTEGER NOT NULL DEFAULT 0')
+    add_column('category', 'change_seq', 'INTEGER NOT NULL DEFAULT 0')
+    create_indexes('ix_note_user_change', 'ix_category_user_change', 'ix_tombstone_user_change')
+    backfill_change_seq()
+
+
+@migration(7, 'Хеши токенов сброса пароля и индекс по сроку действия')
+def migration_reset_token_hashes():
+    create_indexes('ix_password_reset_token_expires')
+    hash_stored_reset_tokens()
+
+
+@migration(8, 'Часовой пояс пользователя и индекс заметок по дате изменения')
+def migration_user_timezone():
+    add_column('user', 'timezone', "VARCHAR(50) NOT NULL DEFAULT 'UTC'")
+    create_indexes('ix_note_user_updated')
+
+
+@migration(9, 'Таблица готовых счетчиков заметок')
+def migration_note_counters():
+    # Таблицу создал create_all(); заполняем по существующим заметкам
+    reconcile_note_counters()
+
+
+@migration(10, 'Сжатие длинных заметок')
+def migration_compress_content():
+    # Сначала триггеры поиска, читающие сжатое содержание, затем сами заметки
+    recreate_search_triggers()
+    compress_notes()
 
 # --- МАРШРУТЫ ---
 
@@ -124,6 +3819,10 @@ def register():
         password = request.form.get('password')
         confirm_password = request.form.get('confirm_password')
         
+        retry_after = rate_limited((register_ip_limit, request.remote_addr))
+        if retry_after:
+            return too_many_attempts('register.html', retry_after)
+        
         # Валидация
         if not all([username, email, password, confirm_password]):
             flash('Все поля обязательны для заполнения', 'danger')
@@ -163,9 +3862,20 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
         
+        retry_after = rate_limited(
+            (login_ip_limit, request.remote_addr),
+            (login_user_limit, (username or '').lower())
+        )
+        if retry_after:
+            return too_many_attempts('login.html', retry_after)
+        
         user = User.query.filter_by(username=username).first()
         
-        if user and user.check_password(password):
+        if user and user.check_password(password or ''):
+            # Успешный вход снимает счетчик неудачных попыток для этого имени
+            if login_user_limit:
+                login_user_limit.reset(username.lower())
+            rehash_password(user, password)
             login_user(user)
             flash('Вход выполнен успешно!', 'success')
             return redirect(url_for('dashboard'))
@@ -188,98 +3898,79 @@ def logout():
 @login_required
 def dashboard():
     """Личный кабинет с поиском и фильтрацией"""
-    # Получаем параметры из GET запроса
-    search_query = request.args.get('search', '').strip()
-    category_filter = request.args.get('category', 'all')
-    show_archived = request.args.get('archived', 'false') == 'true'
-    sort_by = request.args.get('sort', 'updated')  # updated, created, title
+    # Страница зависит только от данных пользователя и параметров запроса
+    version, last_modified = user_version(current_user.id)
+    etag = make_etag('dashboard', current_user.id, current_user.username, version, request.full_path)
+    cached = not_modified(etag, last_modified)
+    if cached:
+        return cached
     
-    # Базовый запрос для заметок текущего пользователя
-    query = Note.query.filter_by(user_id=current_user.id)
+    # Категории пользователя: нужны и для фильтра, и для карточек
+    categories = Category.query.filter_by(user_id=current_user.id).all()
     
-    # Фильтрация по архивированным
-    if not show_archived:
-        query = query.filter_by(is_archived=False)
-    
-    # Поиск по тексту
-    if search_query:
-        search_term = f"%{search_query}%"
-        query = query.filter(
-            db.or_(
-                Note.title.ilike(search_term),
-                Note.content.ilike(search_term),
-                Note.tags.ilike(search_term)
-            )
-        )
+    # Базовый запрос для заметок текущего пользователя с фильтрами из GET запроса
+    query, search, filters = filter_notes(
+        Note.query.filter_by(user_id=current_user.id),
+        current_user.id,
+        request.args,
+        categories
+    )
     
-    # Фильтрация по категории
-    if category_filter != 'all':
-        if category_filter == 'uncategorized':
-            query = query.filter_by(category_id=None)
-        else:
-            # Проверяем, что категория принадлежит пользователю
-            category = Category.query.get(category_filter)
-            if category and category.user_id == current_user.id:
-                query = query.filter_by(category_id=category_filter)
+    # При поиске по умолчанию сортируем по релевантности
+    sort_by = request.args.get('sort') or ('relevance' if filters['search_query'] else 'updated')
     
-    # Сортировка
-    if sort_by == 'created':
-        query = query.order_by(Note.created_at.desc())
-    elif sort_by == 'title':
-        query = query.order_by(Note.title.asc())
-    else:  # updated (по умолчанию)
-        query = query.order_by(Note.updated_at.desc())
+    # Карточкам хватает превью; категорию подгружаем тем же запросом
+    query = query.options(*note_list_options())
     
-    # Сначала закрепленные, потом остальные
-    notes = query.all()
-    notes.sort(key=lambda x: (not x.is_pinned, x.updated_at), reverse=True)
+    # Сортировка и постраничная выдача по курсору
+    notes, next_cursor = keyset_page(
+        query,
+        note_sort_keys(sort_by, search),
+        request.args.get('cursor'),
+        app.config['NOTES_PAGE_SIZE']
+    )
     
-    # Получаем категории пользователя
-    categories = Category.query.filter_by(user_id=current_user.id).all()
+    next_page_url = None
+    if next_cursor:
+        page_args = request.args.to_dict()
+        page_args.pop('partial', None)
+        page_args['cursor'] = next_cursor
+        next_page_url = url_for('dashboard', **page_args)
     
-    # Статистика
-    total_notes = Note.query.filter_by(user_id=current_user.id).count()
-    pinned_notes = Note.query.filter_by(
-        user_id=current_user.id, 
-        is_pinned=True,
-        is_archived=False
-    ).count()
-    archived_notes = Note.query.filter_by(
-        user_id=current_user.id, 
-        is_archived=True
-    ).count()
-    
-    return render_template('dashboard.html', 
-                         notes=notes, 
-                         categories=categories,
-                         Category=Category,
-                         search_query=search_query,
-                         category_filter=category_filter,
-                         show_archived=show_archived,
-                         sort_by=sort_by,
-                         total_notes=total_notes,
-                         pinned_notes=pinned_notes,
-                         archived_notes=archived_notes)
-
-@app.route('/dashboard')
-@login_required
-def dashboard():
-    """Личный кабинет - список всех заметок"""
-    # Получаем заметки текущего пользователя
-    notes = Note.query.filter_by(user_id=current_user.id).order_by(
-        Note.is_pinned.desc(),  # Сначала закрепленные
-        Note.updated_at.desc()  # Потом по дате обновления
-    ).all()
+    # "Загрузить еще": отдаем только карточки следующей страницы
+    if request.args.get('partial'):
+        response = with_validators(render_template('_note_page.html', notes=notes), etag, last_modified)
+        response.headers['X-Next-Page'] = next_page_url or ''
+        return response
     
-    # Получаем категории пользователя
-    categories = Category.query.filter_by(user_id=current_user.id).all()
+    # Статистика и число заметок в категориях - одним запросом
+    stats = user_note_stats(current_user.id)
     
-    return render_template('dashboard.html', 
-                         notes=notes, 
-                         categories=categories,
-                         Category=Category)  # Передаем класс Category в шаблон
+    html = render_template('dashboard.html', 
+                           notes=notes, 
+                           categories=categories,
+                           category_counts=stats['by_category'],
+                           search_query=filters['search_query'],
+                           category_filter=filters['category_filter'],
+                           tag_filter=filters['tag_filter'],
+                           show_archived=filters['show_archived'],
+                           sort_by=sort_by,
+                           next_page_url=next_page_url,
+                           total_notes=stats['total_notes'],
+                           pinned_notes=stats['pinned_notes'],
+                           archived_notes=stats['archived_notes'])
+    return with_validators(html, etag, last_modified)
 
 
+def form_category_id():
+    """Категория из формы заметки: id своей категории, иначе (пусто или чужая) None"""
+    category_id = request.form.get('category_id', type=int)
+    if category_id is None:
+        return None
+    return db.session.scalar(
+        db.select(Category.id).where(Category.id == category_id, Category.user_id == current_user.id)
+    )
+
 @app.route('/notes/new', methods=['GET', 'POST'])
 @login_required
 def new_note():
@@ -287,7 +3978,6 @@ def new_note():
     if request.method == 'POST':
         title = request.form.get('title', '').strip()
         content = request.form.get('content', '').strip()
-        category_id = request.form.get('category_id')
         tags = request.form.get('tags', '').strip()
         
         # Валидация
@@ -300,17 +3990,13 @@ def new_note():
             title=title,
             content=content,
             user_id=current_user.id,
-            tags=tags
+            category_id=form_category_id()
         )
-        
-        # Если выбрана категория
-        if category_id:
-            # Проверяем, что категория принадлежит пользователю
-            category = Category.query.get(category_id)
-            if category and category.user_id == current_user.id:
-                note.category_id = category_id
-        
+        # Сначала в сессию: запрос тегов ниже вызывает автосброс
         db.session.add(note)
+        set_note_tags(note, tags)
+        
+        record_change(current_user.id, note)
         db.session.commit()
         
         flash('Заметка успешно создана!', 'success')
@@ -328,24 +4014,27 @@ def new_note():
 @login_required
 def edit_note(note_id):
     """Редактирование заметки"""
-    note = Note.query.get_or_404(note_id)
-    
-    # Проверяем, что заметка принадлежит текущему пользователю
-    if note.user_id != current_user.id:
-        flash('У вас нет доступа к этой заметке', 'danger')
-        return redirect(url_for('dashboard'))
+    # Чужая заметка - сообщение и возврат на дашборд (AccessDenied)
+    note = get_owned(Note, note_id)
     
     if request.method == 'POST':
-        note.title = request.form.get('title', '').strip()
-        note.content = request.form.get('content', '').strip()
-        note.category_id = request.form.get('category_id')
-        note.tags = request.form.get('tags', '').strip()
-        note.updated_at = datetime.utcnow()  # Обновляем время
+        title = request.form.get('title', '').strip()
+        content = request.form.get('content', '').strip()
         
-        if not note.title:
+        # Валидация - до любых изменений заметки и ее истории
+        if not title:
             flash('Заголовок обязателен', 'danger')
             return redirect(url_for('edit_note', note_id=note_id))
         
+        # Прежний текст уходит в историю версий
+        record_revision(note, title, content)
+        note.title = title
+        note.content = content
+        note.category_id = form_category_id()
+        set_note_tags(note, request.form.get('tags', ''))
+        note.updated_at = datetime.utcnow()  # Обновляем время
+        
+        record_change(current_user.id, note)
         db.session.commit()
         flash('Заметка успешно обновлена!', 'success')
         return redirect(url_for('dashboard'))
@@ -362,13 +4051,9 @@ def edit_note(note_id):
 @login_required
 def delete_note(note_id):
     """Удаление заметки"""
-    note = Note.query.get_or_404(note_id)
-    
-    if note.user_id != current_user.id:
-        flash('У вас нет доступа к этой заметке', 'danger')
-        return redirect(url_for('dashboard'))
+    note = get_owned(Note, note_id)
     
-    db.session.delete(note)
+    remove_note(note)
     db.session.commit()
     
     flash('Заметка успешно удалена!', 'success')
@@ -379,14 +4064,11 @@ def delete_note(note_id):
 @login_required
 def pin_note(note_id):
     """Закрепление/открепление заметки"""
-    note = Note.query.get_or_404(note_id)
-    
-    if note.user_id != current_user.id:
-        flash('У вас нет доступа к этой заметке', 'danger')
-        return redirect(url_for('dashboard'))
+    note = get_owned(Note, note_id)
     
     # Переключаем состояние закрепления
     note.is_pinned = not note.is_pinned
+    record_change(current_user.id, note)
     db.session.commit()
     
     action = "закреплена" if note.is_pinned else "откреплена"
@@ -397,11 +4079,7 @@ def pin_note(note_id):
 @login_required
 def archive_note(note_id):
     """Архивация/восстановление заметки"""
-    note = Note.query.get_or_404(note_id)
-    
-    if note.user_id != current_user.id:
-        flash('У вас нет доступа к этой заметке', 'danger')
-        return redirect(url_for('dashboard'))
+    note = get_owned(Note, note_id)
     
     # Переключаем состояние архивации
     note.is_archived = not note.is_archived
@@ -410,6 +4088,7 @@ def archive_note(note_id):
     if note.is_archived:
         note.is_pinned = False
     
+    record_change(current_user.id, note)
     db.session.commit()
     
     action = "архивирована" if note.is_archived else "восстановлена из архива"
@@ -420,64 +4099,90 @@ def archive_note(note_id):
 @login_required
 def view_note(note_id):
     """Просмотр отдельной заметки"""
-    note = Note.query.get_or_404(note_id)
+    note = get_owned(Note, note_id)
+    # ?revision=N - изменения версии N относительно предыдущей
+    number = request.args.get('revision', type=int)
     
-    if note.user_id != current_user.id:
-        flash('У вас нет доступа к этой заметке', 'danger')
-        return redirect(url_for('dashboard'))
+    # Страница показывает и категорию: по версии данных пользователя
+    # устаревает и при переименовании категории, а не только при правке заметки
+    version, last_modified = user_version(current_user.id)
+    etag = make_etag('note', current_user.id, current_user.username, note.id, version, number)
+    cached = not_modified(etag, last_modified)
+    if cached:
+        return cached
+    
+    diff = revision_diff(note.id, number) if number else None
+    if number and diff is None:
+        flash('Такой версии нет в истории заметки', 'warning')
+        return redirect(url_for('view_note', note_id=note.id))
     
-    return render_template('view_note.html', note=note)
+    return with_validators(render_template('view_note.html',
+                                           note=note,
+                                           revisions=revision_list(note.id),
+                                           diff=diff), etag, last_modified)
 
 @app.route('/notes/batch-action', methods=['POST'])
 @login_required
 def batch_action():
-    """Массовые действия с заметками"""
+    """Массовые действия с заметками одним запросом к базе"""
     action = request.form.get('action')
-    note_ids = request.form.getlist('note_ids')
-    
-    if not note_ids:
-        flash('Не выбрано ни одной заметки', 'warning')
-        return redirect(url_for('dashboard'))
-    
-    notes = Note.query.filter(
-        Note.id.in_(note_ids),
-        Note.user_id == current_user.id
-    ).all()
-    
-    if not notes:
-        flash('Заметки не найдены', 'danger')
-        return redirect(url_for('dashboard'))
-    
-    count = 0
-    for note in notes:
-        if action == 'archive':
-            note.is_archived = True
-            note.is_pinned = False
-            count += 1
-        elif action == 'unarchive':
-            note.is_archived = False
-            count += 1
-        elif action == 'pin':
-            note.is_pinned = True
-            count += 1
-        elif action == 'unpin':
-            note.is_pinned = False
-            count += 1
-        elif action == 'delete':
-            db.session.delete(note)
-            count += 1
-    
-    db.session.commit()
     
     actions = {
         'archive': 'архивировано',
         'unarchive': 'восстановлено из архива',
         'pin': 'закреплено',
         'unpin': 'откреплено',
+        'move': 'перемещено',
+        'add_tag': 'получили тег',
+        'remove_tag': 'лишились тега',
         'delete': 'удалено'
     }
     
-    flash(f'{count} заметок {actions.get(action, "обработано")}!', 'success')
+    if action not in actions:
+        flash('Выберите действие', 'warning')
+        return redirect(url_for('dashboard'))
+    
+    categories = Category.query.filter_by(user_id=current_user.id).all()
+    
+    if request.form.get('select_all'):
+        # Все заметки, подходящие под текущий фильтр дашборда
+        query, _, _ = filter_notes(
+            db.session.query(Note.id).filter(Note.user_id == current_user.id),
+            current_user.id,
+            request.form,
+            categories
+        )
+        note_ids = query.subquery().select()
+    else:
+        note_ids = [int(note_id) for note_id in request.form.getlist('note_ids') if note_id.isdigit()]
+        if not note_ids:
+            flash('Не выбрано ни одной заметки', 'warning')
+            return redirect(url_for('dashboard'))
+    
+    params = {}
+    if action == 'move':
+        # Переносим только в свою категорию; пустое значение - "без категории"
+        target_category = request.form.get('target_category', '')
+        owned = {str(category.id): category.id for category in categories}
+        if target_category and target_category not in owned:
+            flash('Категория не найдена', 'danger')
+            return redirect(url_for('dashboard'))
+        params['category_id'] = owned.get(target_category)
+    elif action in ('add_tag', 'remove_tag'):
+        names = parse_tags(request.form.get('tag_name', ''))
+        if not names:
+            flash('Укажите тег', 'warning')
+            return redirect(url_for('dashboard'))
+        params['tag'] = names[0]
+    
+    count = apply_batch_action(current_user.id, action, note_ids, params)
+    db.session.commit()
+    
+    if not count:
+        flash('Заметки не найдены', 'warning')
+        return redirect(url_for('dashboard'))
+    
+    flash(f'{count} заметок {actions[action]}!', 'success')
     return redirect(url_for('dashboard'))
 
 # маршруты для категорий
@@ -510,6 +4215,7 @@ def new_category():
     )
     
     db.session.add(category)
+    record_change(current_user.id, category)
     db.session.commit()
     
     flash(f'Категория "{name}" создана!', 'success')
@@ -520,211 +4226,188 @@ def new_category():
 @login_required
 def delete_category(category_id):
     """Удаление категории"""
-    category = Category.query.get_or_404(category_id)
-    
-    if category.user_id != current_user.id:
-        flash('У вас нет доступа к этой категории', 'danger')
-        return redirect(url_for('dashboard'))
-    
-    # Переносим заметки в "без категории"
-    notes_with_category = Note.query.filter_by(
-        category_id=category_id,
-        user_id=current_user.id
-    ).all()
-    
-    for note in notes_with_category:
-        note.category_id = None
-    
-    db.session.delete(category)
+    category = get_owned(Category, category_id)
+    remove_category(category)
     db.session.commit()
     
     flash(f'Категория "{category.name}" удалена', 'success')
     return redirect(url_for('dashboard'))
 
-with app.app_context():
-    db.create_all()
-    print("✅ База данных создана!")
+if app.config['AUTO_MIGRATE']:
+    with app.app_context():
+        migrate_database()
+        print("✅ База данных создана!")
 
 @app.route('/api/stats')
 @login_required
 def get_stats():
     """API для получения статистики"""
-    # Основная статистика
-    total_notes = Note.query.filter_by(user_id=current_user.id).count()
-    pinned_notes = Note.query.filter_by(
-        user_id=current_user.id, 
-        is_pinned=True,
-        is_archived=False
-    ).count()
-    archived_notes = Note.query.filter_by(
-        user_id=current_user.id, 
-        is_archived=True
-    ).count()
-    
-    # Статистика по категориям
-    categories = Category.query.filter_by(user_id=current_user.id).all()
-    category_stats = []
-    
-    for category in categories:
-        notes_count = Note.query.filter_by(
-            category_id=category.id,
-            user_id=current_user.id,
-            is_archived=False
-        ).count()
-        
-        category_stats.append({
-            'name': category.name,
-            'color': category.color,
-            'count': notes_count
-        })
-    
-    # Последние 5 заметок
-    recent_notes = Note.query.filter_by(
-        user_id=current_user.id,
-        is_archived=False
-    ).order_by(Note.updated_at.desc()).limit(5).all()
-    
-    recent = [{
-        'id': note.id,
-        'title': note.title,
-        'updated_at': note.updated_at.strftime('%d.%m.%Y %H:%M')
-    } for note in recent_notes]
+    # Клиенты опрашивают статистику постоянно: без изменений отвечаем 304
+    version, last_modified = user_version(current_user.id)
+    etag = make_etag('stats', current_user.id, version)
+    cached = not_modified(etag, last_modified)
+    if cached:
+        return cached
     
-    return {
-        'success': True,
-        'data': {
-            'total_notes': total_notes,
-            'pinned_notes': pinned_notes,
-            'archived_notes': archived_notes,
-            'category_stats': category_stats,
-            'recent_notes': recent
-        }
+    rows = {
+        name: db.session.execute(statement).all()
+        for name, statement in api_stats_statements(current_user.id).items()
     }
+    return with_validators(api_stats_payload(rows), etag, last_modified)
+
+@app.route('/api/cache/users')
+@login_required
+def user_cache_stats():
+    """Метрики кеша пользователей: попадания, промахи, размер"""
+    return {'success': True, 'data': user_cache.stats()}
+
+@app.route('/metrics')
+def metrics():
+    """Метрики запросов в формате Prometheus (при METRICS_ENABLED)"""
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+    token = app.config['METRICS_TOKEN']
+    if token and not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(401)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/stats')
 @login_required
 def stats_page():
     """Страница с подробной статистикой"""
-    # Получаем данные для графиков
-    notes_by_month = []
-    
-    # Заметки за последние 6 месяцев
-    from datetime import datetime, timedelta
-    import calendar
-    
-    for i in range(5, -1, -1):
-        month_start = datetime.utcnow().replace(
-            day=1, hour=0, minute=0, second=0, microsecond=0
-        ) - timedelta(days=30*i)
-        
-        month_end = month_start + timedelta(days=32)
-        month_end = month_end.replace(day=1) - timedelta(days=1)
-        
-        count = Note.query.filter(
-            Note.user_id == current_user.id,
-            Note.created_at >= month_start,
-            Note.created_at <= month_end
-        ).count()
-        
-        notes_by_month.append({
-            'month': calendar.month_name[month_start.month],
-            'count': count
-        })
-    
-    # Топ тегов
-    all_tags = {}
-    notes = Note.query.filter_by(user_id=current_user.id).all()
-    
-    for note in notes:
-        if note.tags:
-            for tag in note.tags.split(','):
-                tag_clean = tag.strip().lower()
-                if tag_clean:
-                    all_tags[tag_clean] = all_tags.get(tag_clean, 0) + 1
+    # Последние 6 календарных месяцев, часы и дни недели - в поясе пользователя
+    activity = activity_histograms(current_user.id, user_timezone(current_user), months=6)
     
-    top_tags = sorted(all_tags.items(), key=lambda x: x[1], reverse=True)[:10]
-    
-    # Статистика по времени суток
-    import random  # Временные данные для демо
-    hourly_stats = [random.randint(0, 10) for _ in range(24)]
+    # Топ тегов - подсчет на стороне базы
+    tags = top_tags(current_user.id, limit=10)
     
     return render_template('stats.html',
-                         notes_by_month=notes_by_month,
-                         top_tags=top_tags,
-                         hourly_stats=hourly_stats)
+                         notes_by_month=activity['months'],
+                         top_tags=tags,
+                         hourly_stats=activity['hours'],
+                         weekday_stats=activity['weekdays'])
 
-@app.route('/export/notes')
+@app.route('/export/notes', methods=['POST'])
 @login_required
 def export_notes():
-    """Экспорт заметок в формате Markdown"""
-    import io
-    from flask import send_file
+    """Экспорт заметок в фоне: Markdown, ZIP (файл на заметку) или JSON Lines"""
+    export_format = request.form.get('format', 'md')
+    if export_format not in EXPORT_FORMATS:
+        flash('Неизвестный формат экспорта', 'danger')
+        return redirect(url_for('dashboard'))
     
-    # Получаем заметки пользователя
-    notes = Note.query.filter_by(
-        user_id=current_user.id,
-        is_archived=False
-    ).order_by(Note.created_at.desc()).all()
+    enqueue_job('export', current_user.id, format=export_format)
+    flash('Экспорт запущен: файл появится на этой странице, когда будет готов', 'info')
+    return redirect(url_for('jobs_page'))
+
+
+@app.route('/jobs')
+@login_required
+def jobs_page():
+    """Фоновые задачи пользователя и ссылки на их результаты"""
+    jobs = Job.query.filter_by(
+        user_id=current_user.id
+    ).order_by(Job.created_at.desc(), Job.id.desc()).limit(JOB_LIST_LIMIT).all()
     
-    # Создаем Markdown документ
-    output = io.StringIO()
+    return render_template('jobs.html',
+                         jobs=jobs,
+                         results={job.id: job_result(job) for job in jobs},
+                         pending=any(job.status in ('queued', 'running') for job in jobs))
+
+
+@app.route('/jobs/<int:job_id>/download')
+@login_required
+def download_job_result(job_id):
+    """Скачивание файла, подготовленного фоновой задачей"""
+    job = get_owned(Job, job_id)
+    if job.status != 'done' or not job.result_path or not os.path.exists(job.result_path):
+        flash('Файл еще не готов или уже удален', 'warning')
+        return redirect(url_for('jobs_page'))
     
-    output.write(f"# Экспорт заметок из NoteFlow\n\n")
-    output.write(f"Пользователь: {current_user.username}\n")
-    output.write(f"Дата экспорта: {datetime.utcnow().strftime('%d.%m.%Y %H:%M')}\n")
-    output.write(f"Всего заметок: {len(notes)}\n\n")
+    result = job_result(job)
+    return send_file(
+        job.result_path,
+        mimetype=result['mimetype'],
+        as_attachment=True,
+        download_name=result['filename']
+    )
+
+def import_uploaded_file():
+    """Импорт файла из поля file запроса; возвращает отчет"""
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        raise NoteImportError('файл не выбран')
     
-    for note in notes:
-        output.write(f"## {note.title}\n\n")
-        
-        if note.category_id:
-            category = Category.query.get(note.category_id)
-            if category:
-                output.write(f"**Категория:** {category.name}\n\n")
-        
-        if note.tags:
-            output.write(f"**Теги:** {note.tags}\n\n")
-        
-        output.write(f"**Создано:** {note.created_at.strftime('%d.%m.%Y %H:%M')}\n")
-        output.write(f"**Обновлено:** {note.updated_at.strftime('%d.%m.%Y %H:%M')}\n\n")
-        
-        if note.content:
-            output.write(f"{note.content}\n")
-        
-        output.write(f"\n---\n\n")
+    records = import_records(upload.stream, upload.filename, request.form.get('format'))
+    return import_notes(current_user.id, records)
+
+
+def enqueue_uploaded_import():
+    """Сохранение файла из поля file и постановка задачи импорта"""
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        raise NoteImportError('файл не выбран')
     
-    # Конвертируем в bytes для отправки
-    content = output.getvalue().encode('utf-8')
-    output.close()
+    import_format = request.form.get('format') or import_format_for(upload.filename)
+    if import_format != 'zip' and import_format not in TEXT_PARSERS:
+        raise NoteImportError('неизвестный формат: ожидается .md, .jsonl или .zip')
     
-    return send_file(
-        io.BytesIO(content),
-        mimetype='text/markdown',
-        as_attachment=True,
-        download_name=f'noteflow_export_{datetime.utcnow().strftime("%Y%m%d")}.md'
+    return enqueue_job(
+        'import', current_user.id,
+        path=save_job_upload(upload),
+        filename=upload.filename,
+        format=import_format
     )
 
+
+@app.route('/import/notes', methods=['POST'])
+@login_required
+def import_notes_upload():
+    """Импорт заметок из файла со страницы профиля (в фоне)"""
+    try:
+        enqueue_uploaded_import()
+    except NoteImportError as error:
+        flash(f'Импорт не выполнен: {error}', 'danger')
+        return redirect(url_for('profile'))
+    
+    flash('Файл загружен, импорт выполняется в фоне', 'info')
+    return redirect(url_for('jobs_page'))
+
+
+@app.route('/api/import', methods=['POST'])
+@login_required
+def api_import_notes():
+    """API импорта: файл в поле file, ответ - отчет об импорте.
+    
+    С background=1 файл импортируется фоновой задачей, ответ - 202 с задачей.
+    """
+    try:
+        if request.form.get('background') == '1':
+            job = enqueue_uploaded_import()
+            return {'success': True, 'data': job_payload(job)}, 202
+        report = import_uploaded_file()
+    except NoteImportError as error:
+        return {'success': False, 'error': str(error)}, 400
+    
+    return {'success': True, 'data': report}
+
 @app.route('/profile')
 @login_required
 def profile():
     """Страница профиля пользователя"""
     # Статистика пользователя
-    total_notes = Note.query.filter_by(user_id=current_user.id).count()
-    pinned_notes = Note.query.filter_by(
-        user_id=current_user.id, 
-        is_pinned=True,
-        is_archived=False
-    ).count()
+    stats = user_note_stats(current_user.id)
     
     # Последняя активность
     last_note = Note.query.filter_by(
         user_id=current_user.id
-    ).order_by(Note.updated_at.desc()).first()
+    ).options(db.load_only(*NOTE_SUMMARY_COLUMNS)).order_by(Note.updated_at.desc()).first()
     
     return render_template('profile.html',
-                         total_notes=total_notes,
-                         pinned_notes=pinned_notes,
-                         last_note=last_note)
+                         total_notes=stats['total_notes'],
+                         pinned_notes=stats['pinned_notes'],
+                         last_note=last_note,
+                         timezones=sorted(timezone_names()))
 
 
 @app.route('/profile/update', methods=['POST'])
@@ -752,10 +4435,17 @@ def update_profile():
             flash('Email уже зарегистрирован', 'danger')
             return redirect(url_for('profile'))
     
+    user_tz = request.form.get('timezone', current_user.timezone)
+    if user_tz not in timezone_names():
+        flash('Неизвестный часовой пояс', 'danger')
+        return redirect(url_for('profile'))
+    
     # Обновляем данные
     current_user.username = username
     current_user.email = email
+    current_user.timezone = user_tz
     db.session.commit()
+    user_cache.invalidate(current_user.id)
     
     flash('Профиль успешно обновлен!', 'success')
     return redirect(url_for('profile'))
@@ -786,6 +4476,7 @@ def change_password():
     # Устанавливаем новый пароль
     current_user.set_password(new_password)
     db.session.commit()
+    user_cache.invalidate(current_user.id)
     
     flash('Пароль успешно изменен!', 'success')
     return redirect(url_for('profile'))
@@ -801,16 +4492,7 @@ def forgot_password():
         
         if user:
             # Создаем токен сброса пароля
-            token = secrets.token_urlsafe(32)
-            expires_at = datetime.utcnow() + timedelta(hours=24)
-            
-            reset_token = PasswordResetToken(
-                user_id=user.id,
-                token=token,
-                expires_at=expires_at
-            )
-            
-            db.session.add(reset_token)
+            token = issue_reset_token(user)
             db.session.commit()
             
             # В реальном приложении здесь была бы отправка email
@@ -833,7 +4515,7 @@ def forgot_password():
 @app.route('/reset-password/<token>', methods=['GET', 'POST'])
 def reset_password(token):
     """Сброс пароля по токену"""
-    reset_token = PasswordResetToken.query.filter_by(token=token).first()
+    reset_token = find_reset_token(token)
     
     if not reset_token or not reset_token.is_valid():
         flash('Недействительная или просроченная ссылка', 'danger')
@@ -855,17 +4537,585 @@ def reset_password(token):
         user = reset_token.user
         user.set_password(password)
         
-        # Помечаем токен как использованный
-        reset_token.is_used = True
+        # Помечаем использованным этот токен и остальные ссылки пользователя
+        PasswordResetToken.query.filter_by(
+            user_id=user.id,
+            is_used=False
+        ).update({'is_used': True}, synchronize_session=False)
         
         db.session.commit()
+        user_cache.invalidate(user.id)
         
         flash('Пароль успешно изменен! Теперь вы можете войти.', 'success')
         return redirect(url_for('login'))
     
     return render_template('reset_password.html', token=token)
 
+# маршруты JSON API v1
+
+def api_conditional(resource):
+    """ETag ответа API по версии данных пользователя и параметрам запроса"""
+    version, last_modified = user_version(current_user.id)
+    etag = make_etag('api', resource, current_user.id, version, request.full_path)
+    return etag, last_modified, not_modified(etag, last_modified)
+
+
+@app.route('/api/v1/notes')
+@login_required
+def api_list_notes():
+    """Список заметок: фильтры как у дашборда, курсор, fields="""
+    fields = api_fields(NOTE_API_FIELDS, NOTE_LIST_FIELDS)
+    etag, last_modified, cached = api_conditional('notes')
+    if cached:
+        return cached
+    
+    categories = Category.query.filter_by(user_id=current_user.id).all()
+    query, search, filters = filter_notes(
+        Note.query.filter_by(user_id=current_user.id),
+        current_user.id,
+        request.args,
+        categories
+    )
+    sort_by = request.args.get('sort') or ('relevance' if filters['search_query'] else 'updated')
+    
+    # Загружаем только запрошенные колонки
+    query = query.options(db.load_only(*[NOTE_API_FIELDS[field] for field in fields]))
+    keys = note_sort_keys(sort_by, search)
+    notes, next_cursor = keyset_page(query, keys, api_cursor(keys), api_page_size())
+    
+    return with_validators({
+        'success': True,
+        'data': [api_object(note, fields) for note in notes],
+        'next_cursor': next_cursor
+    }, etag, last_modified)
+
+
+@app.route('/api/v1/notes/<int:note_id>')
+@login_required
+def api_get_note(note_id):
+    fields = api_fields(NOTE_API_FIELDS, NOTE_API_FIELDS)
+    # ETag по версии данных, как в asgi.py: 304 без чтения заметки
+    etag, last_modified, cached = api_conditional('note')
+    if cached:
+        return cached
+    
+    columns = [NOTE_API_FIELDS[field] for field in fields]
+    note = get_owned(Note, note_id, db.load_only(*columns, Note.user_id))
+    return with_validators({'success': True, 'data': api_object(note, fields)}, etag, last_modified)
+
+
+def owned_category_ids():
+    return set(db.session.scalars(db.select(Category.id).where(Category.user_id == current_user.id)))
+
+
+@app.route('/api/v1/notes', methods=['POST'])
+@login_required
+def api_create_note():
+    changes = note_changes(api_json_body(), owned_category_ids())
+    
+    note = Note(user_id=current_user.id)
+    # Сначала в сессию, как в new_note: запрос тегов ниже вызывает автосброс
+    db.session.add(note)
+    apply_note_changes(note, changes)
+    record_change(current_user.id, note)
+    db.session.commit()
+    
+    return {'success': True, 'data': api_object(note, NOTE_API_FIELDS)}, 201
+
+
+@app.route('/api/v1/notes/<int:note_id>', methods=['PATCH'])
+@login_required
+def api_update_note(note_id):
+    note = get_owned(Note, note_id)
+    changes = note_changes(api_json_body(), owned_category_ids(), partial=True)
+    
+    apply_note_changes(note, changes)
+    record_change(current_user.id, note)
+    db.session.commit()
+    
+    return {'success': True, 'data': api_object(note, NOTE_API_FIELDS)}
+
+
+@app.route('/api/v1/notes/<int:note_id>', methods=['DELETE'])
+@login_required
+def api_delete_note(note_id):
+    note = get_owned(Note, note_id)
+    remove_note(note)
+    db.session.commit()
+    return '', 204
+
+
+@app.route('/api/v1/notes/bulk', methods=['POST'])
+@login_required
+def api_bulk_notes():
+    """Массовое создание и обновление: объекты с id обновляются, без id - создаются.
+    
+    Все объекты проверяются до записи; при любой ошибке ничего не сохраняется.
+    """
+    category_ids = owned_category_ids()
+    changes, errors = validate_bulk(
+        bulk_items(),
+        lambda item, partial: note_changes(item, category_ids, partial)
+    )
+    
+    # Обновляемые заметки - одним запросом и только свои
+    ids = [note_id for note_id, _ in changes if note_id is not None]
+    existing = {note.id: note for note in Note.query.filter(
+        Note.user_id == current_user.id,
+        Note.id.in_(ids)
+    )} if ids else {}
+    errors += [
+        {'index': index, 'error': 'Заметка не найдена'}
+        for index, (note_id, _) in enumerate(changes)
+        if note_id is not None and note_id not in existing
+    ]
+    if errors:
+        return {'success': False, 'errors': sorted(errors, key=lambda item: item['index'])}, 400
+    
+    results = []
+    for note_id, values in changes:
+        note = existing.get(note_id)
+        if note is None:
+            note = Note(user_id=current_user.id)
+            db.session.add(note)
+        apply_note_changes(note, values)
+        results.append((note, 'updated' if note_id is not None else 'created'))
+    
+    record_change(current_user.id, *[note for note, _ in results])
+    db.session.commit()
+    
+    return {'success': True, 'data': [
+        {'id': note.id, 'status': status, 'updated_at': note.updated_at.isoformat()}
+        for note, status in results
+    ]}
+
+
+@app.route('/api/v1/categories')
+@login_required
+def api_list_categories():
+    fields = api_fields(CATEGORY_API_FIELDS, CATEGORY_API_FIELDS)
+    etag, last_modified, cached = api_conditional('categories')
+    if cached:
+        return cached
+    
+    keys = [(Category.id, False)]
+    categories, next_cursor = keyset_page(
+        Category.query.filter_by(user_id=current_user.id),
+        keys,
+        api_cursor(keys),
+        api_page_size()
+    )
+    return with_validators({
+        'success': True,
+        'data': [api_object(category, fields) for category in categories],
+        'next_cursor': next_cursor
+    }, etag, last_modified)
+
+
+@app.route('/api/v1/categories/<int:category_id>')
+@login_required
+def api_get_category(category_id):
+    fields = api_fields(CATEGORY_API_FIELDS, CATEGORY_API_FIELDS)
+    category = get_owned(Category, category_id)
+    return {'success': True, 'data': api_object(category, fields)}
+
+
+@app.route('/api/v1/categories', methods=['POST'])
+@login_required
+def api_create_category():
+    changes = category_changes(api_json_body())
+    check_category_names(current_user.id, [changes['name']])
+    
+    category = Category(user_id=current_user.id, **changes)
+    db.session.add(category)
+    record_change(current_user.id, category)
+    db.session.commit()
+    
+    return {'success': True, 'data': api_object(category, CATEGORY_API_FIELDS)}, 201
+
+
+@app.route('/api/v1/categories/<int:category_id>', methods=['PATCH'])
+@login_required
+def api_update_category(category_id):
+    category = get_owned(Category, category_id)
+    changes = category_changes(api_json_body(), partial=True)
+    if 'name' in changes:
+        check_category_names(current_user.id, [changes['name']], exclude_ids=[category.id])
+    
+    for field, value in changes.items():
+        setattr(category, field, value)
+    record_change(current_user.id, category)
+    db.session.commit()
+    
+    return {'success': True, 'data': api_object(category, CATEGORY_API_FIELDS)}
+
+
+@app.route('/api/v1/categories/<int:category_id>', methods=['DELETE'])
+@login_required
+def api_delete_category(category_id):
+    """Удаление категории; ее заметки остаются без категории"""
+    category = get_owned(Category, category_id)
+    remove_category(category)
+    db.session.commit()
+    return '', 204
+
+
+@app.route('/api/v1/categories/bulk', methods=['POST'])
+@login_required
+def api_bulk_categories():
+    """Массовое создание и обновление категорий (как /api/v1/notes/bulk)"""
+    changes, errors = validate_bulk(bulk_items(), lambda item, partial: category_changes(item, partial))
+    
+    ids = [category_id for category_id, _ in changes if category_id is not None]
+    existing = {category.id: category for category in Category.query.filter(
+        Category.user_id == current_user.id,
+        Category.id.in_(ids)
+    )} if ids else {}
+    errors += [
+        {'index': index, 'error': 'Категория не найдена'}
+        for index, (category_id, _) in enumerate(changes)
+        if category_id is not None and category_id not in existing
+    ]
+    if errors:
+        return {'success': False, 'errors': sorted(errors, key=lambda item: item['index'])}, 400
+    
+    names = [values['name'] for _, values in changes if 'name' in values]
+    check_category_names(current_user.id, names, exclude_ids=ids)
+    
+    results = []
+    for category_id, values in changes:
+        category = existing.get(category_id)
+        if category is None:
+            category = Category(user_id=current_user.id)
+            db.session.add(category)
+        for field, value in values.items():
+            setattr(category, field, value)
+        results.append((category, 'updated' if category_id is not None else 'created'))
+    
+    record_change(current_user.id, *[category for category, _ in results])
+    db.session.commit()
+    
+    return {'success': True, 'data': [
+        {'id': category.id, 'status': status} for category, status in results
+    ]}
+
+@app.route('/api/sync')
+@app.route('/api/v1/sync')
+@login_required
+def api_sync():
+    """Изменения заметок и категорий после курсора.
+    
+    since - курсор из предыдущего ответа (0 или без него - все данные).
+    Пока has_more, клиент повторяет запрос с новым курсором.
+    """
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        raise ApiError('since должен быть числом')
+    if since < 0:
+        raise ApiError('since должен быть неотрицательным')
+    
+    # Нет новых версий - короткий ответ без запросов к заметкам
+    version, _ = user_version(current_user.id)
+    if since > version:
+        raise ApiError('Курсор новее данных сервера: нужна полная синхронизация (since=0)', 409)
+    if since == version:
+        return {'success': True, 'data': {
+            'notes': [], 'categories': [], 'deleted_notes': [], 'deleted_categories': []
+        }, 'cursor': version, 'has_more': False}
+    
+    changes = sync_changes(current_user.id, since, api_page_size(SYNC_MAX_CHANGES, SYNC_MAX_CHANGES))
+    return {'success': True, 'data': {
+        'notes': [api_object(note, NOTE_API_FIELDS) for note in changes['notes']],
+        'categories': [api_object(category, CATEGORY_API_FIELDS) for category in changes['categories']],
+        'deleted_notes': changes['deleted_notes'],
+        'deleted_categories': changes['deleted_categories'],
+    }, 'cursor': changes['cursor'], 'has_more': changes['has_more']}
+
+
+@app.route('/api/v1/search')
+@login_required
+def api_search():
+    """Поиск по заметкам: превью и релевантность лучших совпадений"""
+    statement = search_notes_statement(current_user.id, request.args.get('q', ''), api_page_size())
+    if statement is None:
+        return {'success': True, 'data': []}
+    return search_payload(db.session.execute(statement).all())
+
+
+@app.route('/api/v1/jobs')
+@login_required
+def api_list_jobs():
+    """Последние фоновые задачи пользователя"""
+    jobs = Job.query.filter_by(
+        user_id=current_user.id
+    ).order_by(Job.created_at.desc(), Job.id.desc()).limit(api_page_size(JOB_LIST_LIMIT)).all()
+    return {'success': True, 'data': [job_payload(job) for job in jobs]}
+
+
+@app.route('/api/v1/jobs', methods=['POST'])
+@login_required
+def api_create_job():
+    """Постановка задачи: {"kind": "export", "params": {"format": "zip"}}; ответ 202"""
+    data = api_json_body()
+    kind = JOB_KINDS.get(data.get('kind'))
+    if kind is None or not kind.public:
+        raise ApiError('Неизвестный тип задачи')
+    
+    params = data.get('params') or {}
+    if not isinstance(params, dict):
+        raise ApiError('params должен быть объектом')
+    if kind.name == 'export':
+        params = {'format': params.get('format', 'md')}
+        if params['format'] not in EXPORT_FORMATS:
+            raise ApiError('Неизвестный формат экспорта')
+    else:
+        params = {}
+    
+    job = enqueue_job(kind.name, current_user.id, **params)
+    return {'success': True, 'data': job_payload(job)}, 202
+
+
+@app.route('/api/v1/jobs/<int:job_id>')
+@login_required
+def api_get_job(job_id):
+    """Статус задачи; у готового экспорта - download_url"""
+    return {'success': True, 'data': job_payload(get_owned(Job, job_id))}
+
+
+@app.route('/api/events')
+@login_required
+def api_events():
+    """SSE-канал событий notes-changed (WSGI: соединение держит поток воркера)"""
+    user_id = current_user.id
+    since = last_event_id(request.headers.get('Last-Event-ID'))
+    if since is None:
+        since = user_version(user_id)[0]
+    
+    def stream():
+        nonlocal since
+        started = last_ping = time.monotonic()
+        yield sse_message(retry=app.config['SSE_POLL_INTERVAL'] * 2, comment='connected')
+        
+        while time.monotonic() - started < app.config['SSE_MAX_SECONDS']:
+            version = db.session.scalar(db.select(UserState.version).where(UserState.user_id == user_id)) or 0
+            if version > since:
+                notes, deleted = change_notice_statements(user_id, since)
+                yield change_notice(
+                    since, version,
+                    db.session.scalars(notes).all(),
+                    db.session.scalars(deleted).all()
+                )
+                since = version
+            # Завершаем транзакцию чтения, иначе следующая проверка увидит тот же снимок
+            db.session.rollback()
+            
+            if time.monotonic() - last_ping >= app.config['SSE_HEARTBEAT']:
+                yield sse_message(comment='ping')
+                last_ping = time.monotonic()
+            time.sleep(app.config['SSE_POLL_INTERVAL'])
+    
+    return Response(stream_with_context(stream()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+# --- КОМАНДЫ CLI ---
+
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Применение миграций схемы к существующей базе"""
+    done = migrate_database()
+    for version, description in done:
+        click.echo(f'  {version}: {description}')
+    click.echo(f'Применено миграций: {len(done)}')
+
+
+def explain_rows(statement):
+    """План выполнения запроса в виде списка строк"""
+    connection = db.session.connection()
+    compiled = statement.compile(dialect=db.engine.dialect)
+    
+    if db.engine.dialect.name == 'postgresql':
+        rows = connection.exec_driver_sql(f'EXPLAIN {compiled}', compiled.params)
+        return [row[0] for row in rows]
+    
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}', params)
+    return [row[-1] for row in rows]
+
+
+# Признаки полного просмотра таблицы заметок (и note_counter - по префиксу)
+FULL_SCAN = re.compile(r'^SCAN note(?! USING)|Seq Scan on note')
+
+
+def plan_uses_index(plan):
+    return not any(FULL_SCAN.search(line) for line in plan)
+
+
+def explain_checks():
+    """Запросы дашборда, которые обязаны идти по индексам: имя -> запрос"""
+    def note_list(sort_by, **args):
+        query, search, _ = filter_notes(Note.query.filter_by(user_id=0), 0, args, [])
+        keys = note_sort_keys(sort_by, search)
+        query = query.order_by(*[column.desc() if desc else column.asc() for column, desc in keys])
+        return query.limit(app.config['NOTES_PAGE_SIZE'] + 1).statement
+    
+    return {
+        'дашборд, по обновлению': note_list('updated'),
+        'дашборд, по созданию': note_list('created'),
+        'дашборд, по названию': note_list('title'),
+        'дашборд, категория': note_list('updated', category='uncategorized'),
+        'статистика': note_stats_statement(0),
+    }
+
+
+@app.cli.command('db-explain')
+def db_explain_command():
+    """Проверка, что запросы дашборда используют индексы (EXPLAIN); то же - tests/test_query_plans.py"""
+    failed = 0
+    
+    for name, statement in explain_checks().items():
+        plan = explain_rows(statement)
+        uses_index = plan_uses_index(plan)
+        failed += not uses_index
+        click.echo(f'{"OK " if uses_index else "FAIL"} {name}')
+        for line in plan:
+            click.echo(f'       {line}')
+    
+    if failed:
+        raise click.ClickException(f'Запросов без индекса: {failed}')
+
+
+@app.cli.command('compress-notes')
+@click.option('--batch-size', default=500, help='Заметок в одной транзакции')
+def compress_notes_command(batch_size):
+    """Сжатие (или распаковка) содержания заметок по текущим настройкам"""
+    report = compress_notes(batch_size)
+    before, after = report['bytes_before'], report['bytes_after']
+    click.echo(f'Заметок: {report["notes"]}, переписано: {report["changed"]}')
+    click.echo(f'Содержание: {before / 1048576:.1f} МБ -> {after / 1048576:.1f} МБ '
+               f'(сэкономлено {(before - after) / 1048576:.1f} МБ), CPU: {report["cpu_seconds"]} с')
+
+
+@app.cli.command('backfill-tags')
+def backfill_tags_command():
+    """Перенос тегов из строк Note.tags в таблицу тегов"""
+    processed = backfill_tags()
+    click.echo(f'Обработано заметок с тегами: {processed}')
+
+
+@app.cli.command('sweep-reset-tokens')
+@click.option('--batch-size', default=1000, help='Токенов в одной транзакции')
+def sweep_reset_tokens_command(batch_size):
+    """Удаление просроченных и использованных токенов сброса пароля"""
+    click.echo(f'Удалено токенов: {sweep_reset_tokens(batch_size)}')
+
+
+@app.cli.command('reconcile-counters')
+@click.option('--user', 'username', help='Только этот пользователь')
+def reconcile_counters_command(username):
+    """Пересчет счетчиков заметок и исправление расхождений"""
+    user_id = None
+    if username:
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.ClickException(f'Пользователь {username} не найден')
+        user_id = user.id
+    
+    repaired = reconcile_note_counters(user_id)
+    for uid, rows in repaired.items():
+        click.echo(f'Пользователь {uid}: исправлено строк счетчиков: {rows}')
+    click.echo(f'Расхождения у пользователей: {len(repaired)}')
+
+
+@app.cli.command('import-notes')
+@click.argument('username')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'import_format', type=click.Choice(['md', 'jsonl', 'zip']),
+              help='Формат файла (по умолчанию - по расширению)')
+@click.option('--batch-size', default=IMPORT_BATCH_SIZE, help='Заметок в одной транзакции')
+def import_notes_command(username, path, import_format, batch_size):
+    """Импорт заметок пользователя из Markdown, JSON Lines или ZIP"""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f'Пользователь {username} не найден')
+    
+    with open(path, 'rb') as stream:
+        try:
+            records = import_records(stream, path, import_format)
+        except NoteImportError as error:
+            raise click.ClickException(str(error))
+        report = import_notes(user.id, records, batch_size=batch_size)
+    
+    click.echo(
+        f'Импортировано: {report["imported"]}, с ошибками: {report["failed"]}, '
+        f'{report["seconds"]} с ({report["notes_per_second"]} заметок/с)'
+    )
+    for item in report['errors']:
+        click.echo(f'  {item["ref"]}: {item["error"]}', err=True)
+
+
+jobs_cli = AppGroup('jobs', help='Фоновые задачи')
+app.cli.add_command(jobs_cli)
+
+
+@jobs_cli.command('worker')
+@click.option('--workers', default=None, type=int, help='Потоков (по умолчанию JOB_WORKERS)')
+def jobs_worker_command(workers):
+    """Отдельный процесс выполнения задач (в вебе тогда JOBS_ENABLED=false)"""
+    runner = JobRunner(workers or app.config['JOB_WORKERS'], app.config['JOB_POLL_INTERVAL'])
+    runner.start()
+    click.echo(f'Выполнение фоновых задач: {runner.workers} потоков, Ctrl+C - остановка')
+    try:
+        while runner.is_alive():
+            runner.thread.join(1)
+    except KeyboardInterrupt:
+        click.echo('Остановка: дожидаемся выполняемых задач')
+    finally:
+        runner.stop()
+
+
+@jobs_cli.command('enqueue')
+@click.argument('kind', type=click.Choice(sorted(JOB_KINDS)))
+@click.option('--user', 'username', help='Пользователь задачи (для export и stats)')
+@click.option('--param', 'params', multiple=True, help='Параметр вида имя=значение')
+def jobs_enqueue_command(kind, username, params):
+    """Постановка задачи в очередь, например: flask jobs enqueue backfill --param name=tags"""
+    user_id = None
+    if username:
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.ClickException(f'Пользователь {username} не найден')
+        user_id = user.id
+    
+    if any('=' not in item for item in params):
+        raise click.ClickException('Параметры задаются в виде имя=значение')
+    params = dict(item.split('=', 1) for item in params)
+    if kind == 'backfill' and params.get('name') not in BACKFILLS:
+        raise click.ClickException(f'Укажите --param name=: {", ".join(BACKFILLS)}')
+    
+    job = enqueue_job(kind, user_id, **params)
+    click.echo(f'Задача {job.id} ({kind}) поставлена в очередь')
+
+
+@jobs_cli.command('list')
+@click.option('--limit', default=20, help='Сколько последних задач показать')
+def jobs_list_command(limit):
+    """Последние задачи и их статусы"""
+    for job in Job.query.order_by(Job.id.desc()).limit(limit):
+        click.echo(
+            f'{job.id:>6}  {job.kind:<10} {job.status:<8} '
+            f'попыток {job.attempts}/{job.max_attempts}  {job.error or ""}'
+        )
+
+
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()  # Создаем таблицы в БД
+        migrate_database()  # Создаем таблицы и применяем миграции
     app.run(debug=True)
+else:
+    # Замеры (flask bench ...) - в bench.py; он импортирует этот модуль,
+    # поэтому подключается в конце, когда все имена уже определены
+    import bench  # noqa: E402,F401
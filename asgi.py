@@ -0,0 +1,391 @@
+# asgi.py
+"""ASGI-точка входа: uvicorn asgi:application
+
+Flask-приложение целиком работает через WsgiToAsgi (в пуле потоков), а
+эндпоинты, которые держат соединение или часто опрашиваются, обслуживаются
+корутинами с асинхронным доступом к базе и не занимают потоки:
+
+- GET /api/events - SSE-канал событий notes-changed
+- GET /api/stats - статистика (с ETag, как во Flask-версии)
+- GET /api/v1/notes/<id> - заметка (fields=, с ETag)
+- GET /api/v1/search?q= - поиск
+"""
+import asyncio
+import json
+import re
+import time
+from urllib.parse import parse_qsl
+
+from asgiref.wsgi import WsgiToAsgi
+from flask_login.config import COOKIE_NAME
+from flask_login.utils import decode_cookie
+from itsdangerous import BadSignature
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.http import parse_accept_header, parse_cookie, parse_etags
+
+from app import (
+    app, db, ApiError, NOTE_API_FIELDS, User, UserState,
+    api_note_statement, api_row, api_stats_payload, api_stats_statements,
+    apply_sqlite_pragmas, change_notice, change_notice_statements, compress_data,
+    last_event_id, make_etag, parse_api_fields, preferred_encoding, register_sqlite_functions,
+    search_notes_statement, search_payload, sse_message, user_versions_statement
+)
+
+flask_application = WsgiToAsgi(app)
+
+
+def async_database_url(url):
+    """URL базы для async-драйвера: aiosqlite для SQLite, asyncpg для PostgreSQL"""
+    if url.startswith('sqlite:'):
+        return url.replace('sqlite:', 'sqlite+aiosqlite:', 1)
+    if url.startswith(('postgresql:', 'postgres:')):
+        return 'postgresql+asyncpg:' + url.split(':', 1)[1]
+    return url
+
+
+def create_engine_for_app():
+    options = dict(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+    engine = create_async_engine(async_database_url(app.config['SQLALCHEMY_DATABASE_URI']), **options)
+
+    if engine.dialect.name == 'sqlite':
+        # Соединение aiosqlite не sqlite3.Connection: PRAGMA профиля и функции
+        # для триггеров поиска ставим здесь
+        @event.listens_for(engine.sync_engine, 'connect')
+        def on_async_connect(dbapi_connection, connection_record):
+            apply_sqlite_pragmas(dbapi_connection, app.config['SQLITE_PRAGMAS'])
+            register_sqlite_functions(dbapi_connection)
+
+    return engine
+
+
+engine = create_engine_for_app()
+
+
+# --- ЗАПРОС И ОТВЕТ ---
+
+class Request:
+    """Минимальный разбор HTTP-запроса из ASGI scope"""
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.path = scope['path']
+        self.headers = Headers([
+            (name.decode('latin-1'), value.decode('latin-1'))
+            for name, value in scope['headers']
+        ])
+        self.cookies = parse_cookie(self.headers.get('Cookie', ''))
+        query_string = scope.get('query_string', b'')
+        self.args = MultiDict(parse_qsl(query_string.decode('latin-1'), keep_blank_values=True))
+        # Как request.full_path во Flask: входит в ETag ответов API
+        self.full_path = f'{self.path}?{query_string.decode()}'
+
+    def session(self):
+        """Подписанная cookie сессии Flask; пустой словарь, если ее нет или подпись неверна"""
+        cookie = self.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        if not cookie:
+            return {}
+        serializer = app.session_interface.get_signing_serializer(app)
+        try:
+            return serializer.loads(cookie, max_age=int(app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            return {}
+
+    def user_id(self):
+        """Пользователь из сессии или cookie "запомнить меня", как в login_manager; None, если не вошел"""
+        session = self.session()
+        user_id = session.get('_user_id')
+        # После выхода Flask-Login помечает сессию, и cookie "запомнить меня" уже не действует
+        if user_id is None and session.get('_remember') != 'clear':
+            cookie = self.cookies.get(app.config.get('REMEMBER_COOKIE_NAME', COOKIE_NAME))
+            if cookie:
+                with app.app_context():
+                    user_id = decode_cookie(cookie)
+        try:
+            return int(user_id) if user_id is not None else None
+        except ValueError:
+            return None
+
+
+async def send_response(send, status, body=b'', headers=(), content_type='application/json'):
+    headers = [(b'content-type', content_type.encode()), *headers]
+    headers.append((b'content-length', str(len(body)).encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(request, send, payload, status=200, etag=None):
+    """JSON-ответ со сжатием и ETag по тем же правилам, что и во Flask"""
+    body = json.dumps(payload, ensure_ascii=False).encode()
+    headers = [(b'vary', b'Cookie, Accept-Encoding')]
+
+    encoding = None
+    if len(body) >= app.config['COMPRESS_MIN_SIZE']:
+        encoding = preferred_encoding(parse_accept_header(request.headers.get('Accept-Encoding')))
+    if encoding:
+        body = compress_data(body, encoding)
+        headers.append((b'content-encoding', encoding.encode()))
+
+    if etag:
+        tag = f'{etag}-{encoding}' if encoding else etag
+        headers += [(b'etag', f'"{tag}"'.encode()), (b'cache-control', b'private, no-cache')]
+    await send_response(send, status, body, headers)
+
+
+def is_fresh(request, etag):
+    """If-None-Match совпадает с ETag (в том числе сжатого представления)"""
+    etags = parse_etags(request.headers.get('If-None-Match'))
+    return any(etags.contains(tag) for tag in (etag, f'{etag}-gzip', f'{etag}-br'))
+
+
+# --- УВЕДОМЛЕНИЯ ---
+
+class NotificationHub:
+    """Рассылка notes-changed подписчикам /api/events.
+
+    Одна фоновая задача на процесс раз в SSE_POLL_INTERVAL читает версии
+    данных всех подключенных пользователей одним запросом; записи могут
+    идти из любого процесса (WSGI или ASGI), поэтому источник - база.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.subscribers = {}  # user_id -> {asyncio.Queue}
+        self.versions = {}     # user_id -> последняя известная версия
+        self.task = None
+
+    def subscribe(self, user_id, version):
+        queue = asyncio.Queue()
+        self.subscribers.setdefault(user_id, set()).add(queue)
+        self.versions.setdefault(user_id, version)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        queues = self.subscribers.get(user_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.subscribers[user_id]
+            self.versions.pop(user_id, None)
+
+    async def run(self):
+        while self.subscribers:
+            await asyncio.sleep(app.config['SSE_POLL_INTERVAL'])
+            try:
+                await self.poll()
+            except Exception as error:  # база недоступна - пробуем на следующем шаге
+                app.logger.warning('Опрос версий для SSE не удался: %s', error)
+
+    async def poll(self):
+        user_ids = list(self.subscribers)
+        if not user_ids:
+            return
+
+        with app.app_context():
+            statement = user_versions_statement(user_ids)
+        async with self.engine.connect() as connection:
+            versions = dict((await connection.execute(statement)).all())
+
+            for user_id, version in versions.items():
+                since = self.versions.get(user_id)
+                if since is None or version <= since:
+                    continue
+                message = await load_change_notice(connection, user_id, since, version)
+                self.versions[user_id] = version
+                for queue in self.subscribers.get(user_id, ()):
+                    queue.put_nowait((version, message))
+
+
+async def load_change_notice(connection, user_id, since, version):
+    with app.app_context():
+        notes, deleted = change_notice_statements(user_id, since)
+    note_ids = (await connection.execute(notes)).scalars().all()
+    deleted_ids = (await connection.execute(deleted)).scalars().all()
+    return change_notice(since, version, note_ids, deleted_ids)
+
+
+async def existing_user_id(user_id):
+    """user_id, если пользователь еще существует (как load_user во Flask), иначе None"""
+    if user_id is None:
+        return None
+    async with engine.connect() as connection:
+        return (await connection.execute(db.select(User.id).where(User.id == user_id))).scalar()
+
+
+async def current_version(user_id):
+    async with engine.connect() as connection:
+        version = (await connection.execute(
+            db.select(UserState.version).where(UserState.user_id == user_id)
+        )).scalar()
+    return version or 0
+
+
+hub = NotificationHub(engine)
+
+
+# --- ОБРАБОТЧИКИ ---
+
+async def events(request, receive, send, user_id):
+    """SSE: соединение живет до SSE_MAX_SECONDS, затем клиент переподключается"""
+    version = await current_version(user_id)
+    since = last_event_id(request.headers.get('Last-Event-ID'))
+    queue = hub.subscribe(user_id, version)
+
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'text/event-stream; charset=utf-8'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+    ]})
+
+    async def push(message):
+        await send({'type': 'http.response.body', 'body': message.encode(), 'more_body': True})
+
+    async def wait_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    disconnected = asyncio.create_task(wait_disconnect())
+    try:
+        await push(sse_message(retry=app.config['SSE_POLL_INTERVAL'] * 2, comment='connected'))
+
+        # Клиент переподключился и мог пропустить изменения
+        if since is not None and since < version:
+            async with engine.connect() as connection:
+                await push(await load_change_notice(connection, user_id, since, version))
+
+        deadline = time.monotonic() + app.config['SSE_MAX_SECONDS']
+        while not disconnected.done() and time.monotonic() < deadline:
+            next_message = asyncio.create_task(queue.get())
+            done, _ = await asyncio.wait(
+                {next_message, disconnected},
+                timeout=min(app.config['SSE_HEARTBEAT'], max(deadline - time.monotonic(), 0)),
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            if next_message in done:
+                _, message = next_message.result()
+                await push(message)
+            else:
+                next_message.cancel()
+                if not disconnected.done():
+                    await push(sse_message(comment='ping'))
+
+        if not disconnected.done():
+            await send({'type': 'http.response.body', 'body': b''})
+    except OSError:
+        pass  # клиент закрыл соединение во время записи
+    finally:
+        disconnected.cancel()
+        hub.unsubscribe(user_id, queue)
+
+
+async def stats(request, receive, send, user_id):
+    version = await current_version(user_id)
+    etag = make_etag('stats', user_id, version)
+    if is_fresh(request, etag):
+        await send_response(send, 304, headers=[(b'etag', f'"{etag}"'.encode())])
+        return
+
+    with app.app_context():
+        statements = api_stats_statements(user_id)
+    async with engine.connect() as connection:
+        rows = {
+            name: (await connection.execute(statement)).all()
+            for name, statement in statements.items()
+        }
+    await send_json(request, send, api_stats_payload(rows), etag=etag)
+
+
+async def get_note(request, receive, send, user_id, note_id):
+    fields = parse_api_fields(request.args.get('fields', ''), NOTE_API_FIELDS, NOTE_API_FIELDS)
+    # Тот же ETag, что у api_get_note во Flask (api_conditional)
+    version = await current_version(user_id)
+    etag = make_etag('api', 'note', user_id, version, request.full_path)
+    if is_fresh(request, etag):
+        await send_response(send, 304, headers=[(b'etag', f'"{etag}"'.encode())])
+        return
+
+    with app.app_context():
+        statement = api_note_statement(user_id, note_id, fields)
+    async with engine.connect() as connection:
+        row = (await connection.execute(statement)).first()
+
+    if row is None:
+        # Чужая заметка неотличима от несуществующей
+        await send_json(request, send, {'success': False, 'error': 'Не найдено'}, 404)
+        return
+    await send_json(request, send, {'success': True, 'data': api_row(row, fields)}, etag=etag)
+
+
+async def search(request, receive, send, user_id):
+    try:
+        limit = max(1, min(int(request.args.get('limit', app.config['NOTES_PAGE_SIZE'])), 100))
+    except ValueError:
+        raise ApiError('limit должен быть числом')
+
+    with app.app_context():
+        statement = search_notes_statement(user_id, request.args.get('q', ''), limit)
+    if statement is None:
+        await send_json(request, send, {'success': True, 'data': []})
+        return
+
+    async with engine.connect() as connection:
+        rows = (await connection.execute(statement)).all()
+    await send_json(request, send, search_payload(rows))
+
+
+ROUTES = [
+    (re.compile(r'^/api/events$'), events),
+    (re.compile(r'^/api/stats$'), stats),
+    (re.compile(r'^/api/v1/notes/(?P<note_id>\d+)$'), get_note),
+    (re.compile(r'^/api/v1/search$'), search),
+]
+
+
+def match_route(scope):
+    if scope['method'] != 'GET':
+        return None, {}
+    for pattern, handler in ROUTES:
+        match = pattern.match(scope['path'])
+        if match:
+            return handler, {name: int(value) for name, value in match.groupdict().items()}
+    return None, {}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if hub.task:
+                hub.task.cancel()
+            await engine.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """Async-эндпоинты обрабатываются здесь, все остальное - Flask"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    handler, params = match_route(scope) if scope['type'] == 'http' else (None, {})
+    if handler is None:
+        await flask_application(scope, receive, send)
+        return
+
+    request = Request(scope)
+    user_id = await existing_user_id(request.user_id())
+    if user_id is None:
+        await send_json(request, send, {'success': False, 'error': 'Требуется вход в систему'}, 401)
+        return
+
+    try:
+        await handler(request, receive, send, user_id, **params)
+    except ApiError as error:
+        await send_json(request, send, {'success': False, 'error': str(error)}, error.status)
@@ -0,0 +1,768 @@
+# bench.py
+"""Заполнение тестовыми данными и замеры производительности: flask seed, flask bench ...
+
+app.py импортирует этот модуль в конце, поэтому здесь доступны все его имена.
+"""
+import asyncio
+import html
+import json
+import os
+import random
+import re
+import secrets
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import BaseWSGIServer
+
+from app import (
+    app, db, argon2, CATEGORY_COLORS, REVISION_COMPRESS_LEVEL,
+    Category, Job, Note, NoteCounter, NoteRevision, PasswordHashBusy, Tag, Tombstone, User, UserState,
+    note_tags, apply_sqlite_pragmas, argon2_hasher, content_summary, engine_options, ensure_tag_ids,
+    hash_password, load_revisions, on_connect, parse_tags, password_pool, reconcile_note_counters,
+    record_change, record_revision, run_job, search_index_suspended, search_subquery, sqlite_pragmas,
+    verify_password
+)
+
+
+bench_cli = AppGroup('bench', help='Замеры производительности на временных данных')
+app.cli.add_command(bench_cli)
+
+BENCH_WORDS = (
+    'проект встреча идея задача список покупки отчет план отпуск книга '
+    'рецепт код ошибка релиз дизайн бюджет звонок клиент заметка черновик '
+    'python flask sql index search cache deploy review backlog sprint'
+).split()
+
+
+def _bench_user():
+    """Временный пользователь, все данные которого удаляются после замера"""
+    suffix = secrets.token_hex(4)
+    user = User(username=f'bench_{suffix}', email=f'bench_{suffix}@example.com')
+    user.set_password(secrets.token_urlsafe(16))
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def _drop_bench_user(user):
+    """Удаление временного пользователя вместе с его заметками"""
+    note_ids = db.select(Note.id).where(Note.user_id == user.id)
+    db.session.execute(note_tags.delete().where(note_tags.c.note_id.in_(note_ids)))
+    db.session.execute(db.delete(NoteRevision).where(NoteRevision.note_id.in_(note_ids)))
+    Note.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    Tag.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    Category.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    Tombstone.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    UserState.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    Job.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    NoteCounter.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    db.session.delete(user)
+    db.session.commit()
+
+
+def _bench_note_rows(user_id, count, rnd, category_ids=()):
+    """Синтетические заметки для вставки одним executemany"""
+    now = datetime.utcnow()
+    rows = []
+    for _ in range(count):
+        created = now - timedelta(minutes=rnd.randint(0, 60 * 24 * 365))
+        content = ' '.join(rnd.choices(BENCH_WORDS, k=rnd.randint(20, 200)))
+        rows.append({
+            'title': ' '.join(rnd.choices(BENCH_WORDS, k=rnd.randint(2, 5))).capitalize(),
+            'content': content,
+            **content_summary(content),
+            'tags': ', '.join(rnd.sample(BENCH_WORDS, k=rnd.randint(0, 3))),
+            'user_id': user_id,
+            'is_pinned': rnd.random() < 0.05,
+            'is_archived': rnd.random() < 0.1,
+            # Примерно пятая часть заметок без категории
+            'category_id': rnd.choice(category_ids) if category_ids and rnd.random() < 0.8 else None,
+            'created_at': created,
+            'updated_at': created,
+        })
+    return rows
+
+
+def _median_ms(func, repeat):
+    """Медиана времени выполнения func в миллисекундах"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def _seed_note_counts(users, notes, rnd):
+    """Распределение заметок по пользователям с длинным хвостом, как в жизни:
+    у немногих пользователей много заметок, у большинства - мало"""
+    weights = [1 / (rank + 1) for rank in range(users)]
+    counts = [int(notes * weight / sum(weights)) for weight in weights]
+    counts[0] += notes - sum(counts)
+    rnd.shuffle(counts)
+    return counts
+
+
+def _seed_user(user, count, categories, batch_size, rnd):
+    """Категории, теги и заметки одного пользователя партиями executemany"""
+    category_ids = db.session.execute(
+        db.insert(Category).returning(Category.id, sort_by_parameter_order=True),
+        [{
+            'name': name.capitalize(),
+            'color': CATEGORY_COLORS[index % len(CATEGORY_COLORS)],
+            'user_id': user.id,
+            'change_seq': 1,
+        } for index, name in enumerate(rnd.sample(BENCH_WORDS, k=categories))]
+    ).scalars().all()
+    tag_ids = ensure_tag_ids(user.id, set(BENCH_WORDS))
+    seq = 1
+    
+    for start in range(0, count, batch_size):
+        rows = _bench_note_rows(user.id, min(batch_size, count - start), rnd, category_ids)
+        # id задаем сами: RETURNING с порядком строк SQLite выполняет по строке
+        # за запрос, а заполнение идет в одиночку, без конкурирующих вставок
+        next_id = (db.session.scalar(db.select(db.func.max(Note.id))) or 0) + 1
+        for offset, row in enumerate(rows):
+            seq += 1
+            row['id'] = next_id + offset
+            row['change_seq'] = seq
+        db.session.execute(db.insert(Note), rows)
+        
+        links = [
+            {'note_id': row['id'], 'tag_id': tag_ids[name]}
+            for row in rows
+            for name in parse_tags(row['tags'])
+        ]
+        if links:
+            db.session.execute(note_tags.insert(), links)
+        db.session.commit()
+    
+    db.session.merge(UserState(user_id=user.id, version=seq, updated_at=datetime.utcnow()))
+    db.session.commit()
+    # Заметки вставлены в обход ORM - счетчики считаем по факту
+    reconcile_note_counters(user.id)
+
+
+@app.cli.command('seed')
+@click.option('--users', default=10, help='Число пользователей')
+@click.option('--notes', default=10000, help='Всего заметок (распределяются неравномерно)')
+@click.option('--categories', default=6, help='Категорий у каждого пользователя')
+@click.option('--prefix', default='seed', help='Префикс имен пользователей: seed_0, seed_1, ...')
+@click.option('--password', default='password', help='Пароль всех пользователей')
+@click.option('--batch-size', default=5000, help='Заметок в одной транзакции')
+@click.option('--seed', 'random_seed', default=42, help='Зерно генератора случайных чисел')
+@click.option('--drop', is_flag=True, help='Сначала удалить пользователей с этим префиксом')
+def seed_command(users, notes, categories, prefix, password, batch_size, random_seed, drop):
+    """Синтетические пользователи, категории, теги и заметки для замеров (до миллионов заметок)"""
+    rnd = random.Random(random_seed)
+    existing = User.query.filter(User.username.like(f'{prefix}\\_%', escape='\\')).all()
+    if existing and not drop:
+        raise click.ClickException(
+            f'Пользователи {prefix}_* уже есть ({len(existing)}): укажите --drop или другой --prefix'
+        )
+    for user in existing:
+        _drop_bench_user(user)
+    
+    # Хеш один на всех: хеширование каждого пароля заняло бы минуты
+    password_hash = hash_password(password)
+    db.session.execute(db.insert(User), [{
+        'username': f'{prefix}_{index}',
+        'email': f'{prefix}_{index}@example.com',
+        'password_hash': password_hash,
+    } for index in range(users)])
+    db.session.commit()
+    
+    started = time.perf_counter()
+    inserted = 0
+    with search_index_suspended():
+        seeded = User.query.filter(User.username.like(f'{prefix}\\_%', escape='\\')).order_by(User.id).all()
+        for user, count in zip(seeded, _seed_note_counts(users, notes, rnd)):
+            _seed_user(user, count, min(categories, len(BENCH_WORDS)), batch_size, rnd)
+            inserted += count
+            elapsed = time.perf_counter() - started
+            click.echo(f'{user.username}: {count} заметок (всего {inserted}, {inserted / elapsed:.0f} заметок/с)')
+        click.echo('Перестроение полнотекстового индекса...')
+    
+    click.echo(f'Готово за {time.perf_counter() - started:.1f} с; вход: {seeded[0].username} / {password}')
+
+
+@bench_cli.command('concurrency')
+@click.option('--writers', default=8, help='Потоков, создающих заметки')
+@click.option('--readers', default=8, help='Потоков, читающих список заметок')
+@click.option('--seconds', default=10.0, help='Длительность прогона каждого профиля')
+@click.option('--profiles', default='plain,tuned', help='Профили SQLite через запятую')
+def bench_concurrency(writers, readers, seconds, profiles):
+    """Конкурентные писатели и читатели на временной базе SQLite для профилей PRAGMA"""
+    click.echo(
+        f'{"профиль":>8} {"записей/с":>10} {"чтений/с":>10} {"запись p95, мс":>15} '
+        f'{"чтение p95, мс":>15} {"locked":>7}'
+    )
+    
+    for profile in profiles.split(','):
+        pragmas = sqlite_pragmas(profile.strip())
+        with tempfile.TemporaryDirectory() as directory:
+            uri = f'sqlite:///{os.path.join(directory, "bench.db")}'
+            engine = db.create_engine(uri, **engine_options(uri, pragmas))
+            # Глобальный обработчик настроил бы соединения профилем приложения
+            event.remove(Engine, 'connect', on_connect)
+            event.listen(engine, 'connect', lambda connection, record: apply_sqlite_pragmas(connection, pragmas))
+            try:
+                result = _run_concurrency(engine, writers, readers, seconds)
+            finally:
+                event.listen(Engine, 'connect', on_connect)
+                engine.dispose()
+        
+        click.echo(
+            f'{profile:>8} {result["writes"] / seconds:>10.0f} {result["reads"] / seconds:>10.0f} '
+            f'{result["write_p95"]:>15.1f} {result["read_p95"]:>15.1f} {result["locked"]:>7}'
+        )
+
+
+def _run_concurrency(engine, writers, readers, seconds):
+    """Прогон потоков-писателей и читателей; возвращает счетчики и задержки"""
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        user_id = connection.execute(db.insert(User).values(
+            username='bench', email='bench@example.com', password_hash='-'
+        )).inserted_primary_key[0]
+    
+    deadline = time.perf_counter() + seconds
+    lock = threading.Lock()
+    result = {'writes': 0, 'reads': 0, 'locked': 0, 'write_ms': [], 'read_ms': []}
+    
+    def writer(rnd):
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                with engine.begin() as connection:
+                    connection.execute(db.insert(Note), _bench_note_rows(user_id, 1, rnd))
+            except db.exc.OperationalError:
+                with lock:
+                    result['locked'] += 1
+                continue
+            with lock:
+                result['writes'] += 1
+                result['write_ms'].append((time.perf_counter() - started) * 1000)
+    
+    def reader():
+        statement = db.select(Note.id, Note.title).where(Note.user_id == user_id).order_by(
+            Note.is_pinned.desc(), Note.updated_at.desc()
+        ).limit(30)
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                with engine.connect() as connection:
+                    connection.execute(statement).all()
+            except db.exc.OperationalError:
+                with lock:
+                    result['locked'] += 1
+                continue
+            with lock:
+                result['reads'] += 1
+                result['read_ms'].append((time.perf_counter() - started) * 1000)
+    
+    threads = [threading.Thread(target=writer, args=(random.Random(i),)) for i in range(writers)]
+    threads += [threading.Thread(target=reader) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    def p95(values):
+        return statistics.quantiles(values, n=20)[-1] if len(values) > 1 else 0.0
+    
+    result['write_p95'] = p95(result.pop('write_ms'))
+    result['read_p95'] = p95(result.pop('read_ms'))
+    return result
+
+
+@bench_cli.command('search')
+@click.option('--sizes', default='1000,10000,50000', help='Число заметок через запятую')
+@click.option('--repeat', default=20, help='Повторов каждого запроса')
+@click.option('--query', 'search_query', default='проект клие', help='Поисковый запрос')
+def bench_search(sizes, repeat, search_query):
+    """Задержка поиска (ILIKE против полнотекстового индекса) от числа заметок"""
+    rnd = random.Random(42)
+    user = _bench_user()
+    like = f'%{search_query}%'
+
+    def ilike_search():
+        return Note.query.filter(
+            Note.user_id == user.id,
+            db.or_(Note.title.ilike(like), Note.content.ilike(like), Note.tags.ilike(like))
+        ).order_by(Note.updated_at.desc()).limit(50).all()
+
+    def index_search():
+        search = search_subquery(search_query)
+        return Note.query.filter(Note.user_id == user.id).join(
+            search, search.c.note_id == Note.id
+        ).order_by(search.c.rank.asc()).limit(50).all()
+
+    click.echo(f'{"заметок":>10} {"ILIKE, мс":>12} {"индекс, мс":>12}')
+    try:
+        inserted = 0
+        for size in sorted(int(value) for value in sizes.split(',')):
+            rows = _bench_note_rows(user.id, size - inserted, rnd)
+            if rows:
+                db.session.execute(db.insert(Note), rows)
+                db.session.commit()
+            inserted = size
+
+            ilike_ms = _median_ms(ilike_search, repeat)
+            index_ms = _median_ms(index_search, repeat)
+            db.session.rollback()
+            click.echo(f'{size:>10} {ilike_ms:>12.2f} {index_ms:>12.2f}')
+    finally:
+        _drop_bench_user(user)
+
+
+@bench_cli.command('revisions')
+@click.option('--revisions', 'count', default=2000, help='Правок одной заметки')
+@click.option('--lines', default=300, help='Строк в заметке')
+@click.option('--keep', default=0, help='Хранимых версий (0 - все правки)')
+@click.option('--snapshot-every', type=int, help='Период снимков (по умолчанию NOTE_REVISION_SNAPSHOT_EVERY)')
+@click.option('--samples', default=200, help='Случайных версий для замера сборки')
+def bench_revisions(count, lines, keep, snapshot_every, samples):
+    """Объем истории версий и время сборки версии у заметки с тысячами правок"""
+    rnd = random.Random(42)
+    settings = {key: app.config[key] for key in ('NOTE_REVISIONS_KEEP', 'NOTE_REVISION_SNAPSHOT_EVERY')}
+    app.config['NOTE_REVISIONS_KEEP'] = keep or count + 1
+    if snapshot_every:
+        app.config['NOTE_REVISION_SNAPSHOT_EVERY'] = snapshot_every
+    
+    def random_line():
+        return ' '.join(rnd.choices(BENCH_WORDS, k=rnd.randint(5, 15)))
+    
+    text = [random_line() for _ in range(lines)]
+    user = _bench_user()
+    note = Note(title='bench', content='\n'.join(text), user_id=user.id)
+    db.session.add(note)
+    db.session.commit()
+    note_id, user_id = note.id, user.id
+    
+    save_ms = []
+    plain_sizes, compressed_sizes = [], []
+    try:
+        for _ in range(count):
+            # Типичная правка: заменить, вставить или удалить пару строк
+            for _ in range(rnd.randint(1, 3)):
+                position = rnd.randrange(len(text))
+                action = rnd.random()
+                if action < 0.6:
+                    text[position] = random_line()
+                elif action < 0.85 or len(text) < 10:
+                    text.insert(position, random_line())
+                else:
+                    del text[position]
+            content = '\n'.join(text)
+            
+            started = time.perf_counter()
+            record_revision(note, note.title, content)
+            note.content = content
+            db.session.commit()
+            save_ms.append((time.perf_counter() - started) * 1000)
+            
+            plain_sizes.append(len(content.encode()))
+            compressed_sizes.append(len(zlib.compress(content.encode(), REVISION_COMPRESS_LEVEL)))
+        
+        stored, snapshots, stored_bytes = db.session.execute(db.select(
+            db.func.count(),
+            db.func.sum(db.case((NoteRevision.base_number.is_(None), 1), else_=0)),
+            db.func.sum(db.func.length(NoteRevision.data))
+        ).where(NoteRevision.note_id == note_id)).one()
+        numbers = db.session.scalars(
+            db.select(NoteRevision.number).where(NoteRevision.note_id == note_id)
+        ).all()
+        
+        build_ms = []
+        for number in rnd.sample(numbers, min(samples, len(numbers))):
+            db.session.expunge_all()
+            started = time.perf_counter()
+            load_revisions(note_id, [number])
+            build_ms.append((time.perf_counter() - started) * 1000)
+        
+        db.session.expunge_all()
+        if load_revisions(note_id, [max(numbers)])[max(numbers)][1] != content:
+            raise click.ClickException('Последняя версия не совпала с текстом заметки')
+        
+        # Полные копии сравниваем с теми же хранимыми версиями
+        plain_bytes = sum(plain_sizes[-stored:])
+        compressed_bytes = sum(compressed_sizes[-stored:])
+        click.echo(f'версий: {stored}, из них снимков: {snapshots}, '
+                   f'средний размер текста: {plain_bytes // stored // 1024} КБ')
+        click.echo(f'{"хранение":<28} {"КБ":>10}')
+        click.echo(f'{"полные копии":<28} {plain_bytes / 1024:>10.0f}')
+        click.echo(f'{"полные копии, zlib":<28} {compressed_bytes / 1024:>10.0f}')
+        click.echo(f'{"снимки + разницы":<28} {stored_bytes / 1024:>10.0f}')
+        click.echo(f'{"операция":<28} {"p50, мс":>10} {"p95, мс":>10}')
+        click.echo(f'{"сохранение версии":<28} {statistics.median(save_ms):>10.2f} {_p95(save_ms):>10.2f}')
+        click.echo(f'{"сборка версии":<28} {statistics.median(build_ms):>10.2f} {_p95(build_ms):>10.2f}')
+    finally:
+        app.config.update(settings)
+        db.session.rollback()
+        _drop_bench_user(db.session.get(User, user_id))
+
+
+@bench_cli.command('passwords')
+@click.option('--methods', default='pbkdf2:sha256:600000,scrypt:32768:8:1,scrypt:16384:8:1,argon2',
+              help='Методы хеширования через запятую')
+@click.option('--repeat', default=5, help='Хешей на метод')
+@click.option('--burst', default=200, help='Одновременных проверок пароля в волне')
+def bench_passwords(methods, repeat, burst):
+    """Стоимость хеширования паролей и поведение пула при волне попыток входа"""
+    click.echo(f'{"метод":<28} {"хеш, мс":>10}')
+    for method in methods.split(','):
+        if method == 'argon2' and argon2 is None:
+            click.echo(f'{method:<28} {"нет argon2-cffi":>10}')
+            continue
+        hasher = argon2_hasher().hash if method == 'argon2' else (
+            lambda password, method=method: generate_password_hash(password, method=method)
+        )
+        click.echo(f'{method:<28} {_median_ms(lambda: hasher("secret-password"), repeat):>10.1f}')
+    
+    password_hash = hash_password('secret-password')
+    served, rejected = [], 0
+    
+    def attempt():
+        started = time.perf_counter()
+        password_pool.run(verify_password, password_hash, 'wrong-password')
+        return (time.perf_counter() - started) * 1000
+    
+    started = time.perf_counter()
+    with ThreadPoolExecutor(burst) as clients:
+        for future in [clients.submit(attempt) for _ in range(burst)]:
+            try:
+                served.append(future.result())
+            except PasswordHashBusy:
+                rejected += 1
+    elapsed = time.perf_counter() - started
+    
+    click.echo(
+        f'\nВолна из {burst} проверок ({app.config["PASSWORD_HASH_METHOD"]}, '
+        f'{app.config["PASSWORD_HASH_WORKERS"]} потоков, очередь {app.config["PASSWORD_HASH_QUEUE"]}): '
+        f'выполнено {len(served)}, отклонено {rejected}, {elapsed:.2f} с, '
+        f'p95 выполненных {_p95(served):.0f} мс'
+    )
+
+
+class _QueryCounter:
+    """Число SQL-запросов к движку, пока счетчик подключен"""
+    
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+    
+    def on_execute(self, *args):
+        self.count += 1
+    
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.on_execute)
+        return self
+    
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self.on_execute)
+
+
+def _next_page_url(client, path):
+    """Ссылка "Загрузить еще" (с курсором) со страницы дашборда; None, если страница одна"""
+    match = re.search(r'href="([^"]+)"[^>]*id="loadMore"', client.get(path).get_data(as_text=True))
+    return html.unescape(match.group(1)) if match else None
+
+
+def _bench_export(client, user_id, state):
+    """Экспорт целиком: постановка задачи и ее выполнение в этом же потоке"""
+    response = client.post('/export/notes', data={'format': 'zip'})
+    job = Job.query.filter_by(user_id=user_id, kind='export', status='queued').order_by(Job.id.desc()).first()
+    run_job(job.id)
+    state['jobs'].append(job.id)
+    return response
+
+
+def _bench_batch_action(client, user_id, state):
+    """Закрепление и открепление одних и тех же заметок по очереди"""
+    state['pin'] = not state.get('pin')
+    return client.post('/notes/batch-action', data={
+        'action': 'pin' if state['pin'] else 'unpin',
+        'note_ids': state['note_ids'],
+    })
+
+
+# Имя -> функция (client, user_id, state) -> ответ
+BENCH_ENDPOINTS = {
+    'dashboard': lambda client, user_id, state: client.get('/dashboard'),
+    'dashboard_filter': lambda client, user_id, state: client.get(state['title_page2']),
+    'search': lambda client, user_id, state: client.get('/dashboard?search=проект клие'),
+    'api_search': lambda client, user_id, state: client.get('/api/v1/search?q=проект'),
+    'api_stats': lambda client, user_id, state: client.get('/api/stats'),
+    'stats_page': lambda client, user_id, state: client.get('/stats'),
+    'export': _bench_export,
+    'batch_action': _bench_batch_action,
+}
+
+
+def _bench_regressions(results, baseline, tolerance):
+    """Эндпоинты, у которых p95 вырос больше чем на tolerance или стало больше запросов"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f'{name}: p95 {base["p95_ms"]:.1f} -> {result["p95_ms"]:.1f} мс')
+        if result['queries'] > base['queries']:
+            regressions.append(f'{name}: запросов SQL {base["queries"]} -> {result["queries"]}')
+    return regressions
+
+
+@bench_cli.command('endpoints')
+@click.option('--user', 'username', help='Готовый пользователь (например, из flask seed); '
+                                         'по умолчанию - временный с --notes заметками')
+@click.option('--notes', default=5000, help='Заметок у временного пользователя')
+@click.option('--repeat', default=20, help='Запросов к каждому эндпоинту')
+@click.option('--endpoints', default=','.join(BENCH_ENDPOINTS), help='Эндпоинты через запятую')
+@click.option('--save', type=click.Path(dir_okay=False), help='Сохранить результаты в JSON')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False),
+              help='Сравнить с сохраненными результатами; при регрессии код выхода 1')
+@click.option('--tolerance', default=0.25, help='Допустимый рост p95 относительно --baseline')
+def bench_endpoints(username, notes, repeat, endpoints, save, baseline, tolerance):
+    """p50/p95 и число SQL-запросов горячих эндпоинтов через тестовый клиент"""
+    names = [name.strip() for name in endpoints.split(',') if name.strip()]
+    unknown = set(names) - set(BENCH_ENDPOINTS)
+    if unknown:
+        raise click.ClickException(f'Неизвестные эндпоинты: {", ".join(sorted(unknown))}')
+    
+    temporary = username is None
+    if temporary:
+        user = _bench_user()
+        _seed_user(user, notes, 6, 5000, random.Random(42))
+    else:
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.ClickException(f'Пользователь {username} не найден')
+    
+    # Задачи экспорта выполняет сам замер, а не фоновые потоки
+    jobs_enabled, app.config['JOBS_ENABLED'] = app.config['JOBS_ENABLED'], False
+    client = app.test_client()
+    with client.session_transaction() as client_session:
+        client_session['_user_id'] = str(user.id)
+        client_session['_fresh'] = True
+    
+    state = {
+        'jobs': [],
+        'note_ids': [str(note_id) for note_id in db.session.scalars(
+            db.select(Note.id).where(Note.user_id == user.id).order_by(Note.id).limit(50)
+        )],
+    }
+    # Вторая страница по курсору из ссылки первой (у маленького пользователя - первая)
+    state['title_page2'] = _next_page_url(client, '/dashboard?sort=title') or '/dashboard?sort=title'
+    total = db.session.scalar(db.select(db.func.count(Note.id)).where(Note.user_id == user.id))
+    click.echo(f'Пользователь {user.username}, заметок: {total}, повторов: {repeat}\n')
+    click.echo(f'{"эндпоинт":<18} {"статус":>6} {"p50, мс":>9} {"p95, мс":>9} {"запросов SQL":>13}')
+    
+    results = {}
+    try:
+        for name in names:
+            timings, queries, statuses = [], [], set()
+            for _ in range(repeat):
+                # Свой контекст приложения на запрос, как в работающем сервере:
+                # иначе g и сессия базы переживали бы запрос
+                with app.app_context(), _QueryCounter(db.engine) as counter:
+                    started = time.perf_counter()
+                    response = BENCH_ENDPOINTS[name](client, user.id, state)
+                    timings.append((time.perf_counter() - started) * 1000)
+                queries.append(counter.count)
+                statuses.add(response.status_code)
+            
+            results[name] = {
+                'status': sorted(statuses),
+                'p50_ms': round(statistics.median(timings), 2),
+                'p95_ms': round(_p95(timings), 2),
+                'queries': int(statistics.median(queries)),
+            }
+            status = ','.join(str(code) for code in sorted(statuses))
+            click.echo(
+                f'{name:<18} {status:>6} {results[name]["p50_ms"]:>9.1f} '
+                f'{results[name]["p95_ms"]:>9.1f} {results[name]["queries"]:>13}'
+            )
+    finally:
+        app.config['JOBS_ENABLED'] = jobs_enabled
+        for job in Job.query.filter(Job.id.in_(state['jobs'])):
+            if job.result_path and os.path.exists(job.result_path):
+                os.remove(job.result_path)
+            db.session.delete(job)
+        db.session.commit()
+        if temporary:
+            _drop_bench_user(user)
+    
+    if save:
+        with open(save, 'w', encoding='utf-8') as output:
+            json.dump(results, output, ensure_ascii=False, indent=2)
+        click.echo(f'\nРезультаты сохранены в {save}')
+    
+    if baseline:
+        with open(baseline, encoding='utf-8') as stream:
+            regressions = _bench_regressions(results, json.load(stream), tolerance)
+        if regressions:
+            raise click.ClickException('Регрессии:\n  ' + '\n  '.join(regressions))
+        click.echo('\nРегрессий относительно базовых результатов нет')
+
+
+class _PoolWSGIServer(BaseWSGIServer):
+    """WSGI-сервер с фиксированным пулом потоков, как воркер gunicorn --threads"""
+    
+    def __init__(self, host, port, wsgi_app, threads):
+        super().__init__(host, port, wsgi_app)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+    
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process, request, client_address)
+    
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def _serve_wsgi_pool(port, threads):
+    _PoolWSGIServer('127.0.0.1', port, app, threads).serve_forever()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _start_server(mode, port, threads, env):
+    """Сервер в отдельном процессе: WSGI с пулом потоков или uvicorn с asgi.py"""
+    if mode == 'wsgi':
+        command = [sys.executable, '-c', f'import bench; bench._serve_wsgi_pool({port}, {threads})']
+    else:
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:application', '--port', str(port),
+                   '--log-level', 'warning', '--backlog', '4096']
+    process = subprocess.Popen(command, cwd=app.root_path, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise click.ClickException(f'Сервер {mode} не запустился')
+
+
+def _p95(values):
+    return sorted(values)[int(len(values) * 0.95)] if values else float('nan')
+
+
+async def _http_get(port, path, cookie, timeout):
+    """Время ответа на GET в мс или None при таймауте"""
+    started = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: bench\r\nCookie: {cookie}\r\n'
+                     f'Connection: close\r\n\r\n'.encode())
+        await writer.drain()
+        await asyncio.wait_for(reader.read(), timeout)
+        writer.close()
+    except (OSError, asyncio.TimeoutError):
+        return None
+    return (time.perf_counter() - started) * 1000
+
+
+async def _measure_connections(port, cookie, clients, hold, trigger):
+    """Открывает clients SSE-соединений, замеряет /api/stats под нагрузкой и доставку события"""
+    connected, notified = [], []
+    writers = []
+    
+    async def listen():
+        started = time.perf_counter()
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writers.append(writer)
+            writer.write(f'GET /api/events HTTP/1.1\r\nHost: bench\r\nCookie: {cookie}\r\n\r\n'.encode())
+            await writer.drain()
+            await asyncio.wait_for(reader.readuntil(b'\n\n'), hold)
+            connected.append((time.perf_counter() - started) * 1000)
+            await asyncio.wait_for(reader.readuntil(b'notes-changed'), hold * 2)
+            notified.append(time.perf_counter())
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            pass
+    
+    listeners = [asyncio.create_task(listen()) for _ in range(clients)]
+    await asyncio.sleep(hold)
+    
+    # Изменение заметки и обычные запросы, пока соединения открыты
+    changed_at = time.perf_counter()
+    await asyncio.to_thread(trigger)
+    latencies = await asyncio.gather(*[_http_get(port, '/api/stats', cookie, hold) for _ in range(10)])
+    await asyncio.gather(*listeners)
+    for writer in writers:
+        writer.close()
+    
+    delivery = [(moment - changed_at) * 1000 for moment in notified]
+    return connected, latencies, delivery
+
+
+@bench_cli.command('connections')
+@click.option('--clients', default=500, help='Одновременных SSE-соединений')
+@click.option('--threads', default=32, help='Потоков WSGI-воркера (как gunicorn --threads)')
+@click.option('--hold', default=5.0, help='Ожидание подключения и ответа, с')
+@click.option('--modes', default='wsgi,asgi', help='Серверы через запятую')
+def bench_connections(clients, threads, hold, modes):
+    """Сколько открытых соединений /api/events выдерживает WSGI-воркер и asgi.py"""
+    user = _bench_user()
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookie = f"{app.config['SESSION_COOKIE_NAME']}={serializer.dumps({'_user_id': str(user.id), '_fresh': True})}"
+    env = dict(os.environ, AUTO_MIGRATE='false', SSE_MAX_SECONDS=str(hold * 4),
+               DATABASE_URL=app.config['SQLALCHEMY_DATABASE_URI'])
+    
+    def trigger():
+        with app.app_context():
+            note = Note(title='bench', content='bench', user_id=user.id)
+            db.session.add(note)
+            record_change(user.id, note)
+            db.session.commit()
+    
+    click.echo(f'{"сервер":>7} {"подключено":>11} {"подкл. p95, мс":>15} '
+               f'{"/api/stats p50, мс":>19} {"ответов":>8} {"событие p95, мс":>16}')
+    try:
+        for mode in modes.split(','):
+            port = _free_port()
+            process = _start_server(mode, port, threads, env)
+            try:
+                connected, latencies, delivery = asyncio.run(
+                    _measure_connections(port, cookie, clients, hold, trigger)
+                )
+            finally:
+                process.kill()
+                process.wait()
+            
+            answered = [value for value in latencies if value is not None]
+            click.echo(
+                f'{mode:>7} {len(connected):>5}/{clients:<5} {_p95(connected):>15.1f} '
+                f'{statistics.median(answered) if answered else float("nan"):>19.1f} '
+                f'{len(answered):>4}/{len(latencies):<3} {_p95(delivery):>16.1f}'
+            )
+    finally:
+        _drop_bench_user(user)
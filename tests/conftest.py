@@ -0,0 +1,80 @@
+"""Общие фикстуры: приложение на временной SQLite-базе, пользователь, счетчик запросов"""
+import os
+import tempfile
+
+import pytest
+from sqlalchemy import event
+
+# Приложение читает настройки и создает схему при импорте
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='noteflow-test-'), 'notes.db')
+os.environ['JOBS_ENABLED'] = 'false'
+os.environ['USER_CACHE_BACKEND'] = 'memory'
+os.environ['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'  # быстрые хеши в тестах
+
+from app import app as flask_app, db, User  # noqa: E402
+
+PASSWORD = 'password123'
+
+
+class QueryCounter:
+    """Число SQL-запросов к движку внутри блока with"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def on_execute(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(self.engine, 'before_cursor_execute', self.on_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self.on_execute)
+
+
+@pytest.fixture
+def app():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        yield flask_app
+        db.session.rollback()
+
+
+@pytest.fixture
+def make_user(app):
+    """Новый пользователь с паролем PASSWORD; каждый тест работает со своими данными"""
+    def make(**fields):
+        suffix = os.urandom(4).hex()
+        user = User(username=f'user_{suffix}', email=f'{suffix}@example.com', **fields)
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        db.session.commit()
+        return user
+    return make
+
+
+@pytest.fixture
+def user(make_user):
+    return make_user()
+
+
+def log_in(client, user):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+
+
+@pytest.fixture
+def client(app, user):
+    """Тестовый клиент, вошедший как user"""
+    client = app.test_client()
+    log_in(client, user)
+    return client
+
+
+@pytest.fixture
+def query_counter(app):
+    return QueryCounter(db.engine)
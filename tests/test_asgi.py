@@ -0,0 +1,108 @@
+"""Async-эндпоинты asgi.py: вход как во Flask и общий с ним ETag"""
+import asyncio
+
+from flask_login.utils import encode_cookie
+
+import asgi
+from app import app, db, Note
+
+
+async def call(path, cookies=(), headers=(), query_string=''):
+    """GET через ASGI-приложение: (статус, заголовки)"""
+    cookie = '; '.join(f'{name}={value}' for name, value in cookies)
+    scope = {
+        'type': 'http',
+        'method': 'GET',
+        'path': path,
+        'query_string': query_string.encode(),
+        'headers': [(b'cookie', cookie.encode()), *[(name.encode(), value.encode()) for name, value in headers]],
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi.application(scope, receive, send)
+    return messages[0]['status'], {name.decode(): value.decode() for name, value in messages[0]['headers']}
+
+
+def session_cookie(**session):
+    serializer = app.session_interface.get_signing_serializer(app)
+    return app.config['SESSION_COOKIE_NAME'], serializer.dumps(session)
+
+
+def remember_cookie(user):
+    return app.config.get('REMEMBER_COOKIE_NAME', 'remember_token'), encode_cookie(str(user.id))
+
+
+def create_note(user):
+    note = Note(title='Заметка', content='Текст', user_id=user.id)
+    db.session.add(note)
+    db.session.commit()
+    return note
+
+
+def status(path, *cookies):
+    return asyncio.run(call(path, cookies))[0]
+
+
+def test_session_cookie(user):
+    note = create_note(user)
+    assert status(f'/api/v1/notes/{note.id}', session_cookie(_user_id=str(user.id))) == 200
+
+
+def test_remember_cookie_without_session(user):
+    note = create_note(user)
+    assert status(f'/api/v1/notes/{note.id}', remember_cookie(user)) == 200
+
+
+def test_remember_cookie_after_logout(user):
+    note = create_note(user)
+    cookies = [remember_cookie(user), session_cookie(_remember='clear')]
+    assert status(f'/api/v1/notes/{note.id}', *cookies) == 401
+
+
+def test_forged_cookies(user):
+    note = create_note(user)
+    name, value = remember_cookie(user)
+    assert status(f'/api/v1/notes/{note.id}', (name, value[:-1] + '0')) == 401
+    assert status(f'/api/v1/notes/{note.id}', (app.config['SESSION_COOKIE_NAME'], 'garbage')) == 401
+
+
+def test_deleted_user(make_user):
+    user = make_user()
+    cookie = session_cookie(_user_id=str(user.id))
+    db.session.delete(user)
+    db.session.commit()
+    assert status('/api/stats', cookie) == 401
+
+
+def test_note_etag_matches_flask(client, user):
+    note = create_note(user)
+    flask_response = client.get(f'/api/v1/notes/{note.id}?fields=title')
+    cookie = session_cookie(_user_id=str(user.id))
+
+    code, headers = asyncio.run(call(f'/api/v1/notes/{note.id}', [cookie], query_string='fields=title'))
+    assert code == 200
+    assert headers['etag'] == flask_response.headers['ETag']
+
+    code, _ = asyncio.run(call(f'/api/v1/notes/{note.id}', [cookie], [('if-none-match', headers['etag'])],
+                               query_string='fields=title'))
+    assert code == 304
+
+
+def test_async_engine_can_write_notes(user):
+    """Триггеры поиска вызывают noteflow_plaintext - она есть и у соединений aiosqlite"""
+    note = create_note(user)
+
+    async def update():
+        async with asgi.engine.begin() as connection:
+            await connection.execute(db.update(Note).where(Note.id == note.id).values(title='Из asgi'))
+        await asgi.engine.dispose()
+
+    asyncio.run(update())
+    db.session.expire_all()
+    assert db.session.get(Note, note.id).title == 'Из asgi'
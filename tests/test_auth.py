@@ -0,0 +1,112 @@
+"""Вход и сброс пароля: ограничение частоты, пересчет хеша, хранение токенов"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as noteflow
+from app import db, find_reset_token, hash_reset_token, issue_reset_token, PasswordResetToken
+from conftest import PASSWORD
+
+
+@pytest.fixture(autouse=True)
+def fresh_limits(monkeypatch):
+    """Свои корзины на каждый тест: лимиты не переносятся между тестами"""
+    monkeypatch.setattr(noteflow, 'login_ip_limit', noteflow.create_token_bucket('20/60'))
+    monkeypatch.setattr(noteflow, 'login_user_limit', noteflow.create_token_bucket('3/60'))
+
+
+def log_in(client, user, password):
+    return client.post('/login', data={'username': user.username, 'password': password})
+
+
+def test_failed_logins_are_limited_per_user(app, make_user):
+    user, other = make_user(), make_user()
+    client = app.test_client()
+
+    for _ in range(3):
+        assert log_in(client, user, 'wrong').status_code == 200
+    response = log_in(client, user, PASSWORD)
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) > 0
+
+    # Лимит по имени не задевает других пользователей
+    assert log_in(client, other, PASSWORD).status_code == 302
+
+
+def test_successful_login_resets_user_limit(app, user):
+    client = app.test_client()
+    for _ in range(2):
+        log_in(client, user, 'wrong')
+    assert log_in(client, user, PASSWORD).status_code == 302
+    for _ in range(2):
+        log_in(client, user, 'wrong')
+    assert log_in(client, user, PASSWORD).status_code == 302
+
+
+def test_login_rehashes_outdated_hash(app, user, monkeypatch):
+    old_hash = user.password_hash
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_METHOD', 'pbkdf2:sha256:2000')
+
+    assert log_in(app.test_client(), user, PASSWORD).status_code == 302
+    db.session.refresh(user)
+    assert user.password_hash != old_hash
+    assert user.password_hash.startswith('pbkdf2:sha256:2000$')
+    assert user.check_password(PASSWORD)
+
+    # Хеш с текущими параметрами не пересчитывается
+    current_hash = user.password_hash
+    log_in(app.test_client(), user, PASSWORD)
+    db.session.refresh(user)
+    assert user.password_hash == current_hash
+
+
+def test_reset_token_is_stored_hashed(user):
+    token = issue_reset_token(user)
+    db.session.commit()
+
+    stored = db.session.execute(
+        db.text('SELECT token FROM password_reset_token WHERE user_id = :id'), {'id': user.id}
+    ).scalar()
+    assert stored == hash_reset_token(token) != token
+    assert find_reset_token(token).user_id == user.id
+    assert find_reset_token(stored) is None
+
+
+def test_reset_token_works_once(app, user):
+    token = issue_reset_token(user)
+    other_token = issue_reset_token(user)
+    db.session.commit()
+    client = app.test_client()
+    data = {'password': 'new-password', 'confirm_password': 'new-password'}
+
+    assert client.get(f'/reset-password/{token}').status_code == 200
+    response = client.post(f'/reset-password/{token}', data=data)
+    assert response.headers['Location'].endswith('/login')
+    db.session.refresh(user)
+    assert user.check_password('new-password')
+
+    # Использованы и этот токен, и остальные ссылки пользователя
+    for used in (token, other_token):
+        response = client.post(f'/reset-password/{used}', data={'password': 'x' * 8, 'confirm_password': 'x' * 8})
+        assert response.headers['Location'].endswith('/forgot-password')
+    db.session.refresh(user)
+    assert user.check_password('new-password')
+
+
+def test_expired_reset_token_is_rejected(app, user):
+    token = issue_reset_token(user)
+    db.session.commit()
+    find_reset_token(token).expires_at = datetime.utcnow() - timedelta(minutes=1)
+    db.session.commit()
+
+    response = app.test_client().get(f'/reset-password/{token}')
+    assert response.headers['Location'].endswith('/forgot-password')
+
+
+def test_old_tokens_beyond_limit_are_dropped(app, user):
+    tokens = [issue_reset_token(user) for _ in range(app.config['RESET_TOKENS_PER_USER'] + 2)]
+    db.session.commit()
+
+    assert PasswordResetToken.query.filter_by(user_id=user.id).count() == app.config['RESET_TOKENS_PER_USER']
+    assert find_reset_token(tokens[-1]) is not None
+    assert find_reset_token(tokens[0]) is None
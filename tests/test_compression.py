@@ -0,0 +1,68 @@
+"""Сжатие длинного содержания заметок: значение колонки и обратное преобразование"""
+import pytest
+
+from app import (
+    app, db, compress_content, compress_notes, decompress_content, search_subquery,
+    CONTENT_MARKER, Note
+)
+
+LONG_TEXT = '\n'.join(f'строка {i}: заметка о проекте и его задачах' for i in range(400))
+
+
+def stored_content(note_id):
+    """Значение колонки как оно лежит в базе"""
+    return db.session.execute(db.text('SELECT content FROM note WHERE id = :id'), {'id': note_id}).scalar()
+
+
+@pytest.mark.parametrize('text', [
+    '',
+    'коротко',
+    LONG_TEXT,
+    CONTENT_MARKER + 'текст, похожий на сжатый',
+    'ё' * 10000,
+])
+def test_round_trip(text):
+    assert decompress_content(compress_content(text)) == text
+
+
+def test_only_long_text_is_compressed():
+    assert compress_content('коротко') == 'коротко'
+    assert compress_content(LONG_TEXT).startswith(CONTENT_MARKER)
+    assert len(compress_content(LONG_TEXT)) < len(LONG_TEXT)
+
+
+def test_note_column_is_compressed_transparently(user):
+    note = Note(title='длинная', content=LONG_TEXT, user_id=user.id)
+    db.session.add(note)
+    db.session.commit()
+
+    assert stored_content(note.id).startswith(CONTENT_MARKER)
+    db.session.expire_all()
+    note = db.session.get(Note, note.id)
+    assert note.content == LONG_TEXT
+    assert note.preview.startswith('строка 0')
+    # Триггер индекса читает текст через noteflow_plaintext
+    search = search_subquery('задачах')
+    assert note.id in set(db.session.scalars(db.select(search.c.note_id)))
+
+
+def test_compress_notes_follows_settings(user, monkeypatch):
+    note = Note(title='длинная', content=LONG_TEXT, user_id=user.id)
+    db.session.add(note)
+    db.session.commit()
+    updated_at = note.updated_at
+
+    monkeypatch.setitem(app.config, 'CONTENT_COMPRESSION', 'none')
+    report = compress_notes()
+    assert report['changed'] >= 1
+    assert stored_content(note.id) == LONG_TEXT
+
+    monkeypatch.setitem(app.config, 'CONTENT_COMPRESSION', 'zlib')
+    compress_notes()
+    assert stored_content(note.id).startswith(CONTENT_MARKER)
+    assert compress_notes()['changed'] == 0
+
+    db.session.expire_all()
+    note = db.session.get(Note, note.id)
+    assert note.content == LONG_TEXT
+    assert note.updated_at == updated_at
@@ -0,0 +1,64 @@
+"""note_counter ведется при каждой записи и совпадает с пересчетом reconcile_note_counters"""
+from app import db, reconcile_note_counters, user_note_stats, Category
+
+
+def assert_consistent(user, step):
+    stats = user_note_stats(user.id)
+    assert reconcile_note_counters(user.id) == {}, step
+    return stats
+
+
+def note_id(client, **data):
+    response = client.post('/api/v1/notes', json={'content': '', **data})
+    assert response.status_code == 201, response.json
+    return response.json['data']['id']
+
+
+def test_counters_follow_every_write(client, user):
+    work = Category(name='Работа', user_id=user.id)
+    home = Category(name='Дом', user_id=user.id)
+    db.session.add_all([work, home])
+    db.session.commit()
+
+    client.post('/notes/new', data={'title': 'форма', 'category_id': str(work.id)})
+    ids = [note_id(client, title=f'n{i}', category_id=(work.id, home.id, None)[i % 3]) for i in range(6)]
+    stats = assert_consistent(user, 'create')
+    assert stats['total_notes'] == 7
+    assert stats['by_category'] == {work.id: 3, home.id: 2}
+
+    client.post(f'/notes/{ids[0]}/pin')
+    client.post(f'/notes/{ids[0]}/archive')
+    assert_consistent(user, 'pin, archive')
+
+    client.post(f'/notes/{ids[1]}/edit', data={'title': 'n1', 'category_id': str(work.id)})
+    client.patch(f'/api/v1/notes/{ids[2]}', json={'category_id': home.id, 'is_pinned': True})
+    assert_consistent(user, 'edit, patch')
+
+    for action, extra in [('pin', {}), ('archive', {}), ('move', {'target_category': str(home.id)}),
+                          ('unarchive', {'select_all': '1', 'archived': 'true'})]:
+        client.post('/notes/batch-action', data={'action': action, 'note_ids': [str(i) for i in ids[:4]], **extra})
+        assert_consistent(user, action)
+
+    client.post('/api/v1/notes/bulk', json=[{'title': 'bulk'}, {'id': ids[4], 'is_archived': True}])
+    client.post(f'/notes/{ids[5]}/delete')
+    client.delete(f'/api/v1/notes/{ids[3]}')
+    client.post('/notes/batch-action', data={'action': 'delete', 'note_ids': [str(ids[2])]})
+    assert_consistent(user, 'bulk, delete')
+
+    client.post(f'/categories/{home.id}/delete')
+    client.delete(f'/api/v1/categories/{work.id}')
+    stats = assert_consistent(user, 'delete categories')
+    # Заметки удаленных категорий остаются без категории
+    assert not any(stats['by_category'].values())
+    assert stats['total_notes'] == 5
+
+
+def test_reconcile_repairs_drift(client, user):
+    note_id(client, title='одна')
+    db.session.execute(db.text('UPDATE note_counter SET total = total + 5 WHERE user_id = :user_id'),
+                       {'user_id': user.id})
+    db.session.commit()
+
+    assert reconcile_note_counters(user.id) == {user.id: 1}
+    assert user_note_stats(user.id)['total_notes'] == 1
+    assert reconcile_note_counters(user.id) == {}
@@ -0,0 +1,75 @@
+"""Число SQL-запросов при отрисовке списка заметок не зависит от их количества"""
+import html
+import re
+
+import pytest
+
+from app import db, fragment_cache, Category, Note
+
+N = 40  # больше NOTES_PAGE_SIZE: у дашборда есть вторая страница
+COLORS = ('primary', 'success', 'danger', 'warning')
+
+
+def seed(user_id, notes, categories):
+    """Добавляет пользователю категории и заметки, разложенные по ним"""
+    new_categories = [
+        Category(name=f'Категория {i}', color=COLORS[i % len(COLORS)], user_id=user_id)
+        for i in range(categories)
+    ]
+    db.session.add_all(new_categories)
+    db.session.flush()
+    db.session.add_all(
+        Note(title=f'Заметка {i}', content=f'Текст заметки {i}', user_id=user_id,
+             category_id=new_categories[i % categories].id, tags=f'тег{i % 3}, общий',
+             is_pinned=i % 7 == 0)
+        for i in range(notes)
+    )
+    db.session.commit()
+
+
+def next_page_url(client, path):
+    """Ссылка "Загрузить еще" со страницы: следующая страница по курсору"""
+    match = re.search(r'href="([^"]+)"[^>]*id="loadMore"', client.get(path).get_data(as_text=True))
+    assert match, 'на странице нет ссылки на следующую'
+    return html.unescape(match.group(1))
+
+
+def count_queries(client, query_counter, path):
+    """Число запросов к БД за один GET; первый запрос прогревает кеши,
+    кроме карточек заметок - их отрисовка должна попасть в подсчет"""
+    assert client.get(path).status_code == 200
+    fragment_cache.clear()
+    # Запрос идет в контексте теста: без этого объекты уже лежат в сессии
+    db.session.remove()
+    with query_counter:
+        response = client.get(path)
+    assert response.status_code == 200
+    return query_counter.count
+
+
+@pytest.mark.parametrize('path, second_page', [
+    ('/', False),
+    ('/dashboard', False),
+    ('/dashboard?sort=title', True),
+])
+def test_queries_do_not_grow_with_notes(client, user, query_counter, path, second_page):
+    def page():
+        return next_page_url(client, path) if second_page else path
+
+    seed(user.id, N, N // 5)
+    small = count_queries(client, query_counter, page())
+
+    seed(user.id, 9 * N, 9 * N // 5)
+    large = count_queries(client, query_counter, page())
+
+    assert large == small
+
+
+def test_second_page_continues_after_first(client, user):
+    seed(user.id, N, N // 5)
+    first = client.get('/dashboard?sort=title').get_data(as_text=True)
+    second = client.get(next_page_url(client, '/dashboard?sort=title')).get_data(as_text=True)
+
+    titles = re.compile(r'Заметка \d+')
+    assert set(titles.findall(first)).isdisjoint(titles.findall(second))
+    assert len(set(titles.findall(first)) | set(titles.findall(second))) == N
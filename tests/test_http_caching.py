@@ -0,0 +1,36 @@
+"""Условные запросы: ETag страниц и API устаревает вместе с тем, что они показывают"""
+from app import db, Category, Note
+
+
+def create_note(user, **fields):
+    category = Category(name='Работа', color='primary', user_id=user.id)
+    db.session.add(category)
+    db.session.flush()
+    note = Note(title='Отчет', content='Текст', user_id=user.id, category_id=category.id, **fields)
+    db.session.add(note)
+    db.session.commit()
+    return note, category
+
+
+def test_note_page_is_not_modified_until_it_changes(client, user):
+    note, _ = create_note(user)
+    first = client.get(f'/notes/{note.id}')
+    assert first.status_code == 200
+
+    again = client.get(f'/notes/{note.id}', headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+
+
+def test_note_page_shows_renamed_category(client, user):
+    note, category = create_note(user)
+    first = client.get(f'/notes/{note.id}')
+    assert 'Работа' in first.get_data(as_text=True)
+
+    response = client.patch(f'/api/v1/categories/{category.id}', json={'name': 'Проекты', 'color': 'danger'})
+    assert response.status_code == 200
+
+    second = client.get(f'/notes/{note.id}', headers={'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 200
+    page = second.get_data(as_text=True)
+    assert 'Проекты' in page
+    assert 'bg-danger' in page
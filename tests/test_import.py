@@ -0,0 +1,90 @@
+"""Импорт заметок: разбор Markdown, JSON Lines и ZIP, отчет об ошибках"""
+import io
+import json
+import zipfile
+from datetime import datetime
+
+from app import (
+    db, export_chunks, import_notes, import_records, parse_markdown_export, user_note_stats,
+    Category, Note
+)
+
+
+def user_notes(user):
+    return {note.title: note for note in Note.query.filter_by(user_id=user.id)}
+
+
+def test_markdown_export_round_trip(make_user):
+    source, target = make_user(), make_user()
+    category = Category(name='Работа', user_id=source.id)
+    db.session.add(category)
+    db.session.flush()
+    db.session.add_all([
+        Note(title='Первая', content='Текст\n\n---\n\nс разделителем', tags='план, идея',
+             category_id=category.id, user_id=source.id,
+             created_at=datetime(2024, 1, 2, 3, 4), updated_at=datetime(2024, 1, 5, 6, 7)),
+        Note(title='Вторая', content='', user_id=source.id),
+    ])
+    db.session.commit()
+
+    exported = ''.join(export_chunks('md', source.id, source.username))
+    report = import_notes(target.id, parse_markdown_export(io.StringIO(exported)))
+    assert report['imported'] == 2 and report['failed'] == 0
+
+    notes = user_notes(target)
+    first = notes['Первая']
+    assert first.content == 'Текст\n\n---\n\nс разделителем'
+    assert first.tags == 'план, идея'
+    assert first.category_ref.name == 'Работа'
+    assert first.created_at == datetime(2024, 1, 2, 3, 4)
+    assert first.updated_at == datetime(2024, 1, 5, 6, 7)
+    assert notes['Вторая'].content == ''
+    assert user_note_stats(target.id)['total_notes'] == 2
+
+
+def test_jsonl_reports_bad_records(user):
+    lines = [
+        json.dumps({'title': 'Хорошая', 'tags': ['a', 'b'], 'category': 'Дом', 'is_pinned': True}),
+        '{не json',
+        json.dumps(['не', 'объект']),
+        json.dumps({'title': ''}),
+        json.dumps({'title': 'Дата', 'created_at': 'вчера'}),
+        '',
+    ]
+    stream = io.BytesIO('\n'.join(lines).encode('utf-8'))
+    report = import_notes(user.id, import_records(stream, 'notes.jsonl'))
+
+    assert report['imported'] == 1
+    assert report['failed'] == 4
+    assert [error['ref'] for error in report['errors']] == [
+        'notes.jsonl:2', 'notes.jsonl:3', 'notes.jsonl:4', 'notes.jsonl:5'
+    ]
+    note = user_notes(user)['Хорошая']
+    assert note.tags == 'a, b' and note.is_pinned and note.category_ref.name == 'Дом'
+    assert user_note_stats(user.id)['pinned_notes'] == 1
+
+
+def test_zip_and_small_batches(user):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr('a.md', '## A1\n\nтекст\n\n---\n\n## A2\n\nтекст\n')
+        archive.writestr('b.jsonl', '\n'.join(json.dumps({'title': f'B{i}'}) for i in range(3)))
+        archive.writestr('c.pdf', 'нельзя')
+    buffer.seek(0)
+
+    report = import_notes(user.id, import_records(buffer, 'export.zip'), batch_size=2)
+    assert report['imported'] == 5
+    assert report['errors'] == [{'ref': 'c.pdf', 'error': 'неподдерживаемый тип файла'}]
+    assert set(user_notes(user)) == {'A1', 'A2', 'B0', 'B1', 'B2'}
+
+
+def test_api_import(client, user):
+    data = {'file': (io.BytesIO(json.dumps({'title': 'Из API'}).encode()), 'notes.jsonl')}
+    response = client.post('/api/import', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert response.json['data']['imported'] == 1
+
+    data = {'file': (io.BytesIO(b'x'), 'notes.pdf')}
+    response = client.post('/api/import', data=data, content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert response.json['success'] is False
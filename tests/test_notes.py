@@ -0,0 +1,43 @@
+"""Создание и правка заметок через формы и API"""
+import warnings
+
+import pytest
+from sqlalchemy.exc import SAWarning
+
+from app import db, Category, Note
+
+
+@pytest.fixture
+def strict_warnings():
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', SAWarning)
+        yield
+
+
+def test_form_create_with_tags(client, user, strict_warnings):
+    response = client.post('/notes/new', data={'title': 'Форма', 'content': 'текст', 'tags': 'Работа, дом'})
+    assert response.status_code == 302
+    note = Note.query.filter_by(user_id=user.id).one()
+    assert note.tags == 'работа, дом'
+    assert sorted(tag.name for tag in note.tag_refs) == ['дом', 'работа']
+
+
+def test_api_create_with_tags(client, user, strict_warnings):
+    response = client.post('/api/v1/notes', json={'title': 'API', 'content': 'текст', 'tags': ['a', 'b']})
+    assert response.status_code == 201, response.json
+    note = db.session.get(Note, response.json['data']['id'])
+    assert sorted(tag.name for tag in note.tag_refs) == ['a', 'b']
+
+
+def test_edit_keeps_only_own_category(client, user, make_user):
+    own = Category(name='Своя', user_id=user.id)
+    foreign = Category(name='Чужая', user_id=make_user().id)
+    note = Note(title='Заметка', content='', user_id=user.id)
+    db.session.add_all([own, foreign, note])
+    db.session.commit()
+
+    for value, expected in [(str(own.id), own.id), ('', None), (str(foreign.id), None), ('abc', None)]:
+        response = client.post(f'/notes/{note.id}/edit', data={'title': 'Заметка', 'category_id': value})
+        assert response.status_code == 302
+        db.session.expire_all()
+        assert db.session.get(Note, note.id).category_id == expected, value
@@ -0,0 +1,90 @@
+"""Постраничная выдача по курсору: кодирование курсора и порядок при равных ключах"""
+import base64
+import json
+from datetime import datetime
+
+import pytest
+
+from app import db, decode_cursor, encode_cursor, Category, Note
+
+SAME_TIME = datetime(2024, 5, 1, 12, 0, 0)
+COLUMNS = [Note.is_pinned, Note.updated_at, Note.id]
+
+
+def raw_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def test_cursor_round_trip():
+    values = [True, datetime(2024, 5, 1, 12, 30, 15, 123456), 42]
+    assert decode_cursor(encode_cursor(values), COLUMNS) == values
+
+
+@pytest.mark.parametrize('cursor', [
+    raw_cursor([{'a': 1}, {'b': 2}]),
+    raw_cursor([True, '2024-05-01T12:00:00']),
+    raw_cursor([True, '2024-05-01T12:00:00', '7']),
+    raw_cursor([1, '2024-05-01T12:00:00', 7]),
+    raw_cursor([True, 'вчера', 7]),
+    raw_cursor([True, '2024-05-01T12:00:00', True]),
+    raw_cursor({'id': 7}),
+    'не base64',
+])
+def test_invalid_cursor_is_rejected(cursor):
+    assert decode_cursor(cursor, COLUMNS) is None
+
+
+def collect(client, url):
+    """Все страницы API-списка: id по порядку"""
+    ids, cursor = [], None
+    while True:
+        response = client.get(url + (f'&cursor={cursor}' if cursor else ''))
+        assert response.status_code == 200, response.json
+        ids += [item['id'] for item in response.json['data']]
+        cursor = response.json['next_cursor']
+        if not cursor:
+            return ids
+
+
+def test_equal_sort_keys_page_without_gaps(client, user):
+    notes = [
+        Note(title='Одинаковый', content='', user_id=user.id, updated_at=SAME_TIME, is_pinned=i % 4 == 0)
+        for i in range(23)
+    ]
+    db.session.add_all(notes)
+    db.session.commit()
+    pinned = sorted((note.id for note in notes if note.is_pinned), reverse=True)
+    others = sorted((note.id for note in notes if not note.is_pinned), reverse=True)
+
+    # По обновлению: закрепленные первыми, при равном времени - id по убыванию
+    assert collect(client, '/api/v1/notes?limit=5&sort=updated') == pinned + others
+    # По названию при равных названиях - id по возрастанию
+    assert collect(client, '/api/v1/notes?limit=4&sort=title') == sorted(pinned) + sorted(others)
+
+
+def test_categories_page_by_id(client, user):
+    categories = [Category(name=f'К{i}', user_id=user.id) for i in range(7)]
+    db.session.add_all(categories)
+    db.session.commit()
+    ids, cursor = [], None
+    while True:
+        response = client.get('/api/v1/categories?limit=3' + (f'&cursor={cursor}' if cursor else ''))
+        ids += [item['id'] for item in response.json['data']]
+        cursor = response.json['next_cursor']
+        if not cursor:
+            break
+    assert ids == sorted(category.id for category in categories)
+
+
+def test_bad_cursor_is_400_in_api_and_ignored_in_html(client, user):
+    db.session.add(Note(title='Одна', content='', user_id=user.id))
+    db.session.commit()
+    cursor = raw_cursor([{'a': 1}, {'b': 2}])
+
+    response = client.get(f'/api/v1/notes?cursor={cursor}')
+    assert response.status_code == 400
+    assert response.json == {'success': False, 'error': 'Неверный курсор'}
+
+    response = client.get(f'/dashboard?cursor={cursor}')
+    assert response.status_code == 200
+    assert 'Одна' in response.get_data(as_text=True)
@@ -0,0 +1,21 @@
+"""Запросы дашборда идут по индексам (то же, что flask db-explain)"""
+import pytest
+
+from app import db, explain_checks, explain_rows, plan_uses_index, Note
+
+
+@pytest.mark.parametrize('name', [
+    'дашборд, по обновлению',
+    'дашборд, по созданию',
+    'дашборд, по названию',
+    'дашборд, категория',
+    'статистика',
+])
+def test_query_uses_index(app, name):
+    plan = explain_rows(explain_checks()[name])
+    assert plan_uses_index(plan), '\n'.join(plan)
+
+
+def test_full_scan_is_detected(app):
+    plan = explain_rows(db.select(Note.id).where(Note.content == 'x'))
+    assert not plan_uses_index(plan)
@@ -0,0 +1,98 @@
+"""История версий заметок"""
+import hashlib
+
+from app import app, db, load_revisions, revision_diff, Note, NoteRevision
+
+
+def create_note(user, title='Заметка', content='первая строка\nвторая строка'):
+    note = Note(title=title, content=content, user_id=user.id)
+    db.session.add(note)
+    db.session.commit()
+    return note
+
+
+def revision_count(note):
+    return NoteRevision.query.filter_by(note_id=note.id).count()
+
+
+def test_edit_records_previous_text(client, user):
+    note = create_note(user)
+    response = client.post(f'/notes/{note.id}/edit', data={'title': 'Новая', 'content': 'другой текст'})
+    assert response.status_code == 302
+    # Исходное состояние и новая версия
+    assert revision_count(note) == 2
+
+
+def test_invalid_edit_records_nothing(client, user):
+    note = create_note(user)
+    response = client.post(f'/notes/{note.id}/edit', data={'title': '  ', 'content': 'другой текст'})
+    assert response.status_code == 302
+    # Запрос идет в сессии теста: ничего не должно было в нее попасть
+    assert not db.session.new
+    assert not db.session.dirty
+    db.session.rollback()
+    assert revision_count(note) == 0
+    assert db.session.get(Note, note.id).content == 'первая строка\nвторая строка'
+
+
+def test_api_patch_records_revision_only_for_text(client, user):
+    note = create_note(user)
+    assert client.patch(f'/api/v1/notes/{note.id}', json={'is_pinned': True}).status_code == 200
+    assert revision_count(note) == 0
+
+    assert client.patch(f'/api/v1/notes/{note.id}', json={'title': ''}).status_code == 400
+    db.session.rollback()
+    assert revision_count(note) == 0
+
+    assert client.patch(f'/api/v1/notes/{note.id}', json={'content': 'новое'}).status_code == 200
+    assert revision_count(note) == 2
+
+
+def test_bulk_update_records_revision(client, user):
+    note = create_note(user)
+    response = client.post('/api/v1/notes/bulk', json=[
+        {'id': note.id, 'title': 'Массово'},
+        {'title': 'Новая из bulk'},
+    ])
+    assert response.status_code == 200, response.json
+    assert revision_count(note) == 2
+
+
+def version_text(i):
+    """Плохо сжимаемый текст: разница с соседней версией меньше снимка"""
+    lines = [hashlib.sha256(str(n).encode()).hexdigest() for n in range(30)]
+    lines[i % 30] = f'правка {i}'
+    lines.insert(i % 7, f'вставка {i}')
+    return '\n'.join(lines)
+
+
+def test_deltas_rebuild_every_kept_version(client, user, monkeypatch):
+    monkeypatch.setitem(app.config, 'NOTE_REVISIONS_KEEP', 5)
+    monkeypatch.setitem(app.config, 'NOTE_REVISION_SNAPSHOT_EVERY', 3)
+    note = create_note(user, content=version_text(0))
+    expected = {1: version_text(0)}
+    for i in range(1, 13):
+        assert client.patch(f'/api/v1/notes/{note.id}', json={'content': version_text(i)}).status_code == 200
+        expected[i + 1] = version_text(i)
+
+    numbers = sorted(revision.number for revision in NoteRevision.query.filter_by(note_id=note.id))
+    assert numbers == list(range(9, 14))
+
+    loaded = load_revisions(note.id, numbers)
+    assert {number: content for number, (_, content) in loaded.items()} == {n: expected[n] for n in numbers}
+    # Самая старая из оставшихся - снимок, остальные хранятся разницами
+    assert loaded[9][0].base_number is None
+    assert any(revision.base_number is not None for revision, _ in loaded.values())
+
+
+def test_revision_diff_and_page(client, user):
+    note = create_note(user, content='первая строка\nвторая строка')
+    client.patch(f'/api/v1/notes/{note.id}', json={'content': 'первая строка\nновая вторая'})
+
+    _, old_title, lines = revision_diff(note.id, 2)
+    assert old_title == 'Заметка'
+    assert ('del', 'вторая строка') in lines
+    assert ('add', 'новая вторая') in lines
+
+    assert client.get(f'/notes/{note.id}?revision=2').status_code == 200
+    assert client.get(f'/notes/{note.id}?revision=99').status_code == 302
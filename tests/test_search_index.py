@@ -0,0 +1,70 @@
+"""Полнотекстовый индекс следует за заметками: правка, удаление, массовые действия с тегами"""
+from app import app, db, rebuild_search_index, search_subquery, Note
+
+
+def found(user, query):
+    """id заметок пользователя, которые находит поиск"""
+    search = search_subquery(query)
+    return set(db.session.scalars(
+        db.select(Note.id).join(search, search.c.note_id == Note.id).where(Note.user_id == user.id)
+    ))
+
+
+def create_notes(user, *titles, **fields):
+    notes = [Note(title=title, content=f'содержание {title}', user_id=user.id, **fields) for title in titles]
+    db.session.add_all(notes)
+    db.session.commit()
+    return notes
+
+
+def test_edit_reindexes_title_content_and_tags(client, user):
+    note, = create_notes(user, 'черновик')
+    assert found(user, 'черновик') == {note.id}
+
+    client.post(f'/notes/{note.id}/edit', data={'title': 'итог', 'content': 'финальный текст', 'tags': 'релиз'})
+    assert found(user, 'черновик') == set()
+    assert found(user, 'финальный') == {note.id}
+    assert found(user, 'релиз') == {note.id}
+
+
+def test_compressed_content_is_indexed(client, user):
+    long_text = 'абзац ' * 2000 + 'иголка'
+    assert len(long_text) > app.config['CONTENT_COMPRESSION_MIN']
+    response = client.post('/api/v1/notes', json={'title': 'длинная', 'content': long_text})
+    note_id = response.json['data']['id']
+    assert found(user, 'иголка') == {note_id}
+
+    client.patch(f'/api/v1/notes/{note_id}', json={'content': long_text.replace('иголка', 'стог')})
+    assert found(user, 'иголка') == set()
+    assert found(user, 'стог') == {note_id}
+
+
+def test_delete_removes_from_index(client, user):
+    kept, deleted = create_notes(user, 'оставить', 'удалить')
+    client.post(f'/notes/{deleted.id}/delete')
+    assert found(user, 'содержание') == {kept.id}
+
+
+def test_batch_tag_changes_are_indexed(client, user):
+    first, second, third = create_notes(user, 'один', 'два', 'три')
+    ids = [str(first.id), str(second.id)]
+
+    client.post('/notes/batch-action', data={'action': 'add_tag', 'tag_name': 'срочно', 'note_ids': ids})
+    assert found(user, 'срочно') == {first.id, second.id}
+
+    # Все заметки под фильтром по тегу: цели определяются до изменения тегов
+    client.post('/notes/batch-action', data={'action': 'remove_tag', 'tag_name': 'срочно',
+                                             'select_all': '1', 'tag': 'срочно'})
+    assert found(user, 'срочно') == set()
+
+    client.post('/notes/batch-action', data={'action': 'delete', 'note_ids': [str(third.id)]})
+    assert found(user, 'содержание') == {first.id, second.id}
+
+
+def test_rebuild_matches_triggers(client, user):
+    notes = create_notes(user, 'альфа', 'бета')
+    client.post('/notes/batch-action', data={'action': 'add_tag', 'tag_name': 'общий',
+                                             'note_ids': [str(note.id) for note in notes]})
+    before = {query: found(user, query) for query in ('альфа', 'бета', 'общий', 'содержание')}
+    rebuild_search_index()
+    assert {query: found(user, query) for query in before} == before
@@ -0,0 +1,88 @@
+"""Синхронизация: изменения после курсора и надгробия удаленных заметок и категорий"""
+from app import db, Category, Note
+
+
+def sync(client, since, limit=None):
+    """Все страницы /api/v1/sync после since: (данные, новый курсор)"""
+    data = {'notes': {}, 'categories': {}, 'deleted_notes': set(), 'deleted_categories': set()}
+    while True:
+        response = client.get(f'/api/v1/sync?since={since}' + (f'&limit={limit}' if limit else ''))
+        assert response.status_code == 200, response.json
+        page = response.json['data']
+        data['notes'].update((note['id'], note) for note in page['notes'])
+        data['categories'].update((category['id'], category) for category in page['categories'])
+        data['deleted_notes'].update(page['deleted_notes'])
+        data['deleted_categories'].update(page['deleted_categories'])
+        assert response.json['cursor'] >= since
+        since = response.json['cursor']
+        if not response.json['has_more']:
+            return data, since
+
+
+class Replica:
+    """Клиентская копия данных, которая обновляется только через sync"""
+
+    def __init__(self, client):
+        self.client = client
+        self.cursor = 0
+        self.notes, self.categories = {}, {}
+
+    def pull(self, limit=None):
+        data, self.cursor = sync(self.client, self.cursor, limit)
+        self.notes.update(data['notes'])
+        self.categories.update(data['categories'])
+        for note_id in data['deleted_notes']:
+            self.notes.pop(note_id, None)
+        for category_id in data['deleted_categories']:
+            self.categories.pop(category_id, None)
+        return data
+
+
+def server_state(user):
+    db.session.expire_all()
+    notes = {note.id: (note.title, note.category_id, note.is_pinned) for note in Note.query.filter_by(user_id=user.id)}
+    categories = {category.id: category.name for category in Category.query.filter_by(user_id=user.id)}
+    return notes, categories
+
+
+def replica_state(replica):
+    return (
+        {note_id: (note['title'], note['category_id'], note['is_pinned']) for note_id, note in replica.notes.items()},
+        {category_id: category['name'] for category_id, category in replica.categories.items()},
+    )
+
+
+def test_replica_converges(client, user):
+    replica = Replica(client)
+    category = client.post('/api/v1/categories', json={'name': 'Работа'}).json['data']
+    ids = [client.post('/api/v1/notes', json={'title': f'n{i}', 'content': '', 'category_id': category['id']})
+           .json['data']['id'] for i in range(12)]
+    replica.pull(limit=5)
+    assert replica_state(replica) == server_state(user)
+
+    client.patch(f'/api/v1/notes/{ids[0]}', json={'title': 'изменена'})
+    client.post(f'/notes/{ids[1]}/delete')
+    client.post('/notes/batch-action', data={'action': 'delete', 'note_ids': [str(ids[2]), str(ids[3])]})
+    client.post('/notes/batch-action', data={'action': 'pin', 'note_ids': [str(ids[4])]})
+    data = replica.pull()
+    assert set(data['notes']) == {ids[0], ids[4]}
+    assert data['deleted_notes'] == {ids[1], ids[2], ids[3]}
+    assert replica_state(replica) == server_state(user)
+
+    # Удаление категории меняет и ее заметки
+    client.delete(f'/api/v1/categories/{category["id"]}')
+    data = replica.pull(limit=3)
+    assert data['deleted_categories'] == {category['id']}
+    assert replica_state(replica) == server_state(user)
+
+
+def test_up_to_date_and_future_cursor(client, user):
+    client.post('/api/v1/notes', json={'title': 'одна', 'content': ''})
+    _, cursor = sync(client, 0)
+
+    response = client.get(f'/api/v1/sync?since={cursor}')
+    assert response.json['data']['notes'] == []
+    assert response.json['has_more'] is False
+
+    assert client.get(f'/api/v1/sync?since={cursor + 1}').status_code == 409
+    assert client.get('/api/v1/sync?since=-1').status_code == 400